@@ -17,7 +17,7 @@ __email__ = "ngdavid@uw.edu"
 __status__ = "Production"
 
 from FCS_subroutines.loadFCS import loadFCS
-from FCS_subroutines.Process_FCS_Data import Process_FCS_Data
+from FCS_subroutines.Process_FCS_Data import Process_FCS_Data, Process_FCS_Blocks
 from FCS_subroutines.empty_FCS import empty_FCS
 from FCS_subroutines.FCSmeta_to_database import FCSmeta_to_database
 from FCS_subroutines.FCSstats_to_database import FCSstats_to_database
@@ -25,6 +25,10 @@ from FCS_subroutines.Extract_HistoStats import Extract_HistoStats
 from FCS_subroutines.Comp_Visualization import Comp_Visualization
 from FCS_subroutines.ND_Feature_Extraction import ND_Feature_Extraction
 from FCS_subroutines.p2D_Feature_Extraction import p2D_Feature_Extraction
+from FCS_subroutines.Pyramid_Feature_Extraction import Pyramid_Feature_Extraction
+from FCS_subroutines.Cell_Dictionary import Cell_Dictionary
+from FCS_subroutines.Gated_Events import Gated_Events
+from FCS_subroutines.Event_Store import Event_Store
 from . import __version__
 
 import logging
@@ -37,7 +41,10 @@ class FCS(object):
     See loadFCS for attribute details
 
     Defining attributes
-    .data <pandas dataframe | numpy array> Rows correspond to events, columns to specific Pmt
+    .data <pandas dataframe | numpy array | Event_Store> Rows correspond to events, columns to \
+    specific Pmt (an Event_Store after comp_scale_FCS_data(event_store=True))
+    .gated_events <Gated_Events> processed events and gate mask of comp_scale_FCS_data until \
+    .data is accessed (the gated dataframe is only made then)
     .filepath <str> Fullpath of file this represents
     .version <str> Imported from __init__
 
@@ -69,13 +76,63 @@ class FCS(object):
         else:
             self.make_emptyFCS(**kwargs)
 
-    def load_from_file(self, **kwargs):
+    gated_events = None
+
+    @property
+    def data(self):
+        """ Events of the file, gated events are materialized on first access """
+        if self.gated_events is not None:
+            self.__data = self.gated_events.materialize()
+            self.gated_events = None
+        return self.__data
+
+    @data.setter
+    def data(self, data):
+        if isinstance(data, Gated_Events):
+            self.__dict__.pop('_FCS__data', None)
+            self.gated_events = data
+        else:
+            self.gated_events = None
+            self.__data = data
+
+    @data.deleter
+    def data(self):
+        if self.gated_events is None and '_FCS__data' not in self.__dict__:
+            raise AttributeError("FCS.data does not exist")
+        self.gated_events = None
+        self.__dict__.pop('_FCS__data', None)
+
+    def load_from_file(self, columns=None, max_events=None, sample='stride', seed=None,
+                       **kwargs):
         """ Import FCS data from filepath
 
         nota bene: import_dataframe needs to be explicitly defined for \
         data to be loaded into FCS object
+
+        Keyword arguments:
+        columns -- <str list> only import these channels (implies import_dataframe)
+        max_events -- <int> only import this many events (implies import_dataframe)
+        sample -- 'stride' or 'random' selection of the max_events events
+        seed -- <int> random seed for sample='random'
         """
-        loadFCS(FCS=self, filepath=self.__filepath, version=self.__version, **kwargs)
+        if columns is not None or max_events is not None:
+            kwargs.setdefault('import_dataframe', True)
+        loadFCS(FCS=self, filepath=self.__filepath, version=self.__version,
+                columns=columns, max_events=max_events, sample=sample, seed=seed,
+                **kwargs)
+
+    def iter_events(self, block_size=100000, columns=None):
+        """ Iterate over the raw events of filepath in blocks
+
+        Returns a generator of <pandas dataframe> blocks of at most block_size events,
+        read from a memory map of the file so that only one block is held in memory
+
+        Keyword arguments:
+        block_size -- <int> number of events per block
+        columns -- <str list> only import these channels
+        """
+        loader = loadFCS(FCS=self, filepath=self.__filepath, version=self.__version)
+        return loader.iter_events(block_size=block_size, columns=columns)
 
     def make_emptyFCS(self, error_message, **kwargs):
         """ Import an "empty" FCS file
@@ -94,33 +151,96 @@ class FCS(object):
                             rescale_lim=(-0.15, 1),
                             strict=True,
                             auto_comp=False,
+                            cache=None,
                             **kwargs):
         """ Updates self.data via call of Process_FCS_Data
+
+        If data has not been imported it is loaded from filepath here
+
+        cache -- <Event_Cache> reuse processed data of the whole file from this cache \
+        (data is only imported and processed on a cache miss)
         """
-        if not self.__comp_scale_ran:
-            Process_FCS_Data(FCS=self, compensation_file=compensation_file,
-                             saturation_upper_range=saturation_upper_range,
-                             rescale_lim=rescale_lim,
-                             strict=strict,
-                             auto_comp=auto_comp,
-                             **kwargs)
-            self.__comp_scale_ran = True
-        else:
+        if self.__comp_scale_ran:
             raise RuntimeError("Comp_Scale_FCS_Data method has already been run")
 
+        key = None
+        if cache is not None and self.__is_whole_file():
+            key = cache.key(self, compensation_file, rescale_lim=rescale_lim, strict=strict,
+                            **kwargs)
+            if cache.load(self, key):
+                if kwargs.get('event_store', False):
+                    self.gated_events.events = Event_Store.from_dataframe(self.gated_events.events)
+                self.__comp_scale_ran = True
+                return
+
+        if not hasattr(self, 'data'):
+            self.load_from_file(import_dataframe=True)
+        Process_FCS_Data(FCS=self, compensation_file=compensation_file,
+                         saturation_upper_range=saturation_upper_range,
+                         rescale_lim=rescale_lim,
+                         strict=strict,
+                         auto_comp=auto_comp,
+                         **kwargs)
+        self.__comp_scale_ran = True
+        if key is not None:
+            cache.store(self, key)
+
+    def __is_whole_file(self):
+        """ True unless data was imported for a subset of the channels or events """
+        if not hasattr(self, 'data'):
+            return True
+        return (hasattr(self.data, 'columns') and
+                list(self.data.columns) == self.parameters.loc['Channel_Name'].tolist() and
+                len(self.data) == self.num_events)
+
+    def comp_scale_FCS_blocks(self, compensation_file, block_size=100000,
+                              saturation_upper_range=1000,
+                              rescale_lim=(-0.15, 1),
+                              strict=True,
+                              **kwargs):
+        """ Block-wise version of comp_scale_FCS_data for files that do not fit in memory
+
+        Returns an iterable of processed <pandas dataframe> blocks (see Process_FCS_Blocks)
+        that can be passed as blocks= to extract_FCS_histostats or feature_extraction.
+        self.data is not modified; the event counters are set once it is exhausted
+        """
+        return Process_FCS_Blocks(FCS=self, blocks=self.iter_events(block_size=block_size),
+                                  compensation_file=compensation_file,
+                                  saturation_upper_range=saturation_upper_range,
+                                  rescale_lim=rescale_lim,
+                                  strict=strict,
+                                  **kwargs)
+
     def feature_extraction(self, extraction_type='Full', bins=10, **kwargs):
         """
         Quasi interal function to FCS, to be accessed by other functions?
         Will extract features to an sparse data array
-        extraction type - flag for 2-D vs N-D binning
+        extraction type - flag for 2-D vs N-D binning ('Full') vs N-D binning on the
+                          occupied cells of a cohort ('Sparse') vs N-D and 2-D binning
+                          at several resolutions from one pass ('Pyramid', bins=<list>)
         **kwargs - to pass bin size information etc
+                   (blocks=<iterable of dataframes> to bin processed blocks instead of self.data,
+                    cell_dictionary=<Cell_Dictionary> shared by the cohort for 'Sparse')
         """
         type_flag = extraction_type.lower()
         if type_flag == 'full':
+            kwargs.pop('cell_dictionary', None)
             self.FCS_features = ND_Feature_Extraction(FCS=self,
                                                       bins=bins,
                                                       **kwargs)
 
+        elif type_flag == 'sparse':
+            if kwargs.get('cell_dictionary', None) is None:
+                kwargs['cell_dictionary'] = Cell_Dictionary()
+            self.FCS_features = ND_Feature_Extraction(FCS=self,
+                                                      bins=bins,
+                                                      **kwargs)
+
+        elif type_flag == 'pyramid':
+            self.FCS_features = Pyramid_Feature_Extraction(FCS=self,
+                                                           bins=bins,
+                                                           **kwargs)
+
         elif type_flag == '2d':
             self.FCS_features = p2D_Feature_Extraction(FCS=self,
                                                       bins=bins,
@@ -144,11 +264,13 @@ class FCS(object):
         """
         raise "Not implemented"
 
-    def extract_FCS_histostats(self):
+    def extract_FCS_histostats(self, blocks=None):
         """
         Calls Function to make pandas dataframe of columnwise histograms and statistics
+        blocks -- optional iterable of processed dataframes (see comp_scale_FCS_blocks)
+                  to accumulate instead of self.data
         """
-        Extract_HistoStats(FCS=self)
+        Extract_HistoStats(FCS=self, blocks=blocks)
 
     def comp_visualize_FCS(self, outfile, outfiletype="PNG"):
         """ Makes a pdf file containing the visizliations of the FCS file
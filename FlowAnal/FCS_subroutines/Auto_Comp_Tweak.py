@@ -4,94 +4,155 @@ Created on Thu Nov  6 11:49:11 2014
 This function provides a heurtistic method for tweaking compensation.
 Requires Process_FCS_Data Class
 Specifically uses:
-Process_FCS_Data.__gating()
-Process_FCS_Data.FCS.data
-Process_FCS_Data.FCS.parameters
+Process_FCS_Data.FCS.data (raw events)
+Process_FCS_Data.columns
 Process_FCS_Data._make_comp_matrix()
 Process_FCS_Data.overlap_matrix
+
+Events are compensated with the table (spectral overlap library) matrix, then in the
+populations that are bright in one reagent and dim in another (LR/UL gates of every
+reagent pair) the residual spillover is the least squares slope of the dim reagent on
+the bright one. All slopes are fitted in one batched pass over a subsample of events and
+the compensation matrix is solved for the overlap adjusted by the residual spillover
 @author: ngdavid
 """
 #from Process_FCS_Data import Process_FCS_Data
 from itertools import combinations
 import pandas as pd
-from scipy import stats
 import numpy as np
+
+from Compiled_Gate import compile_gate
+from Logicle_Transform import get_logicle_transform
+
+import logging
+log = logging.getLogger(__name__)
+
+
 class Auto_Comp_Tweak(object):
-    ignore = ['SSC-H','SSC-A','FCS-H','FCS-A','Time']
+    ignore = ['SSC-H','SSC-A','FSC-H','FSC-A','Time']
     Gates={'LR': [ (0.7,-0.2), (1.5,-0.2), (1.5,0.6), (1.0,0.6),
                          (0.7,0.3),(0.7,-0.2)],
            'UL': [ (-0.2,0.7), (-0.2,1.5), (0.6,1.5), (0.6,1.0),
                         (0.3,0.7),(-0.2,0.7)]}
-                        
-    def __init__(self,Process_FCS_object):
-        self.Gates={'LR': [ (0.7,-0.2), (1.5,-0.2), (1.5,0.6), (1.0,0.6),
-                         (0.7,0.3),(0.7,-0.2)],
-                    'UL': [ (-0.2,0.7), (-0.2,1.5), (0.6,1.5), (0.6,1.0),
-                         (0.3,0.7),(-0.2,0.7)]}
+
+    def __init__(self,Process_FCS_object,sample_size=2**15,min_events=50,max_spill=0.25):
+        """
+        sample_size -- <int> number of (evenly strided) events used to fit the spillover
+        min_events -- <int> pairs with fewer gated events are not tweaked
+        max_spill -- <float> fitted spillover slopes are clipped to +/- max_spill
+
+        Accessible Parameters:
+            .overlap_matrix -- <pandas dataframe> adjusted spectral overlap (dye x detector)
+            .spillover -- <pandas dataframe> residual spillover of each reagent (rows)
+                          into each other reagent (columns) after table compensation
+            .gated_events -- <pandas dataframe> number of events that each slope was fitted on
+            .comp_matrix -- <numpy array> compensation matrix of the adjusted overlap
+        """
         self.input = Process_FCS_object
-        self.data = self.input._LogicleRescale(self.input.FCS.data, T=2**18, M=4, W=0.5, A=0)
-        self.antigens_to_comp = self.__find_antigens(self.input.FCS.parameters)
+        self.columns = list(self.input.columns)
+        self.antigens_to_comp = [c for c in self.columns if c not in self.ignore]
+
+        # overlap matrices are cached read-only and shared between files, never edit in place
+        overlap = np.array(self.input.overlap_matrix, dtype=np.float64)
+        table_comp = self.input._make_comp_matrix(overlap)
 
-        self.overlap_matrix = pd.DataFrame(self.input.overlap_matrix,
-                                           columns = self.data.columns,
-                                           index = self.data.columns)
-        
-        self.comp_matrix = self.input._make_comp_matrix(self.overlap_matrix)
+        sample = self.__sample(np.asarray(self.input.FCS.data), sample_size)
+        compensated = np.dot(sample, table_comp)
+        spillover, n_gated = self.__fit_spillover(compensated, min_events, max_spill)
 
-        #self.print_spectral_correlation(file="/home/davidng/Desktop/PreComp_Corr.txt")
+        self.spillover = pd.DataFrame(spillover, index=self.columns, columns=self.columns)
+        self.gated_events = pd.DataFrame(n_gated, index=self.columns, columns=self.columns)
+        # compensated = true * (I + S), so the adjusted overlap is (I + S) * overlap
+        # (rows rescaled so that every dye is still one in its own detector)
+        adjusted = np.dot(np.eye(len(self.columns)) + spillover, overlap)
+        adjusted /= np.diag(adjusted)[:, np.newaxis]
+        np.fill_diagonal(adjusted, 1.0)
+        self.overlap_matrix = pd.DataFrame(adjusted, index=self.columns, columns=self.columns)
+        self.comp_matrix = self.input._make_comp_matrix(adjusted)
+        log.debug("Auto compensation tweaked {} reagent pairs".format(np.count_nonzero(spillover)))
 
-        self.data = self.data.dot(self.input.overlap_matrix)
-        self.data.columns = self.input.FCS.data.columns
-        #need to reset the column names since dot doesn't carry over
+    def __sample(self, raw, sample_size):
+        """ evenly strided subsample of at most sample_size events """
+        step = max(1, len(raw) // sample_size)
+        return np.asarray(raw[::step][:sample_size], dtype=np.float64)
 
-        #self.print_spectral_correlation(file="/home/davidng/Desktop/PostComp_Corr.txt")
+    def __fit_spillover(self, compensated, min_events, max_spill):
+        """
+        Returns the spillover <channels x channels> of every reagent (row) into every other
+        reagent (column) and the number of gated events of each fit
+
+        Reagents are gated on their logicle scale, every reagent pair is gated with the
+        LR (first bright) and UL (second bright) gates from one lookup of the compiled
+        gates and the slopes of all pairs come from masked sums of the linear values
+        """
+        index = [self.columns.index(c) for c in self.antigens_to_comp]
+        transform = get_logicle_transform(T=2**18, M=4, W=0.5, A=0)
+        scaled = np.zeros(compensated.shape, dtype=np.float32)
+        for j in index:
+            scaled[:, j] = compensated[:, j]
+            transform.transform(scaled[:, j], out=scaled[:, j])
+        scaled /= np.float32(2**18)
 
-        self.data = self.data.values
+        pairs = list(combinations(index, 2))
+        x = np.array([i for i, j in pairs] + [j for i, j in pairs], dtype=np.intp)  # bright
+        y = np.array([j for i, j in pairs] + [i for i, j in pairs], dtype=np.intp)  # dim
+        masks = np.concatenate(
+            (compile_gate(self.Gates['LR']).contains_pairs(scaled, x[:len(pairs)], y[:len(pairs)]),
+             compile_gate(self.Gates['UL']).contains_pairs(scaled, x[:len(pairs)], y[:len(pairs)])),
+            axis=1).astype(np.float64)
+
+        # masked sums of every pair as matrix products, grouped on the bright reagent
+        n = masks.sum(axis=0)
+        sx, sy, sxx, sxy = [np.zeros(len(x)) for k in range(4)]
+        for i in index:
+            k = np.flatnonzero(x == i)
+            weighted = masks[:, k] * compensated[:, i:i+1]
+            sums = np.dot(masks[:, k].T, compensated)
+            cross = np.dot(weighted.T, compensated)
+            sx[k] = sums[:, i]
+            sy[k] = sums[np.arange(len(k)), y[k]]
+            sxx[k] = cross[:, i]
+            sxy[k] = cross[np.arange(len(k)), y[k]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        slope[(n < min_events) | ~np.isfinite(slope)] = 0.0
+        np.clip(slope, -max_spill, max_spill, out=slope)
+
+        spillover = np.zeros((len(self.columns), len(self.columns)))
+        n_gated = np.zeros((len(self.columns), len(self.columns)), dtype=np.int64)
+        spillover[x, y] = slope
+        n_gated[x, y] = n
+        return spillover, n_gated
 
     def print_spectral_correlation(self,file=None):
         """
-        This will display the correlations of the gated populations,
+        This will display the residual spillover of the gated populations,
         i.e. the populations with comp issues
         """
         if file:
             fo = open(file,'w+')
 
-        pairlist = [i for i in self.__iterate_combos(self.antigens_to_comp)]
-        for pair in pairlist:
-            index_mask = self.input._gating(self.data,pair[0],pair[1],self.Gates['LR'])
-            slope, intercept, r_value, p_value, std_err = stats.linregress(self.data.loc[index_mask,pair])
-            out_str = "Correlation of {} into {}: {} r-val: {}\n".format(pair[0],pair[1],slope,r_value)
-            if file:
-                fo.write(out_str)
-            else:
-                print(out_str)
+        for pair in self.__iterate_combos(self.antigens_to_comp):
+            for a, b in [pair, pair[::-1]]:
+                out_str = "Spillover of {} into {}: {} ({} events)\n".format(
+                    a, b, self.spillover.loc[a, b], self.gated_events.loc[a, b])
+                if file:
+                    fo.write(out_str)
+                else:
+                    print(out_str)
         if file:
             fo.close()
 
     def print_spectral_overlaps(self,file=None):
-        print self.overlap_matrix        
+        print self.overlap_matrix
         for pair in self.__iterate_combos(self.antigens_to_comp):
             print("Overlap of {} into {} : {}".format(pair[0],pair[1],
                   self.overlap_matrix.loc[pair[0],pair[1]]))
             print("Overlap of {} into {} : {}".format(pair[1],pair[0],
                   self.overlap_matrix.loc[pair[1],pair[0]]))
-            
-    def __xy_comp(self,x,y):
-        """
-        Works on the upper left quadrant
-        """
-        
-    def __find_antigens(self,parameters):
-        """
-        Find parameters with defined antigens, exclude 'SSC-H','SSC-A','FCS-H','FCS-A','Time'
-        
-        """
-        index = parameters.loc['Antigen',:] != 'Unknown'
-        column_names = parameters.loc['Channel Name',index]
-        return column_names
-        
+
     def __iterate_combos(self,antigens):
         """
         Makes a list of all unique pairwise combinations of antigens
         """
-        return combinations(antigens,2)
\ No newline at end of file
+        return combinations(antigens,2)
@@ -30,14 +30,141 @@ import logging
 log = logging.getLogger(__name__)
 
 
+def _gaussian_log_prob(points, means, covars, priors):
+    """ log(prior * N(point | mean, covar)) <n x classes> of 2D points for each class """
+    output = np.empty((len(points), len(means)))
+    for k in xrange(len(means)):
+        (a, b), (_, d) = covars[k]
+        det = a * d - b * b
+        dx = points[:, 0] - means[k, 0]
+        dy = points[:, 1] - means[k, 1]
+        maha = (d * dx * dx - 2 * b * dx * dy + a * dy * dy) / det
+        output[:, k] = np.log(priors[k]) - np.log(2 * np.pi) - 0.5 * np.log(det) - 0.5 * maha
+    return output
+
+
+def _normalize_log_prob(log_prob):
+    """ returns (log sum over classes, class probabilities) of log_prob <n x classes> """
+    top = log_prob.max(axis=1)
+    prob = np.exp(log_prob - top[:, np.newaxis])
+    total = prob.sum(axis=1)
+    prob /= total[:, np.newaxis]
+    return top + np.log(total), prob
+
+
+def _predict_chunks(predict_proba, values, filter_prob, chunk_size=2**16):
+    """
+    Returns the most likely class and whether any class probability is above filter_prob
+    of every row of values, predict_proba is evaluated on chunk_size rows at a time so
+    that the (events x classes) probability matrix is never made
+    """
+    classes = np.empty(len(values), dtype=np.intp)
+    keep = np.empty(len(values), dtype=bool)
+    for start in xrange(0, len(values), chunk_size):
+        prob = predict_proba(values[start:start + chunk_size])
+        classes[start:start + chunk_size] = np.argmax(prob, axis=1)
+        keep[start:start + chunk_size] = np.any(prob > filter_prob, axis=1)
+    return classes, keep
+
+
+def weighted_EM(points, weights, n=4, seed=0, init=None, reg_covar=1e-6, tol=1e-5, max_iter=100):
+    """
+    Fits a full covariance gaussian mixture of n classes to 2D points (i.e. grid cell
+    centers) with weights (i.e. cell counts). Means are initialized by a weighted
+    k-means++ draw from np.random.RandomState(seed) so that fits are reproducible,
+    or the fit is warm started from init <dict> of means, covars and priors
+    Returns means <n x 2>, covars <n x 2 x 2> and priors <n>
+    """
+    points = np.asarray(points, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+
+    if init is not None:
+        means = np.array(init['means'], dtype=np.float64)
+        covars = np.array(init['covars'], dtype=np.float64)
+        priors = np.array(init['priors'], dtype=np.float64)
+    else:
+        random = np.random.RandomState(seed)
+        means = np.empty((n, 2))
+        means[0] = points[random.choice(len(points), p=weights / total)]
+        distance = ((points - means[0])**2).sum(axis=1)
+        for k in xrange(1, n):
+            p = weights * distance
+            means[k] = points[random.choice(len(points), p=p / p.sum())]
+            distance = np.minimum(distance, ((points - means[k])**2).sum(axis=1))
+
+        spread = np.cov(points.T, aweights=weights) + reg_covar * np.eye(2)
+        covars = np.tile(spread / n, (n, 1, 1))
+        priors = np.ones(n) / n
+
+    last = -np.inf
+    for i in xrange(max_iter):
+        log_likelihood, resp = _normalize_log_prob(_gaussian_log_prob(points, means,
+                                                                      covars, priors))
+        log_likelihood = np.dot(weights, log_likelihood) / total
+        resp *= weights[:, np.newaxis]
+        class_weights = resp.sum(axis=0) + 10 * np.finfo(float).eps
+        means = np.dot(resp.T, points) / class_weights[:, np.newaxis]
+        for k in xrange(n):
+            diff = points - means[k]
+            covars[k] = np.dot(resp[:, k] * diff.T, diff) / class_weights[k]
+            covars[k].flat[::3] += reg_covar
+        priors = class_weights / total
+        if abs(log_likelihood - last) < tol:
+            break
+        last = log_likelihood
+    else:
+        log.debug("Weighted EM did not converge in {} iterations".format(max_iter))
+    log.debug("Weighted EM stopped after {} iterations".format(i + 1))
+    return means, covars, priors
+
+
 class GMM_doublet_detection(object):
-    def __init__(self,data,filename='singlet_',classes=4,singlet_verbose=False,**kwargs):
+    def __init__(self,data,filename='singlet_',classes=4,singlet_verbose=False,
+                 singlet_method='gmm',singlet_seed=0,singlet_compare=None,
+                 singlet_cache=None,cytnum=None,date=None,**kwargs):
+        """
+        singlet_method -- 'gmm' to fit sklearn's gaussian mixture on a subsample of events,
+                          'grid' to fit a weighted EM on the counts of a grid_bins x grid_bins
+                          grid of FSC-A/FSC-H and label events by their grid cell
+        singlet_seed -- seed of the subsample/initialization, fits are reproducible under a seed
+        singlet_compare -- other singlet_method to also run, the fraction of events on which the
+                           two singlet masks agree is kept in .agreement
+        singlet_cache -- <Singlet_Model_Cache> the fit is warm started from the model cached for
+                         cytnum and date (and the model is cached on a miss)
+
+        Accessible Parameters:
+            .model -- <dict> of the fitted means, covars and priors
+        """
         self.num_classes = classes
         self.FSC = data[['FSC-A','FSC-H']]
         #fit and apply GMM to data to make annotations
-        self.class_anno, self.gmm_filter, self.centroids = self.__apply_GMM_filtering(n=classes,filter_prob=0.15,**kwargs)
+        if singlet_method.lower() == 'gmm':
+            filtering = self.__apply_GMM_filtering
+        elif singlet_method.lower() == 'grid':
+            filtering = self.__apply_grid_filtering
+        else:
+            raise ValueError("Singlet method: {} is undefined".format(singlet_method))
+        key, init = None, None
+        if singlet_cache is not None:
+            key = singlet_cache.key(cytnum, date, singlet_method, classes)
+            init = singlet_cache.load(key)
+        self.class_anno, self.gmm_filter, self.centroids = filtering(n=classes,filter_prob=0.15,
+                                                                     seed=singlet_seed,init=init,
+                                                                     **kwargs)
+        if key is not None and init is None:
+            singlet_cache.store(key, self.model)
         self.singlet_mask = self.__choose_classes_radial(**kwargs)
 
+        self.agreement = None
+        if singlet_compare is not None:
+            other = GMM_doublet_detection(data, filename=filename, classes=classes,
+                                          singlet_method=singlet_compare,
+                                          singlet_seed=singlet_seed, **kwargs)
+            self.agreement = np.mean(self.singlet_mask == other.singlet_mask)
+            log.info("Singlet masks of {} and {} agree on {:.2%} of events".format(
+                singlet_method, singlet_compare, self.agreement))
+
         if singlet_verbose==True:
             if "save_dir" in kwargs:
                 out_dir = kwargs["save_dir"] 
@@ -56,32 +183,84 @@ class GMM_doublet_detection(object):
         percentage_lost = float(number_lost)/len(self.FSC)
         return number_lost, percentage_lost
         
-    def __apply_GMM_filtering(self,n=4,filter_prob=0.1,subsize=50000,**kwargs):
+    def __apply_GMM_filtering(self,n=4,filter_prob=0.1,subsize=50000,seed=0,init=None,**kwargs):
         """
         """
-        #make a gaussian mixture model 
-        g = mixture.GMM(n_components=n,covariance_type='full')
-
-        #make subgroup size the lesser of subsize or len of array
-        input_length = len(self.FSC)
-        if input_length > subsize:
-            subgroup = subsize
-        if input_length < 1000:
-            raise(ValueError,"Number of events is too small to use this method")
+        #make a gaussian mixture model (warm started from init)
+        if hasattr(mixture, 'GaussianMixture'):
+            if init is None:
+                g = mixture.GaussianMixture(n_components=n,covariance_type='full',
+                                            random_state=seed)
+            else:
+                g = mixture.GaussianMixture(n_components=n,covariance_type='full',
+                                            random_state=seed,weights_init=init['priors'],
+                                            means_init=init['means'],
+                                            precisions_init=np.linalg.inv(init['covars']))
         else:
-            subgroup = input_length
-        
-        # fit on subgroup and predict class probabities on full data
-        temp = self.FSC[np.all(self.FSC>0,axis=1)& np.all(self.FSC<0.95,axis=1)]
-        g.fit(temp[:subgroup]) 
+            g = mixture.GMM(n_components=n,covariance_type='full',random_state=seed)
+            if init is not None:
+                g.weights_, g.means_, g.covars_ = init['priors'], init['means'], init['covars']
+                g.init_params = ''
+
+        if len(self.FSC) < 1000:
+            raise ValueError("Number of events is too small to use this method")
+
+        # fit on a random subgroup of at most subsize events and predict class probabities on full data
+        temp = self.FSC[np.all(self.FSC>0,axis=1)& np.all(self.FSC<0.95,axis=1)].values
+        if len(temp) > subsize:
+            subgroup = np.random.RandomState(seed).choice(len(temp), subsize, replace=False)
+            temp = temp[np.sort(subgroup)]
+        g.fit(temp)
         centroids = g.means_
-        clf_data = g.predict(self.FSC.values)
-        
-        # classifiction probablities
-        clf_prob = g.predict_proba(self.FSC.values)
-        gmm_filter = np.any(clf_prob>filter_prob,axis=1)
+        covars = g.covariances_ if hasattr(g, 'covariances_') else g.covars_
+        self.model = {'means': g.means_, 'covars': covars, 'priors': g.weights_}
+
+        # classes and classifiction probablities
+        clf_data, gmm_filter = _predict_chunks(g.predict_proba, self.FSC.values, filter_prob)
         return clf_data,gmm_filter,centroids
-    
+
+    def __apply_grid_filtering(self,n=4,filter_prob=0.1,grid_bins=128,seed=0,init=None,**kwargs):
+        """
+        Fits the mixture to the event counts of a grid_bins x grid_bins grid over the fit
+        range (0, 0.95) of FSC-A/FSC-H, the class and filter of every grid cell is then
+        a table that events are looked up in (events outside of the grid are evaluated exactly)
+        """
+        if len(self.FSC) < 1000:
+            raise ValueError("Number of events is too small to use this method")
+
+        values = self.FSC.values.astype(np.float64)
+        low, high = 0.0, 0.95
+        width = (high - low) / grid_bins
+        cells = np.floor((values - low) / width)
+        in_grid = np.all((values > low) & (values < high), axis=1)
+        cell = cells[in_grid].astype(np.intp)
+        flat = cell[:, 0] * grid_bins + cell[:, 1]
+        counts = np.bincount(flat, minlength=grid_bins**2)
+
+        centers = low + (np.arange(grid_bins) + 0.5) * width
+        i, j = np.divmod(np.arange(grid_bins**2), grid_bins)
+        grid = np.column_stack((centers[i], centers[j]))
+        occupied = np.flatnonzero(counts)
+        # events are spread uniformly over each cell, add that variance to the covariances
+        means, covars, priors = weighted_EM(grid[occupied], counts[occupied], n=n, seed=seed,
+                                            init=init, reg_covar=1e-6 + width**2 / 12)
+        self.model = {'means': means, 'covars': covars, 'priors': priors}
+
+        def predict_proba(points):
+            return _normalize_log_prob(_gaussian_log_prob(points, means, covars, priors))[1]
+
+        clf_data = np.empty(len(values), dtype=np.intp)
+        gmm_filter = np.empty(len(values), dtype=bool)
+        cell_class, cell_filter = _predict_chunks(predict_proba, grid[occupied], filter_prob)
+        clf_data[in_grid] = cell_class[np.searchsorted(occupied, flat)]
+        gmm_filter[in_grid] = cell_filter[np.searchsorted(occupied, flat)]
+
+        outside = ~in_grid
+        if outside.any():
+            clf_data[outside], gmm_filter[outside] = _predict_chunks(predict_proba,
+                                                                     values[outside], filter_prob)
+        return clf_data,gmm_filter,means
+
     def __choose_classes_absolute(self):
         """Chooses class to use 
         Returns an output mask
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Provides a dictionary of the occupied cells of an N dimensional binning
+
+Cell ids are assigned as cells are first seen and are shared by all tubes of a
+cohort, so that sparse ND features only have columns for occupied cells
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Cell_Dictionary(object):
+    """
+    Maps occupied cells (one bin number per channel) to compact column ids, so that
+    sparse ND features are as wide as the number of cells occupied in the cohort
+    rather than bins^channels
+
+    Cells are keyed on their bin numbers packed into a uint64 (each channel takes
+    ceil(log2(bins)) bits) and, if the packed coordinates do not fit in 64 bits, on
+    the bytes of the coordinates (exact, hashed by python's dict)
+
+    Accessiable Parameters:
+        .bin_description -- <pd.Series> number of bins per channel (set by the first use)
+        .capacity --        <int> maximum number of cells, the width of the feature rows
+        .packed --          <bool> whether cells are keyed on packed uint64 coordinates
+    """
+
+    def __init__(self, bin_description=None, capacity=2**31-1):
+        self.capacity = capacity
+        self.bin_description = None
+        self.__ids = {}
+        self.__cells = []   # blocks of coordinates, in order of id
+        if bin_description is not None:
+            self.set_bin_description(bin_description)
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def set_bin_description(self, bin_description):
+        """ Defines the channels and number of bins of the cells (once) """
+        if self.bin_description is not None:
+            if not bin_description.equals(self.bin_description):
+                raise ValueError("Bin description {} does not match the cell dictionary {}".
+                                 format(dict(bin_description), dict(self.bin_description)))
+            return
+        if np.any(bin_description.values > 2**16):
+            raise ValueError("Cell dictionary supports at most 2**16 bins per channel")
+        self.bin_description = bin_description.astype(np.int64)
+
+        bits = [max(1, int(np.ceil(np.log2(b)))) for b in self.bin_description.values]
+        self.shifts = np.cumsum([0] + bits[:-1]).astype(np.uint64)
+        self.packed = sum(bits) <= 64
+        if not self.packed:
+            log.info("Cell coordinates need {} bits, using byte keys".format(sum(bits)))
+
+    def encode(self, coordinates):
+        """
+        Returns the unique cell keys of coordinates <n x channels int array> with the index
+        of their first occurence and their counts
+        """
+        return np.unique(self.__keys(coordinates), return_index=True, return_counts=True)
+
+    def lookup(self, coordinates):
+        """
+        Returns the ids and counts of the occupied cells in coordinates
+        <n x channels int array>, cells not seen before are added to the dictionary
+        """
+        coordinates = np.asarray(coordinates)
+        keys, first, counts = self.encode(coordinates)
+        keys = self.__hashable(keys)
+
+        ids = np.array([self.__ids.get(k, -1) for k in keys], dtype=np.int64)
+        new = np.flatnonzero(ids < 0)
+        if len(new) > 0:
+            if len(self) + len(new) > self.capacity:
+                raise ValueError("Cell dictionary is full ({} cells)".format(self.capacity))
+            ids[new] = np.arange(len(self), len(self) + len(new))
+            for i in new:
+                self.__ids[keys[i]] = ids[i]
+            self.__cells.append(coordinates[first[new]].astype(np.uint16))
+        return ids, counts
+
+    def coordinates(self, ids=None):
+        """ Returns the bin numbers <n x channels array> of cell ids (all cells if None) """
+        if self.__cells:
+            cells = np.concatenate(self.__cells)
+            self.__cells = [cells]
+        else:
+            cells = np.zeros((0, len(self.bin_description)), dtype=np.uint16)
+        if ids is None:
+            return cells
+        return cells[np.asarray(ids)]
+
+    def __keys(self, coordinates):
+        """ Returns the key of every row of coordinates """
+        coordinates = np.ascontiguousarray(coordinates, dtype=np.uint16)
+        if self.packed:
+            keys = np.zeros(len(coordinates), dtype=np.uint64)
+            for j, shift in enumerate(self.shifts):
+                keys |= coordinates[:, j].astype(np.uint64) << shift
+            return keys
+        return coordinates.view(np.dtype((np.void, coordinates.shape[1] * 2))).ravel()
+
+    def __hashable(self, keys):
+        if self.packed:
+            return keys.tolist()
+        return [k.tostring() for k in keys]
+
+    @classmethod
+    def from_coordinates(cls, bin_description, coordinates, capacity=2**31-1):
+        """
+        Rebuilds a dictionary from bin_description and its coordinates (see coordinates()),
+        the cell in row i of coordinates gets id i
+        """
+        cell_dict = cls(bin_description, capacity=capacity)
+        cell_dict.__add(np.asarray(coordinates, dtype=np.uint16))
+        return cell_dict
+
+    def __add(self, coordinates):
+        keys = self.__hashable(self.__keys(coordinates))
+        self.__ids = dict(zip(keys, xrange(len(keys))))
+        if len(self.__ids) != len(keys):
+            raise ValueError("Cell coordinates are not unique")
+        self.__cells = [coordinates]
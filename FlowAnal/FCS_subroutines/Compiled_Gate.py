@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Provides polygon gates that are rasterized once into a lookup table
+
+Gate membership of events is then an integer index lookup; only events that fall
+in grid cells crossed by the polygon edges are tested exactly with matplotlib's Path.
+Compiled gates are memoized per process (see compile_gate) so that fixed gates
+are compiled once per run rather than once per file
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import numpy as np
+from matplotlib.path import Path
+
+import logging
+log = logging.getLogger(__name__)
+
+_gates = {}     # Compiled_Gate objects keyed on (coords, resolution)
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+def compile_gate(coords, resolution=2048):
+    """ Returns the (memoized) Compiled_Gate of the closed polygon coords """
+    key = (tuple((float(x), float(y)) for x, y in coords), resolution)
+    if key not in _gates:
+        _gates[key] = Compiled_Gate(coords, resolution=resolution)
+    return _gates[key]
+
+
+class Compiled_Gate(object):
+    """
+    Closed polygon gate (same semantics as Path(coords, closed=True).contains_points)
+    rasterized over the bounding box of the polygon into a resolution x resolution
+    table of cells that are inside, outside or on the boundary of the gate
+    """
+
+    def __init__(self, coords, resolution=2048):
+        self.path = Path(coords, closed=True)
+        self.resolution = resolution
+
+        polygons = self.path.to_polygons()
+        vertices = np.concatenate(polygons)
+        self.lower = vertices.min(axis=0)
+        self.upper = vertices.max(axis=0)
+        span = self.upper - self.lower
+        span[span == 0] = 1.0
+        self.scale = resolution / span
+
+        boundary = self.__boundary_cells(polygons)
+
+        # cells not crossed by an edge are entirely in or out and so is every run of
+        # them along a row of the table, test the center of the first cell of each run
+        free = ~boundary
+        start = free.copy()
+        start[:, 1:] &= boundary[:, :-1]
+        run = np.cumsum(start.ravel()) - 1
+        i, j = np.nonzero(start)
+        centers = np.column_stack([self.lower[0] + (i + 0.5) / self.scale[0],
+                                   self.lower[1] + (j + 0.5) / self.scale[1]])
+        run_inside = self.path.contains_points(centers)
+        inside = np.zeros(boundary.size, dtype=bool)
+        inside[free.ravel()] = run_inside[run[free.ravel()]]
+        inside = inside.reshape(boundary.shape)
+
+        # table padded with one cell below the bounding box (outside), one cell band above
+        # it (tested exactly, it holds the upper edges of the box) and outside beyond that
+        self.table = np.zeros((resolution + 3, resolution + 3), dtype=np.int8)
+        self.table[1:resolution+1, 1:resolution+1] = np.where(boundary, BOUNDARY,
+                                                              np.where(inside, INSIDE, OUTSIDE))
+        self.table[1:resolution+2, resolution+1] = BOUNDARY
+        self.table[resolution+1, 1:resolution+2] = BOUNDARY
+        log.debug('Compiled gate {} ({} boundary cells)'.format(coords, boundary.sum()))
+
+    def contains(self, points):
+        """ Returns a boolean mask of the points <n x 2 array> within the gate """
+        points = np.asarray(points)
+        width = self.resolution + 3
+        cell = self.__cell_index(points[:, 0], 0) * width
+        cell += self.__cell_index(points[:, 1], 1)
+        cells = np.take(self.table.ravel(), cell)
+
+        index = cells == INSIDE
+        exact = np.flatnonzero(cells == BOUNDARY)
+        if len(exact) > 0:
+            index[exact] = self.path.contains_points(points[exact])
+        return index
+
+    def contains_pairs(self, values, x, y):
+        """
+        Returns boolean masks <n x pairs> of the points (values[:, x[k]], values[:, y[k]])
+        within the gate for every pair k, as contains() on each projection but with the
+        table rows/columns of each channel of values computed once
+        """
+        values = np.asarray(values)
+        width = self.resolution + 3
+        rows = dict((i, self.__cell_index(values[:, i], 0) * width) for i in set(x))
+        cols = dict((j, self.__cell_index(values[:, j], 1)) for j in set(y))
+        table = self.table.ravel()
+
+        masks = np.empty((len(values), len(x)), dtype=bool)
+        for k, (i, j) in enumerate(zip(x, y)):
+            cells = np.take(table, rows[i] + cols[j])
+            masks[:, k] = cells == INSIDE
+            exact = np.flatnonzero(cells == BOUNDARY)
+            if len(exact) > 0:
+                points = np.column_stack((values[exact, i], values[exact, j]))
+                masks[exact, k] = self.path.contains_points(points)
+        return masks
+
+    def __cell_index(self, values, axis):
+        """
+        Row (axis 0) or column (axis 1) of values in the padded table, NaN maps to 0
+        (float32 values are binned in float32, the rounding is covered by the boundary padding)
+        """
+        dtype = np.float32 if values.dtype == np.float32 else np.float64
+        offset = values - dtype(self.lower[axis])
+        offset *= dtype(self.scale[axis])
+        offset += dtype(1)
+        np.clip(offset, 0, self.resolution + 2, out=offset)
+        offset[np.isnan(offset)] = 0
+        return offset.astype(np.intp)
+
+    def __boundary_cells(self, polygons, pad=2):
+        """
+        Marks the cells crossed by the polygon edges, padded by pad cells so that
+        rounding in the cell lookup can not move an event into an unmarked cell
+        """
+        boundary = np.zeros((self.resolution, self.resolution), dtype=bool)
+        for polygon in polygons:
+            for start, end in zip(polygon[:-1], polygon[1:]):
+                # sample the edge at least twice per cell
+                n = int(np.ceil(2 * np.abs((end - start) * self.scale).max())) + 1
+                t = np.linspace(0, 1, n).reshape(-1, 1)
+                cells = ((start + t * (end - start) - self.lower) * self.scale).astype(np.intp)
+                for di in xrange(-pad, pad + 1):
+                    for dj in xrange(-pad, pad + 1):
+                        boundary[np.clip(cells[:, 0] + di, 0, self.resolution - 1),
+                                 np.clip(cells[:, 1] + dj, 0, self.resolution - 1)] = True
+        return boundary
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of processed (compensated, scaled and gated) FCS event data
+
+Entries are keyed on the file fingerprint (size, mtime and content hash) and a
+fingerprint of the processing parameters, so that rerunning feature extraction
+or stats on the same files skips parsing and compensation entirely
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import os
+import hashlib
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+
+from Gated_Events import Gated_Events
+
+import logging
+log = logging.getLogger(__name__)
+
+# content hashes of files already seen by this process, keyed on (filepath, size, mtime)
+_file_hashes = {}
+
+
+class Event_Cache(object):
+    """
+    Stores FCS.data after Process_FCS_Data as a float32 .npy file along with a pickle of the
+    event index, the gates applied and every other output of Process_FCS_Data on FCS
+    (total_events, n_transform_*, singlet_remain, viable_remain, singlet_agreement)
+
+    cache_dir - directory holding the cache entries (created if needed)
+    max_size - <int> maximum total size of the cache in bytes, least recently used
+               entries are evicted beyond this
+
+    Counts hits and misses of this instance in .hits and .misses
+    """
+
+    counters = ['total_events', 'n_transform_not_nan_all', 'n_transform_keep_all',
+                'n_transform_not_nan_by_channel', 'n_transform_keep_by_channel',
+                'singlet_remain', 'viable_remain']
+    outputs = counters + ['singlet_agreement']  # set on FCS by Process_FCS_Data (if at all)
+
+    # settings of Process_FCS_Data that change its output (with their defaults), any other
+    # argument (engine, event_store, command line options, ...) is not part of the key
+    settings = {'rescale_lim': (-0.15, 1), 'strict': True, 'gate_coords': None,
+                'log_param': None, 'comp_flag': 'table', 'singlet_flag': 'fixed',
+                'viable_flag': 'fixed'}
+    # settings of auto singlet gating, only part of the key with singlet_flag='auto'
+    singlet_settings = {'singlet_method': 'gmm', 'singlet_seed': 0, 'classes': 4,
+                        'singlet_compare': None, 'grid_bins': 128, 'subsize': 50000}
+
+    def __init__(self, cache_dir, max_size=10*2**30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, FCS, compensation_file, **kwargs):
+        """
+        Returns the cache key of FCS processed with compensation_file and the
+        processing arguments in kwargs (the arguments passed to Process_FCS_Data)
+
+        The key is made from the settings (defaults filled in) only. Auto singlet fits
+        that are warm started from a singlet_cache <Singlet_Model_Cache> may differ a
+        little from cold fits, so the singlet cache directory and date window are
+        part of the key as well
+        """
+        stat = os.stat(FCS.filepath)
+        params = self.__resolve(kwargs, self.settings)
+        for flag in ['comp_flag', 'singlet_flag', 'viable_flag']:
+            if params[flag] is not None:
+                params[flag] = params[flag].lower()
+        params['rescale_lim'] = tuple(params['rescale_lim'])
+        if params['singlet_flag'] == 'auto':
+            params.update(self.__resolve(kwargs, self.singlet_settings))
+            params['singlet_method'] = params['singlet_method'].lower()
+            singlet_cache = kwargs.get('singlet_cache', None)
+            if singlet_cache is not None:
+                params['singlet_cache'] = (os.path.abspath(singlet_cache.cache_dir),
+                                           singlet_cache.window_days)
+        params['library'] = self.__library_hash(FCS, compensation_file)
+        fingerprint = [stat.st_size, stat.st_mtime, self.__file_hash(FCS.filepath, stat),
+                       _fingerprint(params)]
+        return hashlib.md5(repr(fingerprint)).hexdigest()
+
+    def load(self, FCS, key):
+        """
+        Exports cached data and outputs to FCS, returns False if key is not cached
+
+        FCS.data is the Gated_Events of the cached (gated) events with the gates
+        applied on processing in .remain
+        """
+        data_fp, meta_fp = self.__paths(key)
+        if not (os.path.exists(data_fp) and os.path.exists(meta_fp)):
+            self.misses += 1
+            return False
+
+        try:
+            with open(meta_fp, 'rb') as fh:
+                meta = pickle.load(fh)
+            values = np.load(data_fp)
+        except (IOError, ValueError, EOFError, pickle.UnpicklingError), e:
+            log.warning('Discarding unreadable cache entry {}: {}'.format(key, e))
+            self.__remove(key)
+            self.misses += 1
+            return False
+
+        gated = Gated_Events(pd.DataFrame(values, index=meta['index'], columns=meta['columns']))
+        gated.remain = list(meta.get('remain', []))
+        FCS.data = gated
+        for output in self.outputs:
+            if output in meta:
+                setattr(FCS, output, meta[output])
+        os.utime(data_fp, None)  # mark as recently used
+        self.hits += 1
+        return True
+
+    def store(self, FCS, key):
+        """ Writes the processed FCS.data and outputs to the cache """
+        data_fp, meta_fp = self.__paths(key)
+        gated = FCS.gated_events
+        if gated is not None:   # FCS.data is left as the Gated_Events
+            data, remain = gated.materialize(), gated.remain
+        else:
+            data, remain = FCS.data, []
+        meta = {'index': np.asarray(data.index),
+                'columns': list(data.columns),
+                'remain': list(remain)}
+        for output in self.outputs:
+            if hasattr(FCS, output):
+                meta[output] = getattr(FCS, output)
+
+        # write to temporary files so that concurrent readers never see partial entries
+        tmp = '.{}'.format(os.getpid())
+        with open(data_fp + tmp, 'wb') as fh:
+            np.save(fh, np.asarray(data.values, dtype=np.float32))
+        with open(meta_fp + tmp, 'wb') as fh:
+            pickle.dump(meta, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(meta_fp + tmp, meta_fp)
+        os.rename(data_fp + tmp, data_fp)
+
+        self.__evict()
+
+    def size(self):
+        """ Returns the total size of the cache entries in bytes """
+        return sum(size for mtime, size, key in self.__entries())
+
+    def clear(self):
+        """ Removes all cache entries """
+        for mtime, size, key in self.__entries():
+            self.__remove(key)
+
+    def __evict(self):
+        """ Removes least recently used entries until the cache fits in max_size """
+        entries = sorted(self.__entries())
+        total = sum(size for mtime, size, key in entries)
+        while entries and total > self.max_size:
+            mtime, size, key = entries.pop(0)
+            log.debug('Evicting cache entry {}'.format(key))
+            self.__remove(key)
+            total -= size
+
+    def __entries(self):
+        """ Returns [(last use, size, key)] of the cache entries """
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.npy'):
+                continue
+            key = fn[:-len('.npy')]
+            data_fp, meta_fp = self.__paths(key)
+            try:
+                stat = os.stat(data_fp)
+                size = stat.st_size + os.path.getsize(meta_fp)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, key))
+        return entries
+
+    def __remove(self, key):
+        for fp in self.__paths(key):
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+
+    def __resolve(self, kwargs, settings):
+        """ Returns the value of every setting in kwargs, or its default """
+        return dict((name, kwargs.get(name, default)) for name, default in settings.items())
+
+    def __paths(self, key):
+        return (os.path.join(self.cache_dir, key + '.npy'),
+                os.path.join(self.cache_dir, key + '.pkl'))
+
+    def __library_hash(self, FCS, compensation_file):
+        """ Content hash of the spectral overlap library that applies to FCS """
+        if isinstance(compensation_file, dict):
+            compensation_file = compensation_file.get(FCS.cytnum, None)
+        if compensation_file is None or not os.path.exists(compensation_file):
+            return repr(compensation_file)
+        return self.__file_hash(compensation_file, os.stat(compensation_file))
+
+    def __file_hash(self, filepath, stat, chunk_size=2**20):
+        """ md5 of the contents of filepath, memoized on (filepath, size, mtime) """
+        memo_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+        if memo_key not in _file_hashes:
+            md5 = hashlib.md5()
+            with open(filepath, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(chunk_size), ''):
+                    md5.update(chunk)
+            _file_hashes[memo_key] = md5.hexdigest()
+        return _file_hashes[memo_key]
+
+
+def _fingerprint(value):
+    """ Hashable representation of value that does not depend on dict ordering """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _fingerprint(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(v) for v in value)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        value = value.values
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, hashlib.md5(value.tobytes()).hexdigest())
+    return value
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Compact array-backed container of FCS events, an alternative to the pandas dataframe of FCS.data
+
+Events are one C-contiguous float32 <events x channels> array with a channel name to
+column map, so that the memory of an FCS object is the array plus a few hundred bytes
+(also when pickled between processes). Columns are views into the array and the container
+converts to and from a dataframe on demand
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import numpy as np
+import pandas as pd
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Event_Store(object):
+    """
+    values - <events x channels> array (converted to a contiguous float32 array)
+    columns - <str list> channel names
+    index - optional event ids <int array> (default: event positions, stored as None)
+
+    Indexing follows the dataframe:
+        store['CD45 V450'] -- <float32 array> view of the channel
+        store[['FSC-A', 'FSC-H']] -- Event_Store of the channels (a copy)
+        store[mask] -- Event_Store of the events in mask <bool or int array> (a copy)
+    """
+
+    __slots__ = ('values', 'columns', '_index', '_positions')
+
+    def __init__(self, values, columns, index=None):
+        values = np.ascontiguousarray(values, dtype=np.float32)
+        if values.ndim != 2 or values.shape[1] != len(columns):
+            raise ValueError("Event array of shape {} does not match {} columns".format(
+                values.shape, len(columns)))
+        if index is not None and len(index) != len(values):
+            raise ValueError("Index of {} events does not match {} events".format(
+                len(index), len(values)))
+        self.values = values
+        self.columns = list(columns)
+        self._index = None if index is None else np.asarray(index)
+        self._positions = dict((c, j) for j, c in enumerate(self.columns))
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        """ Returns the Event_Store of dataframe (a default range index is not kept) """
+        index = dataframe.index
+        if index.equals(pd.RangeIndex(len(index))):
+            index = None
+        else:
+            index = index.values
+        return cls(dataframe.values, dataframe.columns, index=index)
+
+    def to_dataframe(self):
+        """ Returns a dataframe on the event array (not copied) """
+        return pd.DataFrame(self.values, index=self._index, columns=self.columns, copy=False)
+
+    @property
+    def index(self):
+        """ <int array> event ids """
+        if self._index is None:
+            return np.arange(len(self.values))
+        return self._index
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, column):
+        return column in self._positions
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.values[:, self._positions[key]]
+        if isinstance(key, (list, tuple)) and all(isinstance(k, basestring) for k in key):
+            positions = [self._positions[k] for k in key]
+            return Event_Store(self.values[:, positions], key, index=self._index)
+        key = np.asarray(key)
+        if key.dtype == bool and len(key) != len(self.values):
+            raise IndexError("Mask of {} events does not match {} events".format(
+                len(key), len(self.values)))
+        return Event_Store(self.values[key], self.columns, index=self.index[key])
+
+    def __getstate__(self):
+        return (self.values, self.columns, self._index)
+
+    def __setstate__(self, state):
+        values, columns, index = state
+        self.values = values
+        self.columns = columns
+        self._index = index
+        self._positions = dict((c, j) for j, c in enumerate(columns))
+
+    def __repr__(self):
+        return "Event_Store({} events x {} channels)".format(*self.values.shape)
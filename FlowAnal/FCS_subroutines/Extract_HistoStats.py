@@ -6,8 +6,8 @@ This file describes a class that generates column-wise stats and histograms
 from FCS data
 @author: David Ng, MD
 """
-from scipy.stats import pearsonr
-from matplotlib.path import Path
+from scipy.special import betainc
+from Compiled_Gate import compile_gate
 
 import pandas as pd
 import numpy as np
@@ -18,18 +18,155 @@ import itertools
 log = logging.getLogger(__name__)
 
 
+def histogram_counts(values, edges, clip=False, chunk_size=2**16, mask=None):
+    """
+    Returns the counts <bins x columns> of every column of values <n x columns> in the
+    bins of edges and the edges used, binned as np.histogram (float32 values are binned
+    on float32 edges and the last edge falls in the last bin)
+
+    Values out of range (and NaN) are not counted, unless clip in which case values out
+    of range are counted in the first/last bin. All columns are counted with one bincount
+    per chunk of events over the bin numbers offset by column
+
+    mask -- <bool array> only count these events (taken chunk by chunk, values is not copied)
+    """
+    dtype = np.float32 if values.dtype == np.float32 else np.float64
+    edges = np.asarray(edges, dtype=dtype)
+    bins = len(edges) - 1
+    n_columns = values.shape[1]
+    offsets = np.arange(n_columns) * bins
+    counts = np.zeros(n_columns * bins + 1, dtype=np.int64)  # last bin collects out of range
+    for start in xrange(0, len(values), chunk_size):
+        chunk = np.asarray(values[start:start + chunk_size], dtype=dtype)
+        if mask is not None:
+            chunk = chunk[mask[start:start + chunk_size]]
+        codes = np.searchsorted(edges, chunk.ravel(), side='right').reshape(chunk.shape) - 1
+        codes[chunk == edges[-1]] = bins - 1
+        if clip:
+            np.clip(codes, 0, bins - 1, out=codes)
+        out = (codes < 0) | (codes >= bins) | np.isnan(chunk)
+        codes += offsets
+        codes[out] = n_columns * bins
+        counts += np.bincount(codes.ravel(), minlength=n_columns * bins + 1)
+    return counts[:-1].reshape(n_columns, bins).T, edges
+
+
+def quantiles(values, q=(0.25, 0.5, 0.75)):
+    """
+    Returns the quantiles <len(q) x columns> of every column of values, linearly
+    interpolated as np.percentile (NaN are ignored as in DataFrame.describe) with
+    one np.partition of values rather than a sort
+    """
+    values = np.asarray(values)
+    nan = np.isnan(values).any(axis=0)
+    output = np.empty((len(q), values.shape[1]))
+    if not nan.all():
+        output[:, ~nan] = _partition_quantiles(values[:, ~nan], q)
+    for j in np.flatnonzero(nan):
+        # pandas returns the quantiles of columns with NaN in the precision of the column
+        column = values[:, j]
+        column = _partition_quantiles(column[~np.isnan(column)].reshape(-1, 1), q)[:, 0]
+        output[:, j] = column.astype(values.dtype)
+    return output
+
+
+def _partition_quantiles(values, q):
+    n = len(values)
+    if n == 0:
+        return np.full((len(q), values.shape[1]), np.nan)
+    indices = np.asarray(q, dtype=np.float64) * (n - 1)
+    below = np.floor(indices).astype(np.intp)
+    above = np.minimum(below + 1, n - 1)
+    weights_above = (indices - below).reshape(-1, 1)
+    weights_below = 1.0 - weights_above
+    ap = np.partition(values, np.concatenate((below, above)), axis=0)
+    return ap[below] * weights_below + ap[above] * weights_above
+
+
+class Quantile_Sketch(object):
+    """
+    Quantile sketch of the columns of chunked data (see update) that needs no range
+
+    Events are kept in levels of weight 2**h, a level that reaches 2*k events is sorted
+    and every other event (alternating the first) moves up a level with twice the weight.
+    The rank error of a quantile of n events is at most n*log2(n/k)/(2*k), so memory stays
+    at about 2*k*log2(n/k) events per column
+    """
+
+    def __init__(self, n_columns, k=2**12):
+        self.k = k
+        self.n_columns = n_columns
+        self.levels = []
+        self.__offset = 0
+
+    def update(self, values):
+        """ Adds the events of values <n x columns> to the sketch """
+        if len(values) > 0:
+            # levels are <columns x events> so that sorts run along contiguous rows
+            self.__add(0, np.array(values, dtype=np.float64).T)
+
+    def __add(self, h, values):
+        if len(self.levels) <= h:
+            self.levels.append(np.empty((self.n_columns, 0)))
+        level = np.concatenate((self.levels[h], values), axis=1)
+        if level.shape[1] < 2 * self.k:
+            self.levels[h] = level
+            return
+        level.sort(axis=1, kind='quicksort' if h == 0 else 'mergesort')  # upper levels are sorted runs
+        n = level.shape[1] // 2 * 2
+        self.levels[h] = level[:, n:]
+        self.__offset = 1 - self.__offset
+        self.__add(h + 1, level[:, self.__offset:n:2])
+
+    def quantiles(self, q=(0.25, 0.5, 0.75)):
+        """ Returns the quantiles <len(q) x columns> of the events added to the sketch """
+        output = np.full((len(q), self.n_columns), np.nan)
+        if not self.levels:
+            return output
+        values = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate([np.repeat(2.0**h, level.shape[1])
+                                  for h, level in enumerate(self.levels)])
+        for j in xrange(self.n_columns):
+            keep = ~np.isnan(values[j])
+            if not keep.any():
+                continue
+            order = np.argsort(values[j, keep])
+            cumulative = np.cumsum(weights[keep][order])
+            ranks = np.asarray(q) * (cumulative[-1] - 1)
+            index = np.minimum(np.searchsorted(cumulative, ranks, side='right'), len(order) - 1)
+            output[:, j] = values[j, keep][order][index]
+        return output
+
+
 class Extract_HistoStats(object):
 
-    def __init__(self, FCS,range=(0,1),comp_corr_cutoff=25):
+    # upper left corner gate of the compensation correlations
+    ul_gate_coords = [(0.0,0.7),(0.6,0.7),(0.9,1.0),(0.0,1.0),(0.0,0.7)]
+
+    def __init__(self, FCS,range=(0,1),comp_corr_cutoff=25,blocks=None):
         """
         Returns 2 dataframes, stats and histogram indexed on parameters in
         FCS.data
         TODO: Other statistical Measures to be added?
         :param FCS:
+        :param blocks: optional iterable of processed dataframes (see
+                       FCS.comp_scale_FCS_blocks) to accumulate instead of FCS.data
+                       (PmtStats quartiles come from a Quantile_Sketch of the gated
+                       events, their rank error is at most n*log2(n/k)/(2*k) of n events
+                       with k=4096, i.e. about 0.1% of the events for 10**6 events)
         :return:
         """
-        if hasattr(FCS, 'data'):
+        if blocks is not None:
+            self.FCS = FCS
+            self.__accumulate_blocks(blocks, range=range, cutoff=comp_corr_cutoff)
+            FCS.TubeStats = self.__make_TubeStats()
+        elif getattr(FCS, 'gated_events', None) is not None or hasattr(FCS, 'data'):
             self.FCS = FCS
+            # gated events are read through their mask rather than materializing FCS.data
+            if getattr(FCS, 'gated_events', None) is not None:
+                self.events, self.mask = FCS.gated_events.events, FCS.gated_events.mask
+            else:
+                self.events, self.mask = FCS.data, None
             FCS.PmtStats = self.__make_PmtStats()
             FCS.TubeStats = self.__make_TubeStats()
             FCS.histos = self.__make_histogram(range=range)
@@ -47,9 +184,11 @@ class Extract_HistoStats(object):
         :param density:
         :return pandas dataframe:
         """
-        columns = self.FCS.data.columns
-        function_hist = lambda x: np.histogram(x, bins=bins, range=range, density=density)[0]
-        histo_df = np.apply_along_axis(function_hist, 0, self.FCS.data[columns])
+        columns = self.events.columns
+        edges = np.linspace(range[0], range[1], bins + 1)
+        histo_df, edges = histogram_counts(self.events.values, edges, mask=self.mask)
+        if density:  # as np.histogram(density=True)
+            histo_df = histo_df / np.diff(edges).astype(float).reshape(-1, 1) / histo_df.sum(axis=0)
         histo_df = pd.DataFrame(histo_df, columns=columns,
                                 index=np.linspace(range[0], range[1], num=bins))
         return histo_df
@@ -58,11 +197,26 @@ class Extract_HistoStats(object):
         """
         Returns a dataframe with columns indexed on parameters
         Rows of [count,mena,std,min,25%,50%,75%,max]
+        (as DataFrame.describe, with the quartiles of all columns from one partition)
         :return:
         """
-        stats = self.FCS.data.describe().T
+        data = self.events
+        if self.mask is None:
+            quartiles = quantiles(data.values)
+        else:
+            quartiles = quantiles(data.values[self.mask])
+        stats = []
+        for j, c in enumerate(data.columns):
+            column = np.asarray(data[c])   # dataframe or Event_Store column
+            column = pd.Series(column if self.mask is None else column[self.mask])
+            stats.append([column.count(), column.mean(), column.std(), column.min()] +
+                         list(quartiles[:, j]) + [column.max()])
+        stats = pd.DataFrame(stats, index=data.columns, dtype=np.float64,
+                             columns=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'])
+        return self.__add_transform_counts(stats)
 
-        # Add transformation filtering information
+    def __add_transform_counts(self, stats):
+        """ Add transformation filtering information to PmtStats """
         stats = pd.concat([stats, self.FCS.n_transform_keep_by_channel], axis=1, join='outer',
                           ignore_index=False)
         stats = pd.concat([stats, self.FCS.n_transform_not_nan_by_channel], axis=1, join='outer',
@@ -81,37 +235,134 @@ class Extract_HistoStats(object):
         a list of lists with [Xax,Yax,PearsonR,P_value]
         N.B. - This is a subfunction of the FCS object
 	    """
-        # set up the reagent list
+        pairs = self.__reagent_pairs(self.events.columns)
+        sums = self.__pair_sums(self.events, pairs, mask=self.mask)
+        return self.__comp_corr_table(pairs, sums, cutoff)
+
+    def __reagent_pairs(self, columns):
+        """ all pairwise permutations of the reagents (not scatter or time) in columns """
         exclude = ['FSC-A','FSC-H','SSC-A','SSC-H','Time']
-        reagents = [i for i in self.FCS.data.columns if i not in exclude]
+        reagents = [i for i in columns if i not in exclude]
+        return list(itertools.permutations(reagents,2))
 
-        # make an empty list to append
-        output = []
-        for (x,y) in itertools.permutations(reagents,2):
-	        # this will walk through all pairwise permutations of the reagent
-            correlation = self.__comp_correlation(x,y,cutoff=cutoff)
-            output.append([x,y,correlation[0],correlation[1]])
-        return pd.DataFrame(output,columns = ['spill_in','spill_from','Pearson_R','P_value'])
+    def __pair_sums(self, data, pairs, chunk_size=2**14, mask=None):
+        """
+        Returns the sums [n, sx, sy, sxx, syy, sxy] <pairs x 6> of the events of every
+        (x, y) pair of columns of data within the upper left gate of that pair
 
-    def __comp_correlation(self,x_ax,y_ax,cutoff):
-        gated_pop = self.FCS.data[[x_ax,y_ax]][self.__UL_gating(x_ax,y_ax)]
+        Gate masks of all pairs come from one lookup in the compiled gate and the sums
+        are masked matrix products, one pass over each chunk of events
+        (of the events in mask <bool array> if given)
+        """
+        columns = list(data.columns)
+        x = np.array([columns.index(x_ax) for x_ax, y_ax in pairs], dtype=np.intp)
+        y = np.array([columns.index(y_ax) for x_ax, y_ax in pairs], dtype=np.intp)
+        k = np.arange(len(pairs))
+        gate = compile_gate(self.ul_gate_coords)
 
-        if len(gated_pop) > cutoff:
-	        output = pearsonr(gated_pop.iloc[:,0],gated_pop.iloc[:,1])
+        sums = np.zeros((len(pairs), 6))
+        data_values = data.values
+        for start in xrange(0, len(data), chunk_size):
+            chunk = data_values[start:start + chunk_size]
+            if mask is not None:
+                chunk = chunk[mask[start:start + chunk_size]]
+            masks = gate.contains_pairs(chunk, x, y).astype(np.float64)
+            values = np.asarray(chunk, dtype=np.float64)
+            first = masks.T.dot(values)         # sums of every column over each pair gate
+            second = masks.T.dot(values**2)
+            sums[:, 0] += masks.sum(axis=0)
+            sums[:, 1] += first[k, x]
+            sums[:, 2] += first[k, y]
+            sums[:, 3] += second[k, x]
+            sums[:, 4] += second[k, y]
+            sums[:, 5] += np.einsum('ij,ij->j', values[:, x] * values[:, y], masks)
+        return sums
 
-        else:
-	          #if not enough events exist in the gate; there is no point in taking
-	          #a correlation and we should append NaN to the matrix
-	        output = (np.nan,np.nan)
+    def __comp_corr_table(self, pairs, sums, cutoff):
+        """ the [spill_in, spill_from, Pearson_R, P_value] table of pairs from their sums """
+        r, p = self.__pearson_from_sums(sums, cutoff)
+        output = pd.DataFrame(pairs, columns=['spill_in','spill_from'])
+        output['Pearson_R'] = r
+        output['P_value'] = p
         return output
 
-    def __UL_gating(self,x_ax,y_ax):
-        #describes an upper left corner gate
-        coords = [(0.0,0.7),(0.6,0.7),(0.9,1.0),(0.0,1.0),(0.0,0.7)]
-        gate = Path(coords, closed=True)
-        projection = np.array(self.FCS.data[[x_ax, y_ax]])
-        index = gate.contains_points(projection)
-        return index
+    def __accumulate_blocks(self, blocks, range, cutoff, bins=100):
+        """
+        Accumulates histogram counts, moments and the sums needed for the
+        compensation correlations over blocks of data, then exports histos,
+        PmtStats and comp_correlation to FCS
+        Counts and histograms are identical to the whole-file results
+        """
+        columns = None
+        for block in blocks:
+            if columns is None:
+                columns = block.columns
+                pairs = self.__reagent_pairs(columns)
+                edges = np.linspace(range[0], range[1], bins + 1)
+                counts = np.zeros((bins, len(columns)), dtype=np.int64)
+                sketch = Quantile_Sketch(len(columns))
+                bin_edges = edges
+                n = np.zeros(len(columns))
+                mean = np.zeros(len(columns))
+                M2 = np.zeros(len(columns))
+                cmin = np.repeat(np.inf, len(columns))
+                cmax = np.repeat(-np.inf, len(columns))
+                pair_sums = np.zeros((len(pairs), 6))  # n, sx, sy, sxx, syy, sxy
+            if len(block) == 0:
+                continue
+
+            block_counts, bin_edges = histogram_counts(block[columns].values, edges)
+            counts += block_counts
+            sketch.update(block[columns].values)
+            values = block[columns].values.astype(np.float64)
+
+            # merge block moments (Chan et al.)
+            n_b = len(values)
+            mean_b = values.mean(axis=0)
+            M2_b = ((values - mean_b)**2).sum(axis=0)
+            delta = mean_b - mean
+            M2 += M2_b + delta**2 * n * n_b / (n + n_b)
+            mean += delta * n_b / (n + n_b)
+            n += n_b
+            cmin = np.minimum(cmin, values.min(axis=0))
+            cmax = np.maximum(cmax, values.max(axis=0))
+
+            pair_sums += self.__pair_sums(block, pairs)
+
+        if columns is None:
+            raise ValueError("No event blocks to accumulate")
+
+        # density normalization as np.histogram(density=True)
+        density = counts / np.diff(bin_edges).astype(float).reshape(-1, 1) / counts.sum(axis=0)
+        self.FCS.histos = pd.DataFrame(density, columns=columns,
+                                       index=np.linspace(range[0], range[1], num=bins))
+
+        quartiles = sketch.quantiles()
+        stats = pd.DataFrame({'count': n, 'mean': mean, 'std': np.sqrt(M2 / (n - 1)),
+                              'min': cmin, '25%': quartiles[0], '50%': quartiles[1],
+                              '75%': quartiles[2], 'max': cmax}, index=columns,
+                             columns=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'])
+        self.FCS.PmtStats = self.__add_transform_counts(stats)
+
+        self.FCS.comp_correlation = self.__comp_corr_table(pairs, pair_sums, cutoff)
+
+    def __pearson_from_sums(self, sums, cutoff):
+        """
+        Pearson's R and two-sided p value (as scipy.stats.pearsonr) from the sums
+        [n, sx, sy, sxx, syy, sxy] <pairs x 6> of each gated population, NaN for
+        populations of cutoff events or less
+        """
+        n, sx, sy, sxx, syy, sxy = sums.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = (n*sxy - sx*sy) / np.sqrt((n*sxx - sx**2) * (n*syy - sy**2))
+            r = np.clip(r, -1.0, 1.0)
+            df = n - 2
+            t_squared = r**2 * (df / ((1.0 - r) * (1.0 + r)))
+            p = betainc(0.5*df, 0.5, df / (df + t_squared))
+        p[np.abs(r) == 1.0] = 0.0
+        r[n <= cutoff] = np.nan
+        p[n <= cutoff] = np.nan
+        return r, p
 
     def __make_TubeStats(self):
         """
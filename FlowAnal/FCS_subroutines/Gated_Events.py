@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Processed FCS events with gates that are composed as masks rather than applied
+
+Every gate of Process_FCS_Data (nan, limit, singlet, viable) narrows one boolean mask
+over the processed events, the events themselves are only copied when the gated dataframe
+is materialized (i.e. on access of FCS.data). Consumers that take a mask (histograms and
+stats, see Extract_HistoStats) read the events and mask directly
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import numpy as np
+import pandas as pd
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Gated_Events(object):
+    """
+    events - <pandas dataframe | Event_Store> all processed events
+
+    Accessible Parameters:
+        .events -- <pandas dataframe | Event_Store> all processed events (never copied or reordered)
+        .mask -- <bool array> events that pass every gate so far (None until the first gate)
+        .remain -- <list> of (gate name, number of events remaining after the gate)
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.mask = None
+        self.remain = []
+
+    def __len__(self):
+        """ Number of events that pass every gate """
+        if self.mask is None:
+            return len(self.events)
+        return int(np.count_nonzero(self.mask))
+
+    def gate(self, name, mask):
+        """
+        Narrows the selection by mask <bool array> given over all events or over the
+        currently selected events (i.e. a gate computed on select()), returns the
+        number of events remaining
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if len(mask) == len(self.events):
+            selected = mask.copy() if self.mask is None else self.mask & mask
+        elif self.mask is not None and len(mask) == len(self):
+            selected = self.mask.copy()
+            selected[selected] = mask
+        else:
+            raise ValueError("Gate {} has {} events, expected {} or {}".format(
+                name, len(mask), len(self.events), len(self)))
+        self.mask = selected
+        self.remain.append((name, len(self)))
+        log.debug("Gate {} leaves {} of {} events".format(name, self.remain[-1][1],
+                                                          len(self.events)))
+        return self.remain[-1][1]
+
+    def select(self, columns=None):
+        """ Returns a dataframe of the selected events on columns (only those are copied) """
+        events = self.events if columns is None else self.events[columns]
+        if self.mask is None:
+            return events
+        return events[self.mask]
+
+    def materialize(self):
+        """ Returns the dataframe (or Event_Store) of the selected events on all columns """
+        return self.select()
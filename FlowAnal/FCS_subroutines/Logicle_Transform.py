@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Provides a table driven logicle transformation
+
+The inverse biexponential table only depends on the logicle parameters (T, M, W, A)
+so it is built once per process and parameter set (see get_logicle_transform)
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+_transforms = {}    # Logicle_Transform objects keyed on (T, M, W, A)
+
+
+def get_logicle_transform(T=2**18, M=4.0, W=1, A=0):
+    """ Returns the (memoized) Logicle_Transform for parameters T, M, W, A """
+    key = (float(T), float(M), float(W), float(A))
+    if key not in _transforms:
+        _transforms[key] = Logicle_Transform(T=T, M=M, W=W, A=A)
+    return _transforms[key]
+
+
+class Logicle_Transform(object):
+    """
+    LOGICLE transform of flow data
+        T = top of scale data
+        M = total plot width in asymptotic decades
+        W = width of linearization
+        A = number of additional decades of negative data values
+
+    transform() maps data values to logicle scale by interpolating a precomputed table
+    of the inverse of the biexponential function, biexponential() maps logicle scale
+    values back to data values (i.e. for axis labelling)
+
+    This function references: Moore, W et al. "Update for the Logicle Data Scale Including
+    Operational Code Implementation" Cytometry Part A. 81A 273-277, 2012
+    """
+
+    def __init__(self, T=2**18, M=4.0, W=1, A=0):
+        self.T = float(T)
+
+        b = (M+A)*np.log(10)
+        w = np.float(W)/np.float(M+A)
+
+        d = _rtsafe(w, b)
+        if (d < 0) | (d > b):
+            raise NameError('d must satisfy 0 < d < b')
+
+        x2 = np.float(A)/np.float(M+A)
+        x1 = x2+w
+        x0 = x1+w
+
+        c_a = np.exp((b+d)*x0)
+        f_a = -np.exp(b*x1)+c_a*np.exp(-d*x1)
+        a = T/(np.exp(b)-c_a*np.exp(-d)+f_a)
+        self.__coef = (a, b, c_a*a, d, f_a*a)
+
+        # interpolation table, a linear range from -2**19 to zero and
+        # a log range from 0 to 2**18+10000
+        xn = np.linspace(-2**19, 0, 20000)
+        xp = np.logspace(0, np.log10(2**18+10000), 10000)
+        self.scale = np.concatenate([xn, xp])
+        self.values = self.biexponential(self.scale)
+
+    def biexponential(self, input_array):
+        """ Maps logicle scale values (in units of T) to data values """
+        a, b, c, d, f = self.__coef
+        input_array = np.asarray(input_array)/self.T
+        return (a*np.e**(b*input_array) - c*np.e**(-d*input_array)+f)
+
+    def transform(self, input_array, out=None):
+        """
+        Maps data values to logicle scale (in units of T), values outside of the
+        table are NaN
+
+        out - optional array (i.e. input_array itself for an in place transform) to
+              write the result to, it is filled column by column so that a float32 out
+              needs no temporary copy of the whole input
+        """
+        input_array = np.asarray(input_array)
+        if out is None:
+            out = np.empty(input_array.shape, dtype=np.float64)
+        if input_array.ndim == 1:
+            out[:] = self.__interp(input_array)
+        else:
+            for j in xrange(input_array.shape[1]):
+                out[:, j] = self.__interp(input_array[:, j])
+        return out
+
+    def __interp(self, x):
+        return np.interp(x, self.values, self.scale, left=np.nan, right=np.nan)
+
+
+def _rtsafe(w, b):
+    """
+    Modified from 'Numerical recipes: the art of scientific computing'
+    solves the following equation for d : w = 2ln(d/b) / (b+d)
+    where d = (0,b)
+    """
+
+    #the functions
+    def gFunction(d):                           #This defines the function we are 'rooting' for
+        return (w*(b+d) + 2*(np.log(d)-np.log(b)))
+    def derivFunction(d):                       #Derivative of g
+        return (w+2/d)
+
+    X_ACCURACY = 0.0000001
+    MAX_IT = 1000
+
+    lowerLimit = 0.0  #defines upper and lower limits where to find the roots
+    upperLimit = np.float(b)
+
+    if ((gFunction(lowerLimit)>0) & (gFunction(upperLimit)>0)) | ((gFunction(lowerLimit)<0) & (gFunction(upperLimit)<0)):
+        raise NameError('Root must be bracketed') # if the f(d) at both ends have the same sign, there is no root
+
+    if gFunction(lowerLimit)<0:
+        xLow = lowerLimit
+        xHigh = upperLimit
+    else:
+        xLow = upperLimit
+        xHigh = lowerLimit
+
+    root = np.float(lowerLimit + upperLimit)/2      #sets the intial guess for root at midpoint
+    dxOld = np.abs(upperLimit - lowerLimit)    #differenance from previous guess
+    dx = dxOld                              #no reason - define dx just in case
+    g = gFunction(root)                     #intitial function value at root_0
+    dg = derivFunction(root)                #intial derivative value at root_0
+
+    for i in range(0,MAX_IT):
+        if (((root-xHigh)*dg-g)*((root-xLow)*dg-g) > 0)|(abs(2*g) > abs(dxOld*dg)):
+            #Bisect method
+            dxOld = dx
+            dx = (xHigh-xLow)/2
+            root = xLow + dx
+        else:
+            #Newton method
+            dxOld = dx
+            dx = g/dg
+            root = root - dx
+
+        if (abs(dx) < X_ACCURACY):
+            return root #stop condition and return root
+
+        g = gFunction(root)         #reinitialize g to new root
+        dg = derivFunction(root)    #reinitialize dg to new derivative
+
+        if g < 0: #move the xLow or xHigh to the new search area
+            xLow = root
+        else:
+            xHigh = root
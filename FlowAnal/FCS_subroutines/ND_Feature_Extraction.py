@@ -17,16 +17,19 @@ __status__ = "Production"
 import pandas as pd
 import numpy as np
 import scipy as sp
+import scipy.sparse
 import h5py
 """Built in packages"""
 import os.path
 import logging
+"""Internal packages"""
+from Cell_Dictionary import Cell_Dictionary
 
 log = logging.getLogger(__name__)
 
 class ND_Feature_Extraction(object):
 
-    def __init__(self,FCS,bins,**kwargs):
+    def __init__(self,FCS,bins,blocks=None,**kwargs):
         """ Performs N-Dimenstional Feature Extration on FCS.data
         
         This class takes a data FCS object which as been compensated and
@@ -46,42 +49,95 @@ class ND_Feature_Extraction(object):
         Accessiable Functions:
             .Return_Coordinates -- Returns the bin centroid for a given index
                                    or bin number (I think...)
+
+        blocks -- optional iterable of processed dataframes (see FCS.comp_scale_FCS_blocks)
+                  whose histograms are accumulated in place of FCS.data
+        cell_dictionary -- optional <Cell_Dictionary> shared by the tubes of a cohort, if
+                           given (type 'Sparse') the histogram is indexed on the compact
+                           cell ids of the dictionary rather than on bin_number
         """
-        self.type = 'Full'
+        self.cell_dictionary = kwargs.get('cell_dictionary', None)
+        self.type = 'Full' if self.cell_dictionary is None else 'Sparse'
         if 'exclude_param' in kwargs:
             exclude = kwargs['exclude_param']
         else:
             exclude = ['FSC-H','SSC-A','Time']
-        #generate list of columns to be used
-        columns = [c for c in FCS.data.columns if c not in exclude]
-        #generate a dictionary describing the bins to be used
-        bin_dict = self._Generate_Bin_Dict(columns,bins)
-        self.bin_description = bin_dict
-        #bin the data so that coordinates are generated for every data point in FCS.data
-        vector_length,coordinates = self._Uniform_Bin_Data(input_data = FCS.data, bin_dict = bin_dict)
-
-        #generate a sparse array of from the given coordinates
-        self.histogram = self._coord2sparse_histogram(vector_length,
-                                                      coordinates,
-                                                      **kwargs).tocsr()
+        if blocks is None:
+            blocks = [FCS.data]
+
+        bin_dict = None
+        histogram = None
+        n_events = 0
+        for block in blocks:
+            if bin_dict is None:
+                #generate list of columns to be used
+                columns = [c for c in block.columns if c not in exclude]
+                #generate a dictionary describing the bins to be used
+                bin_dict = self._Generate_Bin_Dict(columns,bins)
+                self.bin_description = bin_dict
+                if self.cell_dictionary is not None:
+                    self.cell_dictionary.set_bin_description(bin_dict)
+            if len(block) == 0:
+                continue
+            if self.cell_dictionary is None:
+                #bin the data so that coordinates are generated for every data point in the block
+                vector_length,coordinates = self._Uniform_Bin_Data(input_data = block, bin_dict = bin_dict)
+
+                #generate a sparse array of counts from the given coordinates
+                counts = self._coord2sparse_histogram(vector_length, coordinates,
+                                                      normalize=False).tocsr()
+            else:
+                coordinates = self._Bin_Coordinates(input_data = block, bin_dict = bin_dict)
+                counts = self._cells2sparse_histogram(coordinates)
+            histogram = counts if histogram is None else histogram + counts
+            n_events += len(coordinates)
+
+        if histogram is None:
+            raise ValueError("FCS data is empty!")
+        if kwargs.get('normalize', True):
+            histogram = histogram / n_events
+        self.histogram = histogram.tocsr()
 
     def _coord2sparse_histogram(self,vector_length,coordinates,normalize=True,**kwargs):
         """
         generates a sparse matrix with normalized histogram counts
         each bin describes the fraction of total events within it (i.e. < 1)
         """
-        output=sp.sparse.lil_matrix((1,vector_length), dtype=np.float32)
-        
-        for i in coordinates:
-            output[0,i]+=1
+        cells, counts = np.unique(np.asarray(coordinates, dtype=np.int64), return_counts=True)
+        output = sp.sparse.csr_matrix((counts.astype(np.float32), cells, [0, len(cells)]),
+                                      shape=(1, vector_length))
         if normalize:
             return output/ len(coordinates)
         else:
             return output
 
+    def _cells2sparse_histogram(self,coordinates):
+        """
+        generates a sparse matrix of counts indexed on the cell ids of self.cell_dictionary
+        (new cells are added to the dictionary)
+        """
+        ids, counts = self.cell_dictionary.lookup(coordinates)
+        order = np.argsort(ids)
+        return sp.sparse.csr_matrix((counts[order].astype(np.float32), ids[order],
+                                     [0, len(ids)]),
+                                    shape=(1, self.cell_dictionary.capacity))
+
+    def _Bin_Coordinates(self,input_data,bin_dict):
+        """
+        returns the bin number of every event on every channel <n x channels uint16 array>
+        (binned as in _Uniform_Bin_Data)
+        """
+        output = np.empty((len(input_data), len(bin_dict)), dtype=np.uint16)
+        for j, key in enumerate(bin_dict.index.values):
+            rounded = np.floor(np.asarray(input_data[key]) * int(bin_dict[key]))
+            np.clip(rounded, 0, bin_dict[key] - 1, out=rounded)
+            output[:, j] = rounded
+        return output
+
     def _Uniform_Bin_Data(self,input_data,bin_dict):
         """
         fits event parameters to an integer 'binned' value
+        values are clipped to the bins so that 1.0 falls in the last bin
         """
         basis = [1]         #intialize a list of basis values
         for i in bin_dict.values:
@@ -90,19 +146,19 @@ class ND_Feature_Extraction(object):
             # logic and algorithm from Donald Kunth's Art of Computer Programming Vol 1
 
         vector_length = basis.pop()         # this is the highest coordinate value (max length of array)
-        basis = pd.Series(data=basis,index = bin_dict.index.values)
-        rounded = input_data.copy()                 # copy input_data since we will soon operate on it.
-        for key in bin_dict.index.values:
-            rounded[key] = np.floor(rounded[key]*bin_dict[key]) # iterate and round over every column
-        output = rounded[bin_dict.index.values].dot(basis) # apply dot product to multiply columns
-                                                            # by basis vector (see Kunth)
-        log.debug("Vector Length: {}, \nRounded: {}, \nBasis: {}, \
-                   \nCoordinates: {}".format(vector_length,rounded,basis,output))
         if len(input_data) == 0:
             raise ValueError("FCS data is empty!")
-        if len(output) == 0:
-            raise ValueError("Coordinate Data is empty!")      
-        return vector_length, output.apply(np.int64)
+
+        output = np.zeros(len(input_data), dtype=np.int64)
+        for key, base in zip(bin_dict.index.values, basis):
+            # column * bins is evaluated in the precision of the column (i.e. float32)
+            rounded = np.floor(np.asarray(input_data[key]) * int(bin_dict[key])).astype(np.int64)
+            np.clip(rounded, 0, bin_dict[key] - 1, out=rounded)
+            rounded *= base
+            output += rounded       # mixed radix coordinate (see Kunth)
+        log.debug("Vector Length: {}, \nBasis: {}, \nCoordinates: {}".format(vector_length,
+                                                                            basis, output))
+        return vector_length, output
 
     def _Generate_Bin_Dict(self,columns,bins):
         """
@@ -132,6 +188,11 @@ class ND_Feature_Extraction(object):
             index = [index] # make sure index is a list
 
         coords = self.histogram.indices[index]
+        if self.cell_dictionary is not None:
+            temp = self.cell_dictionary.coordinates(coords) / \
+                np.array(self.bin_description, dtype=np.float32)[np.newaxis]
+            return pd.DataFrame(temp,index=coords,columns=self.bin_description.index.values)
+
         self.x = np.array(np.unravel_index(coords,list(self.bin_description)),dtype=np.float32).T
         temp = self.x / np.array(self.bin_description)[np.newaxis]
 
@@ -13,22 +13,56 @@ __maintainer__ = "David Ng"
 __email__ = "ngdavid@uw.edu"
 __status__ = "Production"
 
+import os
 import pandas as pd
 import numpy as np
-from scipy.interpolate import interp1d
-from matplotlib.path import Path
 from Auto_Comp_Tweak import Auto_Comp_Tweak
+from Compiled_Gate import compile_gate
+from Logicle_Transform import get_logicle_transform
 from Auto_Singlet import GMM_doublet_detection
+from Gated_Events import Gated_Events
+from Event_Store import Event_Store
 
 import logging
 log = logging.getLogger(__name__)
 
+# process wide caches (see load_spectral_library and Process_FCS_Data._load_overlap_matrix)
+_spectral_libraries = {}    # parsed libraries keyed on (filepath, mtime)
+_comp_matrices = {}         # (overlap_matrix, comp_matrix) keyed on library, cytometer,
+                            # channels, loaded columns and strict
+
+
+def load_spectral_library(spectral_overlap_file):
+    """
+    Returns the parsed spectral overlap library <pandas dataframe>, memoized on the
+    path and modification time of the file
+    """
+    key = (os.path.abspath(spectral_overlap_file), os.path.getmtime(spectral_overlap_file))
+    if key not in _spectral_libraries:
+        _spectral_libraries[key] = pd.read_table(spectral_overlap_file, comment='#', sep='\t',
+                                                 header=0, index_col=0).dropna(axis=0, how='all')
+    return _spectral_libraries[key]
+
+
+def warm_compensation_cache(compensation_file):
+    """
+    Loads the spectral overlap libraries of compensation_file (str or dictionary keyed
+    on cytometer) into the process wide cache, i.e. as initializer of worker processes
+    """
+    if isinstance(compensation_file, dict):
+        files = set(compensation_file.values())
+    else:
+        files = [compensation_file]
+    for spectral_overlap_file in files:
+        load_spectral_library(spectral_overlap_file)
+
 
 class Process_FCS_Data(object):
     """
     This class will compensate and scale data from an .fcs file given an FCSobject and
     spillover library
-    Stores a pandas dataframe in data
+    Stores a pandas dataframe in data (as Gated_Events, the gates are composed as one mask
+    and the gated dataframe is only made when FCS.data is accessed)
     Also stores the export_time, cytometer_name, cytometer_num, comp_matrix and tube_name
 
     rescale_lim - tuple (max,min) for the channels
@@ -39,7 +73,8 @@ class Process_FCS_Data(object):
 
     def __init__(self, FCS, compensation_file, saturation_upper_range=1000,
                  rescale_lim=(-0.15, 1), strict=True, comp_flag = "table",
-                 singlet_flag = "fixed", viable_flag = "fixed", **kwargs):
+                 singlet_flag = "fixed", viable_flag = "fixed", engine = "pandas",
+                 event_store = False, **kwargs):
         """
         Takes an FCS_object, and a spillover library. \n
         Can handle a spillover library as dictionary if keyed on the machine
@@ -49,33 +84,52 @@ class Process_FCS_Data(object):
                             parameter is undefined, then error out) and False
                             (if channel parameter is undefined, goto default FL__)
         auto_comp - <bool> - default False, applies auto compensation tweaking
+        engine - "pandas" (default) or "fast", the fast engine compensates, transforms,
+                 gates and rescales one float32 array in place (peak memory ~2x the raw
+                 data) with identical results
+        event_store - <bool> - default False, FCS.data is an Event_Store (float32 array
+                      and channel map) rather than a dataframe (the fast engine never
+                      makes a dataframe)
         """
         self.strict = strict
         self.FCS = FCS
 
         # save columns because data is redfined after comp
-        self.columns = self.__Clean_up_columns(self.FCS.parameters.loc['Channel_Name'])
+        self.channels = self.__Clean_up_columns(self.FCS.parameters.loc['Channel_Name'])
+        if hasattr(self.FCS.data, 'columns'):  # data might be loaded for a subset of channels
+            self.columns = self.__Clean_up_columns(self.FCS.data.columns)
+        else:
+            self.columns = list(self.channels)
         self.FCS.total_events = self.FCS.data.shape[0]      # initial number of events before gating
 
         self.overlap_matrix = self._load_overlap_matrix(compensation_file)   # load compensation matrix
-        self.__compensation_switch(comp_mode=comp_flag,**kwargs)
-        
-        #Saturation Gate might need to go here
-        #sat_gate = self._SaturationGate()
+        if engine == "fast":
+            self.__fast_engine(comp_mode=comp_flag, rescale_lim=rescale_lim,
+                               event_store=event_store, **kwargs)
+        elif engine == "pandas":
+            self.__compensation_switch(comp_mode=comp_flag,**kwargs)
 
-        self.data = self._LogicleRescale(self.data, T=2**18, M=4, W=0.5, A=0)
-        self.FCS.data = self.data  # update FCS.data
+            #Saturation Gate might need to go here
+            #sat_gate = self._SaturationGate()
 
-        nan_mask = self.__nan_gate(self.data)
-        self.data = self.data[nan_mask]
+            self.data = self._LogicleRescale(self.data, T=2**18, M=4, W=0.5, A=0)
+            self.FCS.data = self.data  # update FCS.data
 
-        limit_mask = self.__limit_gate(self.data, high=rescale_lim[1], low=rescale_lim[0])
-        self.data = self.data[limit_mask] #this might duplicate the saturation_gate
+            # gates only narrow the mask of self.gated, self.data keeps all events
+            self.gated = Gated_Events(self.data)
+            self.gated.gate('nan', self.__nan_gate(self.data))
+            limit_mask = self.__limit_gate(self.data, high=rescale_lim[1], low=rescale_lim[0],
+                                           selected=self.gated.mask)
+            self.gated.gate('limit', limit_mask) #this might duplicate the saturation_gate
 
-        self.__Rescale(high=rescale_lim[0], low=rescale_lim[1])  # Edits self.data
+            self.__Rescale(high=rescale_lim[0], low=rescale_lim[1])  # Edits self.data
 
-        self.__patch() # flips axis so that things display correctly
-        self.FCS.data = self.data  # update FCS.data
+            self.__patch() # flips axis so that things display correctly
+        else:
+            raise ValueError("Engine {} is Undefined".format(engine))
+        if event_store and not isinstance(self.gated.events, Event_Store):
+            self.gated.events = Event_Store.from_dataframe(self.gated.events)
+        self.FCS.data = self.gated  # update FCS.data (made from the gate mask on access)
         
         if 'gate_coords' in kwargs:   # if gate coord dictionary provided, do initial cleanup
             self.coords = kwargs['gate_coords']
@@ -83,8 +137,7 @@ class Process_FCS_Data(object):
             self.coords = None
         self.__singlet_switch(singlet_mode=singlet_flag,**kwargs)
         self.__viable_switch(viable_mode=viable_flag,**kwargs)
-            
-        self.FCS.data = self.data  # update FCS.data
+
         del self.data
         
     def __compensation_switch(self,comp_mode,**kwargs):
@@ -94,10 +147,10 @@ class Process_FCS_Data(object):
         elif comp_mode.lower() == "auto":
             Tweaked = Auto_Comp_Tweak(self)
             self.comp_matrix = Tweaked.comp_matrix
-            self.data = Tweaked.data
-            #data is not compensated at this point!
+            #table compensation adjusted by the residual spillover fitted on the data
+            self.data = np.dot(self.FCS.data, self.comp_matrix)
         elif comp_mode.lower() == "table":
-            self.comp_matrix = self._make_comp_matrix(self.overlap_matrix)
+            self.comp_matrix = self.__table_comp_matrix()
             #simple inversion of the overlap matrix
             self.data = np.dot(self.FCS.data, self.comp_matrix)   # apply compensation (returns a numpy array)
         else:
@@ -107,37 +160,125 @@ class Process_FCS_Data(object):
                                  dtype=np.float32)  # create a dataframe with columns
 
             
+    def __fast_engine(self, comp_mode, rescale_lim, chunk_size=2**16, event_store=False,
+                      **kwargs):
+        """
+        Same steps as the pandas engine (compensation, logicle rescale, nan gate,
+        limit gate, __Rescale and __patch) applied in place to one float32 array,
+        self.data is only made a dataframe (or an Event_Store on the array) at the end
+        """
+        if comp_mode is not None and comp_mode.lower() in ["table", "auto"]:
+            if comp_mode.lower() == "auto":
+                self.comp_matrix = Auto_Comp_Tweak(self).comp_matrix
+            else:
+                self.comp_matrix = self.__table_comp_matrix()
+            raw = np.asarray(self.FCS.data)
+            X = np.empty(raw.shape, dtype=np.float32)
+            for i in xrange(0, raw.shape[0], chunk_size):   # float64 temporaries per chunk only
+                X[i:i+chunk_size] = np.dot(raw[i:i+chunk_size], self.comp_matrix)
+            del raw
+        else:
+            self.__compensation_switch(comp_mode=comp_mode, **kwargs)
+            X = np.array(self.data.values, dtype=np.float32)
+            del self.data
+        self.FCS.data = X  # release the raw data
+
+        columns = list(self.columns)
+        scatter = ['FSC-A', 'FSC-H', 'SSC-A', 'SSC-H']
+        lin = [c for c in ['FSC-A', 'FSC-H'] if c in columns]
+        if 'log_param' in kwargs:
+            log_param = kwargs.get('log_param')
+        else:
+            log_param = [c for c in columns if c not in lin + ['Time']]
+        transform = get_logicle_transform(T=2**18, M=4, W=0.5, A=0)
+        for j, c in enumerate(columns):
+            if c in log_param:
+                transform.transform(X[:, j], out=X[:, j])
+            if c in log_param or c in lin:
+                X[:, j] /= np.float32(2**18)
+
+        # nan gate
+        not_nan = ~np.isnan(X)
+        n_not_nan = pd.Series(not_nan.sum(axis=0), index=columns)
+        n_not_nan.name = 'transform_not_nan'
+        self.FCS.n_transform_not_nan_by_channel = n_not_nan
+        nan_mask = not_nan.all(axis=1)
+        self.FCS.n_transform_not_nan_all = np.sum(nan_mask)
+        del not_nan
+
+        # limit gate (counted over the events that pass the nan gate)
+        low, high = rescale_lim
+        gated = [c for c in columns if c != 'Time']
+        mask = np.ones(X.shape[0], dtype=bool)
+        n_keep = []
+        with np.errstate(invalid='ignore'):
+            for c in gated:
+                x = X[:, columns.index(c)]
+                if c in scatter:
+                    keep = (x <= 1) & (x >= 0)
+                else:
+                    keep = (x <= high) & (x >= low)
+                n_keep.append(np.sum(keep & nan_mask))
+                mask &= keep
+        n_keep = pd.Series(n_keep, index=gated)
+        n_keep.name = 'transform_in_limits'
+        self.FCS.n_transform_keep_by_channel = n_keep
+        self.FCS.n_transform_keep_all = np.sum(mask & nan_mask)
+
+        # __Rescale (with its swapped limits) and __patch, on all events
+        for j, c in enumerate(columns):
+            if c not in scatter + ['Time']:
+                x = X[:, j]
+                x -= high
+                x /= (low - high)
+                np.subtract(1, x, out=x)
+
+        if event_store:
+            self.data = Event_Store(X, self.columns)
+        else:
+            self.data = pd.DataFrame(X, columns=self.columns, copy=False)
+        self.gated = Gated_Events(self.data)
+        self.gated.gate('nan', nan_mask)
+        self.gated.gate('limit', mask)
+
     def __singlet_switch(self,singlet_mode,**kwargs):
         """defines singlet gating modes"""
         if singlet_mode == None:
-            self.FCS.singlet_remain = self.FCS.data.shape[0]
+            self.FCS.singlet_remain = len(self.gated)
         elif singlet_mode.lower() == "auto":
             auto_gate_obj = self.__auto_singlet_gating(**kwargs)
-            singlet_mask = auto_gate_obj.singlet_mask
             self.FCS.singlet_remain,percent_loss = auto_gate_obj.calculate_stats()
-            self.data = self.data[singlet_mask]
+            if auto_gate_obj.agreement is not None:
+                self.FCS.singlet_agreement = auto_gate_obj.agreement
+            self.gated.gate('singlet', auto_gate_obj.singlet_mask)
         elif singlet_mode.lower() == "fixed" and 'gate_coords' in kwargs:
-            singlet_mask = self._gating(self.data, 'FSC-A', 'FSC-H', self.coords['singlet'])
-            self.FCS.singlet_remain = np.sum(singlet_mask)
-            self.data = self.data[singlet_mask]
+            singlet_mask = self._gating(self.gated.select(['FSC-A', 'FSC-H']), 'FSC-A', 'FSC-H',
+                                        self.coords['singlet'])
+            self.FCS.singlet_remain = self.gated.gate('singlet', singlet_mask)
         else:
             raise(ValueError,"Singlet Mode: {} is Undefined".format(singlet_mode))        
 
     def __viable_switch(self,viable_mode,**kwargs):
         """defines viable gating modes"""
         if viable_mode == None:
-            self.FCS.viable_remain = self.FCS.data.shape[0]              
+            self.FCS.viable_remain = len(self.gated)
         elif viable_mode.lower() == "auto":
             raise(NotImplementedError,"Auto Viability Gating has not been implemented")
         elif viable_mode.lower() == "fixed" and 'gate_coords' in kwargs:
-            viable_mask = self._gating(self.data, 'SSC-H', 'FSC-H', self.coords['viable'])
-            self.FCS.viable_remain = np.sum(viable_mask)
-            self.data = self.data[viable_mask]
+            viable_mask = self._gating(self.gated.select(['SSC-H', 'FSC-H']), 'SSC-H', 'FSC-H',
+                                       self.coords['viable'])
+            self.FCS.viable_remain = self.gated.gate('viable', viable_mask)
         else:
             raise(ValueError,"Viablity Mode: {} is Undefined".format(viable_mode))        
 
     def __auto_singlet_gating(self,**kwargs):
-        return GMM_doublet_detection(data=self.data,
+        # cytnum/date of the file (kwargs may hold query filters of the same name)
+        kwargs['cytnum'] = getattr(self.FCS, 'cytnum', None)
+        kwargs['date'] = getattr(self.FCS, 'date', None)
+        data = self.gated.select(['FSC-A', 'FSC-H'])
+        if isinstance(data, Event_Store):
+            data = data.to_dataframe()
+        return GMM_doublet_detection(data=data,
                                      filename=self.FCS.filename,
                                      **kwargs)
         
@@ -179,11 +320,12 @@ class Process_FCS_Data(object):
 
         return mask
 
-    def __limit_gate(self, X_input, high, low):
+    def __limit_gate(self, X_input, high, low, selected=None):
         """
         limits X_input to all events between 0 and 1
+        (events are tallied over the selected <bool array> events only)
         """
-        tmp = X_input.drop(['Time'], axis=1).copy()
+        tmp = X_input.drop([c for c in ['Time'] if c in X_input.columns], axis=1).copy()
         reagents = [x for x in tmp.columns.values
                     if x not in ['FSC-A', 'FSC-H', 'SSC-A', 'SSC-H']]
 
@@ -194,13 +336,14 @@ class Process_FCS_Data(object):
                 tmp[col] = (tmp[col] <= 1) & (tmp[col] >= 0)
 
         # Tally and record number of cells that are inside of limits
-        n_transform_keep = tmp.apply(lambda x: np.sum(x), axis=0)
+        tally = tmp if selected is None else tmp[selected]
+        n_transform_keep = tally.apply(lambda x: np.sum(x), axis=0)
         n_transform_keep.name = 'transform_in_limits'
         self.FCS.n_transform_keep_by_channel = n_transform_keep
 
         # True if all true (Not sure if this is fastest)
         mask = np.prod(tmp, axis=1).astype(bool)
-        self.FCS.n_transform_keep_all = np.sum(mask)
+        self.FCS.n_transform_keep_all = np.sum(mask if selected is None else mask & selected)
 
         return mask
 
@@ -209,6 +352,8 @@ class Process_FCS_Data(object):
         Loads the the spectral overlap library and returns spectral overlap matrix
         Pass compensation_file as a dictionary if there are different spectral
         overlap libaries for difference cytometers
+        Overlap (and compensation) matrices are cached per process for each library,
+        cytometer, column layout and strict setting
         """
         columns = list(self.columns)
         if isinstance(compensation_file, str):
@@ -217,12 +362,24 @@ class Process_FCS_Data(object):
             if self.FCS.cytnum in compensation_file.keys():
                 spectral_overlap_file = compensation_file[self.FCS.cytnum]
             else:
-                raise ValueError('Cytometer ' + self.cytnum +
-                                 'is not seen in the compensation dictionary')
+                raise ValueError('Cytometer ' + str(self.FCS.cytnum) +
+                                 ' is not seen in the compensation dictionary')
         else:
             raise TypeError('Provided compensation_file is not of type str or dict')
-        spectral_overlap_library = pd.read_table(spectral_overlap_file, comment='#', sep='\t',
-                                                 header=0, index_col=0).dropna(axis=0, how='all')
+
+        not_loaded = [c for c in self.channels if c not in self.columns and
+                      c not in ['FSC-A', 'FSC-H', 'SSC-A', 'SSC-H', 'Time']]
+        if not_loaded:
+            log.warning('Compensation is restricted to the loaded channels, spillover from '
+                        '{} is ignored'.format(not_loaded))
+
+        self.__matrix_key = (os.path.abspath(spectral_overlap_file),
+                             os.path.getmtime(spectral_overlap_file), self.FCS.cytnum,
+                             tuple(self.channels), tuple(self.columns), self.strict)
+        if self.__matrix_key in _comp_matrices:
+            return _comp_matrices[self.__matrix_key][0]
+
+        spectral_overlap_library = load_spectral_library(spectral_overlap_file)
         Undescribed = set(columns)-set(spectral_overlap_library.columns)
         if Undescribed:
             if self.strict:  # if strict == true, then error out with Undescrbied antigens
@@ -232,12 +389,26 @@ class Process_FCS_Data(object):
                             'FL04', 'FL05', 'FL06', 'FL07', 'FL08', 'FL09', 'FL10', 'Time']
                 for ukn in Undescribed:
                     i = columns.index(ukn)
-                    columns[i] = Defaults[i]
+                    columns[i] = Defaults[self.channels.index(ukn)]  # default by file position
         else:
             pass    # Undescribed is an empty set and we can use columns directly
 
         overlap_matrix = spectral_overlap_library[columns].values   # create a matrix from columns
-        return overlap_matrix.T
+        if self.columns != self.channels:  # library rows are detectors, keep the loaded ones
+            overlap_matrix = overlap_matrix[[self.channels.index(c) for c in self.columns], :]
+        overlap_matrix = overlap_matrix.T
+        overlap_matrix.flags.writeable = False  # shared between files
+        _comp_matrices[self.__matrix_key] = (overlap_matrix, None)
+        return overlap_matrix
+
+    def __table_comp_matrix(self):
+        """ Cached inverse of the (unmodified) spectral overlap matrix """
+        overlap_matrix, comp_matrix = _comp_matrices[self.__matrix_key]
+        if comp_matrix is None:
+            comp_matrix = self._make_comp_matrix(overlap_matrix)
+            comp_matrix.flags.writeable = False
+            _comp_matrices[self.__matrix_key] = (overlap_matrix, comp_matrix)
+        return comp_matrix
 
     def _make_comp_matrix(self, overlap_matrix):
         """
@@ -274,9 +445,9 @@ class Process_FCS_Data(object):
         Returns a logical index given set of gate coordinates
         """
         log.debug('Applying gate coords {} to axes {} and {}'.format(coords, x_ax, y_ax))
-        gate = Path(coords, closed=True)
+        gate = compile_gate(coords)
         projection = np.array(DF_array_data[[x_ax, y_ax]])
-        index = gate.contains_points(projection)
+        index = gate.contains(projection)
         return index
 
     def _LogicleRescale(self, X_input, lin=['FSC-A', 'FSC-H'],
@@ -287,123 +458,26 @@ class Process_FCS_Data(object):
         Operates pass-by-reference (i.e. in place)
         *log_param = passes parameters to be logicle transformed
         """
+        lin = [x for x in lin if x in X_input.columns]
         if 'log_param' in kwargs:
             log = kwargs.get("log_param")
         else:
             log = [x for x in X_input.columns.values if x not in lin + ['Time']]
         output = X_input.copy()
-        output[log] = self.__LogicleTransform(X_input[log].values, T, M, W, A)/np.float(2**18) #logicle transform and rescaling
+        values = np.array(X_input[log].values, dtype=np.float32)
+        self.__LogicleTransform(values, T, M, W, A, out=values)
+        values /= np.float32(2**18)
+        output[log] = values #logicle transform and rescaling
         output[lin] = X_input[lin].values/np.float(2**18) #rescale forward scatter linear
 
         return output
 
-    def __LogicleTransform(self, input_array, T=2**18, M=4.0, W=1, A=1.0):
+    def __LogicleTransform(self, input_array, T=2**18, M=4.0, W=1, A=1.0, out=None):
         """
         interpolated inverse of the biexponential function
-
-        ul = np.log10(2**18+10000)
-        x = np.logspace(0, ul, 10000)
-        x = x[::-1] - 400000
-        # x = np.arange(-200000, 2**18+10000, 50)
+        (the interpolation table is shared by all calls with the same T, M, W, A)
         """
-        xn = np.linspace(-2**19, 0, 20000)
-        #set up a linear range from -2**19 to zero
-        xp = np.logspace(0, np.log10(2**18+10000), 10000)
-        #set up a log range from 0 to 2**18+10000
-        x = np.concatenate([xn, xp])
-        y = self.__BiexponentialFunction(x, T, M, W, A)
-        output = interp1d(y.T, x.T, bounds_error=False, fill_value=np.nan)
-        return output(input_array)  # NOTE: This fails if values fall outside the defined range
-
-    def __rtsafe(self, w, b):
-        """
-        Modified from 'Numerical recipes: the art of scientific computing'
-        solves the following equation for d : w = 2ln(d/b) / (b+d)
-        where d = (0,b)
-        """
-
-        #the functions
-        def gFunction(d):                           #This defines the function we are 'rooting' for
-            return (w*(b+d) + 2*(np.log(d)-np.log(b)))
-        def derivFunction(d):                       #Derivative of g
-            return (w+2/d)
-
-        X_ACCURACY = 0.0000001
-        MAX_IT = 1000
-
-        lowerLimit = 0.0  #defines upper and lower limits where to find the roots
-        upperLimit = np.float(b)
-
-        if ((gFunction(lowerLimit)>0) & (gFunction(upperLimit)>0)) | ((gFunction(lowerLimit)<0) & (gFunction(upperLimit)<0)):
-            raise NameError('Root must be bracketed') # if the f(d) at both ends have the same sign, there is no root
-
-        if gFunction(lowerLimit)<0:
-            xLow = lowerLimit
-            xHigh = upperLimit
-        else:
-            xLow = upperLimit
-            xHigh = lowerLimit
-
-        root = np.float(lowerLimit + upperLimit)/2      #sets the intial guess for root at midpoint
-        dxOld = np.abs(upperLimit - lowerLimit)    #differenance from previous guess
-        dx = dxOld                              #no reason - define dx just in case
-        g = gFunction(root)                     #intitial function value at root_0
-        dg = derivFunction(root)                #intial derivative value at root_0
-
-        for i in range(0,MAX_IT):
-            if (((root-xHigh)*dg-g)*((root-xLow)*dg-g) > 0)|(abs(2*g) > abs(dxOld*dg)):
-                #Bisect method
-                dxOld = dx
-                dx = (xHigh-xLow)/2
-                root = xLow + dx
-            else:
-                #Newton method
-                dxOld = dx
-                dx = g/dg
-                root = root - dx
-
-            if (abs(dx) < X_ACCURACY):
-                return root #stop condition and return root
-
-            g = gFunction(root)         #reinitialize g to new root
-            dg = derivFunction(root)    #reinitialize dg to new derivative
-
-            if g < 0: #move the xLow or xHigh to the new search area
-                xLow = root
-            else:
-                xHigh = root
-
-    def __BiexponentialFunction(self, input_array, T, M, W, A):
-        """
-        LOGICLE performs logicle transform of flow data
-            T = top of scale data
-            M = total plot width in asymptotic decades
-            W = width of linearization                              = 3
-           A = number of additional decades of negative data values =0
-
-        This function references: Moore, W et al. "Update for the Logicle Data Scale Including
-        Operational Code Implementation" Cytometry Part A. 81A 273-277, 2012
-        """
-        input_array = input_array/float(T)
-
-        b = (M+A)*np.log(10)
-        w = np.float(W)/np.float(M+A)
-
-        d = self.__rtsafe(w, b)
-        if (d < 0) | (d > b):
-            raise NameError('d must satisfy 0 < d < b')
-
-        x2 = np.float(A)/np.float(M+A)
-        x1 = x2+w
-        x0 = x1+w
-
-        c_a = np.exp((b+d)*x0)
-        f_a = -np.exp(b*x1)+c_a*np.exp(-d*x1)
-        a = T/(np.exp(b)-c_a*np.exp(-d)+f_a)
-        f = f_a*a
-        c = c_a*a
-
-        return (a*np.e**(b*input_array) - c*np.e**(-d*input_array)+f)
+        return get_logicle_transform(T, M, W, A).transform(input_array, out=out)
 
     def __patch(self):
         """
@@ -416,6 +490,60 @@ class Process_FCS_Data(object):
         #print self.data[mask]
         self.data[mask] = 1-self.data[mask]
 
+class Process_FCS_Blocks(object):
+    """
+    Applies Process_FCS_Data to an iterable of raw event blocks (see FCS.iter_events)
+    Iterating over this object yields processed <pandas dataframe> blocks. Once
+    exhausted FCS carries the same event counters as a whole-file
+    Process_FCS_Data (total_events, n_transform_*, singlet_remain, viable_remain)
+
+    Gating and compensation modes that are fitted to the data ('auto') are not
+    supported since they can not be reproduced block by block
+    """
+
+    counters = ['total_events', 'n_transform_not_nan_all', 'n_transform_keep_all',
+                'n_transform_not_nan_by_channel', 'n_transform_keep_by_channel',
+                'singlet_remain', 'viable_remain']
+
+    def __init__(self, FCS, blocks, compensation_file, comp_flag="table",
+                 singlet_flag="fixed", viable_flag="fixed", **kwargs):
+        for flag in [comp_flag, singlet_flag, viable_flag]:
+            if flag is not None and flag.lower() == "auto":
+                raise NotImplementedError("'auto' modes can not be applied to event blocks")
+
+        self.FCS = FCS
+        self.blocks = blocks
+        self.kwargs = dict(kwargs, compensation_file=compensation_file, comp_flag=comp_flag,
+                           singlet_flag=singlet_flag, viable_flag=viable_flag)
+
+    def __iter__(self):
+        for counter in self.counters:
+            setattr(self.FCS, counter, 0)
+
+        for block in self.blocks:
+            block_FCS = _Event_Block(self.FCS, block)
+            Process_FCS_Data(FCS=block_FCS, **self.kwargs)
+            for counter in self.counters:
+                total = getattr(self.FCS, counter)
+                value = getattr(block_FCS, counter)
+                if isinstance(value, pd.Series) and not isinstance(total, pd.Series):
+                    total = value
+                else:
+                    total = total + value
+                setattr(self.FCS, counter, total)
+            yield block_FCS.data.materialize()
+
+
+class _Event_Block(object):
+    """ Stand-in FCS object carrying the meta information of FCS and one block of data """
+
+    def __init__(self, FCS, data):
+        for attr in ['parameters', 'cytometer', 'cytnum', 'filename', 'case_tube']:
+            if hasattr(FCS, attr):
+                setattr(self, attr, getattr(FCS, attr))
+        self.data = data
+
+
 if __name__ == "__main__":
     import os
     import sys
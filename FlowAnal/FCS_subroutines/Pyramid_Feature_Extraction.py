@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+This file describes a feature extraction class that bins FCS.data once at a fine
+resolution and derives ND and 2D histograms at several coarser resolutions from it
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import itertools
+from fractions import gcd
+
+import pandas as pd
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from p2D_Feature_Extraction import pair_counts
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Histogram_Level(object):
+    """ One level of the pyramid, with the attributes of ND/p2D_Feature_Extraction """
+
+    def __init__(self, type, bin_description, histogram):
+        self.type = type
+        self.bin_description = bin_description
+        self.histogram = histogram
+
+
+class Pyramid_Feature_Extraction(object):
+
+    def __init__(self, FCS, bins=[5, 8, 10], blocks=None, **kwargs):
+        """ Performs ND and pairwise 2D Feature Extraction at several resolutions
+
+        Events are binned once per channel at the least common multiple of bins, the
+        bin numbers of every coarser level are the fine bin numbers integer divided by
+        (fine bins / level bins), so no level re-reads or re-bins the data
+
+        bins -- <list of int> number of bins per channel of each level
+        blocks -- optional iterable of processed dataframes (see FCS.comp_scale_FCS_blocks)
+                  whose histograms are accumulated in place of FCS.data
+        include_2d -- <bool> also make the pairwise 2D histograms of each level [default: True]
+
+        Accessiable Parameters:
+            .type --    <string> 'Pyramid'
+            .levels --  <dict> of Histogram_Level keyed on level name ('ND_<bins>' and
+                        '2D_<bins>'), each with .type, .bin_description and .histogram
+                        as made by ND_Feature_Extraction and p2D_Feature_Extraction
+        """
+        self.type = 'Pyramid'
+        if isinstance(bins, int):
+            bins = [bins]
+        self.bins = sorted(set(int(b) for b in bins))
+        self.fine_bins = reduce(lambda a, b: a * b / gcd(a, b), self.bins)
+        if self.fine_bins > 2**16:
+            raise ValueError("Least common multiple of bins {} is too large".format(self.bins))
+
+        exclude = kwargs.get('exclude_param', ['FSC-H', 'SSC-A', 'Time'])
+        include_2d = kwargs.get('include_2d', True)
+        normalize = kwargs.get('normalize', True)
+        if blocks is None:
+            blocks = [FCS.data]
+
+        columns = None
+        nd_counts = dict((b, None) for b in self.bins)
+        pair_totals = dict((b, None) for b in self.bins)
+        n_events = 0
+        for block in blocks:
+            if columns is None:
+                columns = [c for c in block.columns if c not in exclude]
+                pairs = list(itertools.combinations(range(len(columns)), 2))
+            if len(block) == 0:
+                continue
+            fine = self._Fine_Bin_Data(block, columns)
+            for level in self.bins:
+                coarse = fine // (self.fine_bins / level)
+                counts = self._nd_counts(coarse, level)
+                nd_counts[level] = counts if nd_counts[level] is None else nd_counts[level] + counts
+                if include_2d:
+                    counts = self._pair_counts(coarse, level, pairs)
+                    if pair_totals[level] is None:
+                        pair_totals[level] = counts
+                    else:
+                        pair_totals[level] += counts
+            n_events += len(block)
+
+        if n_events == 0:
+            raise ValueError("FCS data is empty!")
+
+        self.levels = {}
+        for level in self.bins:
+            bin_description = pd.Series([level] * len(columns), index=columns)
+            histogram = nd_counts[level]
+            if normalize:
+                histogram = histogram / n_events
+            self.levels['ND_{}'.format(level)] = Histogram_Level('Full', bin_description,
+                                                                 histogram.tocsr())
+            if include_2d:
+                counts = pair_totals[level]
+                if normalize:  # density, as in p2D_Feature_Extraction
+                    counts = counts * float(level * level) / counts.sum(axis=1)[:, np.newaxis]
+                self.levels['2D_{}'.format(level)] = Histogram_Level(
+                    'Full', bin_description, sp.sparse.csr_matrix(counts.reshape(1, -1)))
+
+    def _Fine_Bin_Data(self, input_data, columns):
+        """ returns the fine bin number of every event on every channel <n x channels> """
+        output = np.empty((len(input_data), len(columns)), dtype=np.uint16)
+        for j, key in enumerate(columns):
+            # column * bins is evaluated in the precision of the column (i.e. float32)
+            rounded = np.floor(np.asarray(input_data[key]) * self.fine_bins)
+            np.clip(rounded, 0, self.fine_bins - 1, out=rounded)
+            output[:, j] = rounded
+        return output
+
+    def _nd_counts(self, coarse, level):
+        """ sparse row of ND counts on the mixed radix coordinates of ND_Feature_Extraction """
+        coordinates = np.zeros(len(coarse), dtype=np.int64)
+        base = 1
+        for j in xrange(coarse.shape[1]):
+            coordinates += coarse[:, j].astype(np.int64) * base
+            base *= level
+        cells, counts = np.unique(coordinates, return_counts=True)
+        return sp.sparse.csr_matrix((counts.astype(np.float32), cells, [0, len(cells)]),
+                                    shape=(1, base))
+
+    def _pair_counts(self, coarse, level, pairs):
+        """ dense 2D counts <n pairs x level*level> of each pair of channels """
+        counts, offsets = pair_counts(coarse, [level] * coarse.shape[1], pairs)
+        return counts.reshape(len(pairs), level * level).astype(np.float64)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of fitted auto singlet (doublet detection) models
+
+Models are keyed on the cytometer, a window of acquisition dates, the singlet method and
+the number of classes, so that tubes run on the same instrument in the same window start
+their fit from the cached parameters (see GMM_doublet_detection) instead of from scratch.
+Entries are single pickles written atomically so that worker processes can share a cache
+"""
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014, David Ng"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import os
+import cPickle as pickle
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+# models already read by this process, keyed on (cache_dir, key)
+_models = {}
+
+
+class Singlet_Model_Cache(object):
+    """
+    Stores the means, covars and priors of fitted singlet models
+
+    cache_dir - directory holding the cache entries (created if needed)
+    window_days - <int> number of days of acquisition dates that share a model
+
+    Counts hits and misses of this instance in .hits and .misses
+    """
+
+    def __init__(self, cache_dir, window_days=30):
+        self.cache_dir = cache_dir
+        self.window_days = window_days
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, cytnum, date, method, classes):
+        """ Returns the cache key of a model fitted with method and classes on cytnum at date """
+        if date is None:
+            window = 'nodate'
+        else:
+            window = str(date.toordinal() // self.window_days)
+        return '_'.join([str(cytnum), window, str(method).lower(), str(classes)])
+
+    def load(self, key):
+        """ Returns the cached model <dict> of means, covars and priors or None """
+        memo_key = (os.path.abspath(self.cache_dir), key)
+        if memo_key not in _models:
+            fp = self.__path(key)
+            if not os.path.exists(fp):
+                self.misses += 1
+                return None
+            try:
+                with open(fp, 'rb') as fh:
+                    _models[memo_key] = pickle.load(fh)
+            except (IOError, ValueError, EOFError, pickle.UnpicklingError), e:
+                log.warning('Discarding unreadable singlet model {}: {}'.format(key, e))
+                self.__remove(key)
+                self.misses += 1
+                return None
+        self.hits += 1
+        return _models[memo_key]
+
+    def store(self, key, model):
+        """ Writes model <dict> of means, covars and priors to the cache """
+        model = dict((name, np.asarray(model[name], dtype=np.float64))
+                     for name in ['means', 'covars', 'priors'])
+        fp = self.__path(key)
+
+        # write to a temporary file so that concurrent readers never see partial entries
+        tmp = fp + '.{}'.format(os.getpid())
+        with open(tmp, 'wb') as fh:
+            pickle.dump(model, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, fp)
+        _models[(os.path.abspath(self.cache_dir), key)] = model
+
+    def clear(self):
+        """ Removes all cache entries """
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith('.pkl'):
+                self.__remove(fn[:-len('.pkl')])
+
+    def __remove(self, key):
+        _models.pop((os.path.abspath(self.cache_dir), key), None)
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
@@ -19,7 +19,6 @@ import pandas as pd
 from re import compile, findall, search
 from datetime import datetime
 from warnings import warn
-from struct import calcsize, unpack
 from os.path import basename
 import logging
 
@@ -51,6 +50,11 @@ class loadFCS(object):
         import_dataframe = True to import listmode as a dataframe
         import_dataframe = False to import listmode as a numpy array
         import_dataframe not included, will just read the header
+
+        columns -- <str list> channel names to import (default all channels)
+        max_events -- <int> import at most max_events events (default all events)
+        sample -- 'stride' (evenly spaced events) or 'random', used with max_events
+        seed -- <int> seed for sample='random'
         """
 
         # Load raw data
@@ -64,10 +68,17 @@ class loadFCS(object):
         self.parameters = self.__parameter_header()
         self.channels = self.parameters.loc['Channel_Name'].tolist()
         if 'import_dataframe' in kwargs:
+            columns = kwargs.get('columns', None)
+            if columns is None:
+                columns = self.channels
+            data = self.__parse_data(columns=columns,
+                                     max_events=kwargs.get('max_events', None),
+                                     sample=kwargs.get('sample', 'stride'),
+                                     seed=kwargs.get('seed', None))
             if kwargs['import_dataframe']:
-                self.data = pd.DataFrame(self.__parse_data(), columns=self.channels)
+                self.data = pd.DataFrame(data, columns=columns)
             else:
-                self.data = self.__parse_data()
+                self.data = data
         self.date = self.__py_export_time()
         self.filename = self.__get_filename(filepath)
         self.case_number = self.__get_case_number(filepath)
@@ -191,33 +202,182 @@ class loadFCS(object):
         self.fh.seek(start)
         return self.fh.read(stop - start + 1)
 
-    def __parse_data(self):
-        """parses the data structure, only listmode float support"""
+    def __parse_data(self, columns=None, max_events=None, sample='stride', seed=None):
+        """parses the data structure, listmode float (F), double (D) and integer (I) support
+
+        Returns a float32 <numpy array> (events x columns). When all events and
+        channels are requested the DATA segment is read into a single buffer,
+        otherwise only the requested events/channels are copied out of a
+        read-only memory map of the DATA segment
+        """
+        start, end = self.__get_data_offsets()
+        num_events = int(self.text['tot'])
+        dtype = self.__record_dtype()
+        col_idx = self.__column_index(columns)
+        rows = self.__sample_events(num_events, max_events, sample, seed)
+
+        if rows is None and col_idx == range(len(self.channels)):
+            records = self.__read_records(start, end, dtype, num_events)
+        else:
+            records = np.memmap(self.filepath, dtype=dtype, mode='r', offset=start,
+                                shape=(num_events,))
+            if rows is not None:
+                records = records[rows]  # copies only the selected events
+        return self.__decode_records(records, col_idx)
+
+    def iter_events(self, block_size=100000, columns=None):
+        """
+        Generator over the DATA segment in blocks of at most block_size events
+        Yields <pandas dataframe> blocks (events x columns, float32) indexed on the
+        event number, so only one block is held in memory at a time
+
+        Keyword arguments:
+        block_size -- <int> number of events per block
+        columns -- <str list> channel names to import (default all channels)
+        """
+        if columns is None:
+            columns = self.channels
+        start, end = self.__get_data_offsets()
+        num_events = int(self.text['tot'])
+        dtype = self.__record_dtype()
+        col_idx = self.__column_index(columns)
+        if (end - start + 1) / dtype.itemsize < num_events:
+            raise IndexError('the byte stream is shorter than the DATA segment')
+
+        records = np.memmap(self.filepath, dtype=dtype, mode='r', offset=start,
+                            shape=(num_events,))
+        for i in range(0, num_events, block_size):
+            block = np.array(records[i:i + block_size])  # copy of this block only
+            yield pd.DataFrame(self.__decode_records(block, col_idx), columns=columns,
+                               index=np.arange(i, i + len(block)))
+
+    def __get_data_offsets(self):
+        """
+        Returns the (start, end) byte offsets of the DATA segment
+        The HEADER offsets are zero for DATA segments past 99,999,999 bytes, in that
+        case the offsets are given by $BEGINDATA/$ENDDATA in TEXT
+        """
         start = self.header['data_start']
         end = self.header['data_end']
-        datatype = self.text['datatype'].lower()
-        mode = self.text['mode'].lower()
-        num_events = int(self.text['tot'])
-        byteorder = self.text['byteord']
+        if (start == 0 or end == 0) and 'begindata' in self.text:
+            start = int(self.text['begindata'])
+            end = int(self.text['enddata'])
+        return start, end
+
+    def __column_index(self, columns):
+        """Returns the parameter positions of the channel names in columns"""
+        if columns is None:
+            return range(len(self.channels))
+        missing = [c for c in columns if c not in self.channels]
+        if missing:
+            raise ValueError('Channels {} are not in the FCS file'.format(missing))
+        return [self.channels.index(c) for c in columns]
+
+    def __get_byteorder(self):
+        """Translates $BYTEORD into a numpy byteorder character"""
         byteorder_translation = {'4,3,2,1': '>',
-                                 '1,2,3,4': '<'} # dictionary to choose byteorder
-        if byteorder in byteorder_translation:
-            byteorder = byteorder_translation[byteorder]
+                                 '1,2,3,4': '<',
+                                 '2,1': '>',
+                                 '1,2': '<',
+                                 '1': '<'}  # dictionary to choose byteorder
+        byteorder = self.text['byteord'].strip()
+        if byteorder not in byteorder_translation:
+            raise ValueError('unsupported byteorder: {}'.format(byteorder))
+        return byteorder_translation[byteorder]
 
-        if mode != 'l' or datatype != 'f':
+    def __record_dtype(self):
+        """
+        Returns the structured numpy dtype describing one event of the DATA segment
+        (one field per parameter), built from $DATATYPE, $BYTEORD and $PnB
+        Only listmode data is supported
+        """
+        if self.text['mode'].lower() != 'l':
             raise ValueError('unsupported mode or datatype')
+        par = int(self.text['par'])
+        datatype = self.text['datatype'].lower()
+        byteorder = self.__get_byteorder()
+        if datatype in ['f', 'd']:
+            bits = [{'f': 32, 'd': 64}[datatype]] * par
+            kind = 'f'
+        elif datatype == 'i':
+            bits = [int(self.text['p{}b'.format(i)]) for i in range(1, par+1)]
+            if [b for b in bits if b not in [8, 16, 32]]:
+                raise ValueError('unsupported integer bit widths: {}'.format(bits))
+            kind = 'u'
+        else:
+            raise ValueError('unsupported mode or datatype')
+        return np.dtype([('p{}'.format(i), byteorder + '%s%d' % (kind, b / 8))
+                         for i, b in enumerate(bits, 1)])
+
+    def __sample_events(self, num_events, max_events, sample, seed):
+        """
+        Returns a sorted <numpy array> of the event indices to import
+        or None if all events are imported
+        """
+        if max_events is None or max_events >= num_events:
+            return None
+        if sample == 'stride':  # evenly spaced through the acquisition
+            return np.arange(max_events, dtype=np.int64) * num_events / max_events
+        elif sample == 'random':
+            rs = np.random.RandomState(seed)
+            if max_events > num_events / 2:
+                return np.sort(rs.permutation(num_events)[:max_events])
+            rows = np.unique(rs.randint(0, num_events, size=max_events))
+            while len(rows) < max_events:  # top up after dropping repeats
+                rows = np.unique(np.concatenate([rows, rs.randint(0, num_events,
+                                                                  size=max_events - len(rows))]))
+            return rows
         else:
-            return self.__float_parsing(start, end, datatype, byteorder, num_events)
+            raise ValueError("sample must be 'stride' or 'random'")
 
-    def __float_parsing(self, start, end, datatype, byteorder, num_events):
+    def __read_records(self, start, end, dtype, num_events):
         """
-        Parses floating point data given the byte coordinates
+        Reads the DATA segment directly into the buffer that backs the returned
+        <numpy array> of num_events records of dtype, so no python level copy of
+        the events is ever made
         """
-        num_items = (end - start + 1) / calcsize(datatype)
-        tmp = unpack('%s%d%s' % (byteorder, num_items, datatype), self.__get_block(start, end))
-        if len(tmp) % num_events != 0:
+        num_records = (end - start + 1) / dtype.itemsize
+        if num_records % num_events != 0:
             raise IndexError('the byte stream mismatch with number of events')
-        return np.array(tmp).reshape((num_events, len(tmp) / num_events))
+
+        buf = bytearray(num_events * dtype.itemsize)
+        self.fh.seek(start)
+        if self.fh.readinto(buf) != len(buf):
+            raise IndexError('the byte stream is shorter than the DATA segment')
+        return np.frombuffer(buf, dtype=dtype)
+
+    def __decode_records(self, records, col_idx):
+        """
+        Converts event records into a float32 <numpy array> (events x col_idx)
+        Float data of a single width is viewed as a 2d array (native float32 with
+        all columns is returned without a copy); integer data is masked down to
+        the bits given by each parameter's $PnR range
+        """
+        fields = records.dtype.names
+        field_dtypes = set([records.dtype[f] for f in fields])
+        if len(field_dtypes) == 1 and records.dtype[0].kind == 'f':
+            tmp = records.view(records.dtype[0]).reshape((len(records), len(fields)))
+            if col_idx != range(len(fields)):
+                tmp = tmp[:, col_idx]
+            return tmp.astype(np.float32, copy=False)
+
+        output = np.empty((len(records), len(col_idx)), dtype=np.float32)
+        for j, i in enumerate(col_idx):
+            column = records[fields[i]]
+            if column.dtype.kind == 'u':
+                column = np.bitwise_and(column, self.__range_mask(i+1, 8 * column.dtype.itemsize))
+            output[:, j] = column
+        return output
+
+    def __range_mask(self, i, bits):
+        """Returns the bitmask for parameter i given by its $PnR range"""
+        mask = 2**bits - 1
+        key = 'p{}r'.format(i)
+        if key in self.text:
+            prange = int(float(self.text[key]))
+            if prange > 0:
+                mask = min(mask, 2**int(prange - 1).bit_length() - 1)
+        return mask
 
     def __py_export_time(self):
         if self.text.has_key('export time'):
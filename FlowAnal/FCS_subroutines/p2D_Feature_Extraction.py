@@ -16,14 +16,47 @@ import logging
 import itertools
 log = logging.getLogger(__name__)
 
+def pair_counts(codes, bins, pairs, chunk_size=2**14):
+    """
+    Returns the 2d histogram counts <n pairs x max(bx*by)> of each (x, y) column pair
+    of codes <n x columns int array of bin numbers, -1 for events out of range>
+    flattened and concatenated in the order of pairs (offsets are returned as well)
+
+    The counts of all pairs come from one bincount per chunk of events over the pair
+    codes offset by the position of each pair histogram
+    """
+    bins = np.asarray(bins, dtype=np.intp)
+    x = np.array([a for a, b in pairs], dtype=np.intp)
+    y = np.array([b for a, b in pairs], dtype=np.intp)
+    sizes = bins[x] * bins[y]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    total = offsets[-1]
+
+    counts = np.zeros(total + 1, dtype=np.int64)   # last bin collects out of range events
+    for start in xrange(0, len(codes), chunk_size):
+        cx = codes[start:start + chunk_size, x].astype(np.intp)
+        cy = codes[start:start + chunk_size, y]
+        index = cx * bins[y]
+        index += cy
+        index += offsets[:-1]
+        index[(cx < 0) | (cy < 0)] = total
+        counts += np.bincount(index.ravel(), minlength=total + 1)
+    return counts[:total], offsets
+
+
 class p2D_Feature_Extraction(object):
 
-    def __init__(self,FCS,bins,**kwargs):
+    def __init__(self,FCS,bins,blocks=None,**kwargs):
         """
         bins = number of bins per axis
+        blocks = optional iterable of processed dataframes whose histograms are
+                 accumulated in place of FCS.data
+        pairs = optional list of (x, y) column pairs to bin (default every pair of columns)
+        output = 'sparse' for a csr_matrix row (default) or 'dense' for an array row
         Accessiable Parameters
         type
         bin_description
+        pairs
         histogram
         """
         self.type = 'Full'
@@ -31,40 +64,76 @@ class p2D_Feature_Extraction(object):
             exclude = kwargs['exclude_param']
         else:
             exclude = ['FSC-H','SSC-A','Time']
-        #generate list of columns to be used
-        columns = [c for c in FCS.data.columns if c not in exclude]
-        #generate a dictionary describing the bins to be used
-        bin_dict = self._Generate_Bin_Dict(columns,bins)
-        self.bin_description = bin_dict
-        self.histogram = self._flattened_2d_histograms(FCS_data=FCS.data,
-                                                       columns=columns,
-                                                       bin_dict=bin_dict,**kwargs)
-
-    def _flattened_2d_histograms(self,FCS_data,columns,bin_dict,ul=1.0,normalize=True,**kwargs):
+        if blocks is None:
+            blocks = [FCS.data]
+        self.histogram = self._flattened_2d_histograms(blocks=blocks,
+                                                       exclude=exclude,
+                                                       bins=bins,**kwargs)
+
+    def _flattened_2d_histograms(self,blocks,exclude,bins,ul=1.0,normalize=True,
+                                 pairs=None,output='sparse',**kwargs):
         """
+        Accumulates the 2d histogram counts of every pair of columns over blocks
+        of data and returns them (as densities if normalize) flattened into a
+        single row, bins are those of np.histogram2d(range=[[0,ul],[0,ul]])
         """
+        counts = None
+        for FCS_data in blocks:
+            if counts is None:
+                #generate list of columns to be used
+                columns = [c for c in FCS_data.columns if c not in exclude]
+                #generate a dictionary describing the bins to be used
+                bin_dict = self._Generate_Bin_Dict(columns,bins)
+                self.bin_description = bin_dict
+                if pairs is None:
+                    pairs = list(itertools.combinations(columns,2))
+                self.pairs = [tuple(pair) for pair in pairs]
+                missing = set(itertools.chain(*self.pairs)) - set(columns)
+                if missing:
+                    raise ValueError("Pair channels {} are not binned".format(sorted(missing)))
+                code_pairs = [(columns.index(a), columns.index(b)) for a, b in self.pairs]
+            codes = self._Bin_Codes(FCS_data,bin_dict,ul)
+            block_counts, offsets = pair_counts(codes, bin_dict.values, code_pairs)
+            counts = block_counts if counts is None else counts + block_counts
+
+        histogram = np.empty(len(counts), dtype=np.float32)
+        histogram[:] = counts
+        if normalize:  # same normalization as np.histogram2d(normed=True)
+            for k, (x, y) in enumerate(self.pairs):
+                histo2d = histogram[offsets[k]:offsets[k+1]]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    histo2d *= (bin_dict[x] * bin_dict[y]) / (ul * ul * histo2d.sum(dtype=np.float64))
+        if output == 'dense':
+            return histogram.reshape(1, -1)
+        index = np.flatnonzero(histogram)
+        return sp.sparse.csr_matrix((histogram[index], index, [0, len(index)]),
+                                    shape=(1, len(histogram)))
 
-        feature_space=[]
-        for features in itertools.combinations(columns,2):
-            dim = (bin_dict[features[0]],bin_dict[features[1]])
-            log.debug(features)
-            histo2d,xbin,ybin = np.histogram2d(FCS_data[features[0]],
-                                               FCS_data[features[1]],
-                                               bins=dim,
-                                               range=[[0,ul],[0,ul]],
-                                               normed=normalize)
-            #feature_space.extend(np.ravel(1-1/((histo2d*scaling)**0.75+1)))
-            feature_space.extend(np.ravel(histo2d))
-        return sp.sparse.csr_matrix(feature_space)
+    def _Bin_Codes(self,FCS_data,bin_dict,ul=1.0):
+        """
+        Returns the bin number (int16 for up to 2**15 bins) of every event on every column
+        of bin_dict, binned as np.histogram2d over [0, ul] (ul falls in the last bin), or -1
+        for events out of range
+        """
+        dtype = np.int16 if bin_dict.max() < 2**15 else np.int32
+        codes = np.empty((len(FCS_data), len(bin_dict)), dtype=dtype)
+        for j, key in enumerate(bin_dict.index.values):
+            values = np.asarray(FCS_data[key], dtype=np.float64)
+            edges = np.linspace(0, ul, bin_dict[key] + 1)
+            code = np.searchsorted(edges, values, side='right') - 1
+            code[values == ul] = bin_dict[key] - 1
+            code[(code < 0) | (code >= bin_dict[key])] = -1
+            codes[:, j] = code
+        return codes
 
     def _coord2sparse_histogram(self,vector_length,coordinates,normalize=True,**kwargs):
         """
         generates a sparse matrix with normalized histogram counts
         each bin describes the fraction of total events within it (i.e. < 1)
         """
-        output=sp.sparse.lil_matrix((1,vector_length), dtype=np.float32)
-        for i in coordinates:
-            output[0,i]+=1
+        cells, counts = np.unique(np.asarray(coordinates, dtype=np.int64), return_counts=True)
+        output = sp.sparse.csr_matrix((counts.astype(np.float32), cells, [0, len(cells)]),
+                                      shape=(1, vector_length))
         if normalize:
             return output/ len(coordinates)
         else:
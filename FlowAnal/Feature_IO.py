@@ -3,6 +3,14 @@
 Created on Wed 31 Dec 2014 05:54:41 AM PST
 This file describes a HDF5 interface class for pushing and pulling 'binned' histograms
 to an HDF5 file format
+
+Layout of the features (of a level, see Feature_IO) under <root>features/:
+    data, indices -- <1D> values and column indices of all tubes, concatenated
+    indptr -- <1D> row pointers, tube k (in push order) is data[indptr[k]:indptr[k+1]]
+    case_tube_idx, shape -- case_tube_idx and CSR shape of tube k
+    index -- <n x 2> case_tube_idx and position k of every tube (sorted on writer close)
+Files written before have one <root>data/<case_tube_idx>/{data,indices,indptr,shape}
+group per tube, they are read as well and can be converted with migrate_layout()
 @author: David Ng, MD
 """
 __author__ = "David Ng, MD"
@@ -13,8 +21,9 @@ __maintainer__ = "David Ng"
 __email__ = "ngdavid@uw.edu"
 __status__ = "Production"
 
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 from HDF5_subroutines.HDF5_IO import HDF5_IO
+from FCS_subroutines.Cell_Dictionary import Cell_Dictionary
 
 import numpy as np
 import pandas as pd
@@ -25,7 +34,7 @@ log = logging.getLogger(__name__)
 
 
 class Feature_IO(HDF5_IO):
-    def __init__(self, filepath, clobber=False):
+    def __init__(self, filepath, clobber=False, level=None):
         """ HDF5 input/output inferface
 
         This class provides an inferface for pushing feature extracted sparse
@@ -37,72 +46,215 @@ class Feature_IO(HDF5_IO):
         filepath -- <str> Absolute filepath to an HDF5 file for reading and
                           writing
         clobber -- <bool> Flag to overwrite a HDF5 file object
+        level -- <str> name of the level (i.e. 'ND_10') of 'Pyramid' features to read
+                       and write, each level is stored like a file of its own under
+                       /levels/<level>/ [default: None, no levels]
 
         """
         HDF5_IO.__init__(self,filepath)
+        self.level = level
+        self.__indices = {}     # level -> (file stamp, index of the tubes in the file)
 
         #self.filepath = filepath
         if clobber is True and os.path.exists(filepath):
             os.remove(filepath)
 
-    def make_single_tube_analysis(self, case_tube_list):
+    def make_single_tube_analysis(self, case_tube_list, dense=False):
         """
         This function will call a series of case_tube_idx as listed and merge
-        into a dense array that is the union of sparse matrix columns
+        into one sparse matrix on the union of the sparse matrix columns
         outputs a tuple of:
-        merged features <pd.DataFrame>
+        merged features <csr_matrix> tubes (in listed order) x occupied bins
+                        (<pd.DataFrame> indexed on case_tube_idx if dense)
+        bin_num <int array> bin number of every column of merged features
         not_in_data <list>
-        merge_failure <list>
-        
+        merge_failure <list> tubes that could not be read or whose number of bins
+                             differs from the (most common) one of the others, these
+                             tubes are left out of merged features
         """
-        fh = h5py.File(self.filepath, 'a')
-
         # error checking
-        not_in_data = set([str(x) for x in case_tube_list]) - set(fh['data'].keys())
-        not_in_data = [int(i) for i in not_in_data] 
+        not_in_data = set([int(x) for x in case_tube_list]) - \
+            set(self.get_case_tube_idxs())
+        not_in_data = list(not_in_data)
         if not_in_data:
             log.info("Some of the listed case_tubes are not in the dataset: {}".format(not_in_data))
-        cleaned_up_cti_list = [i for i in case_tube_list if i not in not_in_data]
+        cleaned_up_cti_list = [i for i in case_tube_list if int(i) not in not_in_data]
         if cleaned_up_cti_list == []:
             raise ValueError("Aborting single tube analysis creation; provide cases do not \
                               exist in the data file")
-        # get union of indices
-        index_union = self.__get_check_merge_indices(cleaned_up_cti_list)
-        # intialize bin number dataframe AND merge dataframe
-        bin_num_df = pd.DataFrame(index_union,columns=['bin_num'])
-        merged = bin_num_df
-        merge_failure = []
-        for case in cleaned_up_cti_list:
-            #load FCS Feature Dataframe
+
+        # one row per tube, columns compressed to the union of occupied bins
+        fh = h5py.File(self.filepath, 'r')
+        try:
+            shapes = self.__read_shapes(fh, cleaned_up_cti_list)
+            widths, counts = np.unique(shapes[shapes[:, 0] == 1, 1], return_counts=True)
+            width = widths[np.argmax(counts)] if len(widths) else -1
+            matching = (shapes[:, 0] == 1) & (shapes[:, 1] == width)
+            merge_failure = [i for i, ok in zip(cleaned_up_cti_list, matching) if not ok]
+            cleaned_up_cti_list = [i for i, ok in zip(cleaned_up_cti_list, matching) if ok]
             try:
-                FCS_ft_df = self.__translate_FCS_feature(case)
-                # do a relation algebra join on the bin_number on the union of bin
-                # numbers and index/bin_number of the FCS_features
-                merged = pd.merge(merged,FCS_ft_df,how='left', \
-                                  left_on='bin_num',right_index=True)
-            except:
-                merge_failure.append(case)
-        merged.fillna(0,inplace=True) # clear out nan to zero
-        return merged, not_in_data, merge_failure
+                if cleaned_up_cti_list:
+                    features = self.__read_features(fh, cleaned_up_cti_list)
+            except (KeyError, ValueError, IOError):   # read tube by tube, dropping failures
+                matrices = []
+                for i in cleaned_up_cti_list:
+                    try:
+                        matrices.append((i, self.__read_features(fh, [i])))
+                    except (KeyError, ValueError, IOError):
+                        merge_failure.append(i)
+                cleaned_up_cti_list = [i for i, matrix in matrices]
+                if matrices:
+                    features = vstack([matrix for i, matrix in matrices], format='csr')
+            if merge_failure:
+                log.info("Some of the listed case_tubes failed to merge: {}".format(
+                    merge_failure))
+            if cleaned_up_cti_list == []:
+                raise ValueError("Aborting single tube analysis creation; none of the \
+                                  provided cases could be read")
+        finally:
+            fh.close()
+        if features.shape[1] <= max(4 * features.nnz, 2**20):
+            # occupancy table of the bins (i.e. Sparse features or a few bins per channel)
+            occupied = np.zeros(features.shape[1], dtype=bool)
+            occupied[features.indices] = True
+            bin_num = np.flatnonzero(occupied)
+            columns = (np.cumsum(occupied) - 1)[features.indices]
+        else:
+            bin_num = np.unique(features.indices)
+            columns = np.searchsorted(bin_num, features.indices)
+        merged = csr_matrix((features.data, columns, features.indptr),
+                            shape=(features.shape[0], len(bin_num)))
+        if dense:
+            merged = pd.DataFrame(merged.toarray(), columns=bin_num,
+                                  index=[int(i) for i in cleaned_up_cti_list])
+            merged.columns.name = 'bin_num'
+        return merged, bin_num, not_in_data, merge_failure
 
 
     def push_fcs_features(self, case_tube_idx, FCS, db):
         """
         This function will push the fcs features stored in CSR matrix form
         to a given case_tube_idx as well as associated meta information
+        (opens the file for one tube, use writer() to push many tubes)
+        """
+        with self.writer(db=db) as writer:
+            writer.push(case_tube_idx, FCS)
+
+    def writer(self, db, batch_size=1000):
+        """
+        Returns a Feature_Writer session on this file, i.e.
+            with HDF_obj.writer(db=db) as writer:
+                for case_tube_idx, FCS in ...:
+                    writer.push(case_tube_idx, FCS)
+        """
+        return Feature_Writer(self, db=db, batch_size=batch_size)
+
+    def _check_header(self, fh, FCS, db, features, level):
+        """ Checks (or writes) the header of level against FCS, db and features """
+        self.level, previous = level, self.level
+        try:
+            self.schema = self.__make_schema('')
+            self.__push_check_version(hdf_fh=fh, FCS=FCS, db=db, features=features)
+        finally:
+            self.level = previous
+
+    def _append_features(self, fh, level, batch, chunk_size=2**16, compression='lzf'):
+        """
+        Appends batch <list> of (case_tube_idx, csr_matrix row) to the resizable
+        concatenated datasets of level (values, column indices, row pointers,
+        case_tube_idx and shape per tube)
+        """
+        self.level, previous = level, self.level
+        try:
+            schema = self.__make_schema('')
+        finally:
+            self.level = previous
+        matrices = [csr for cti, csr in batch]
+        if schema['fcti'] not in fh:
+            data_dtype = np.result_type(*[csr.dtype for csr in matrices])
+            for key, dtype, shape in [('fdat', data_dtype, (0,)), ('fidx', np.int64, (0,)),
+                                      ('fptr', np.int64, (1,)), ('fcti', np.int64, (0,)),
+                                      ('fshp', np.int64, (0, 2)), ('find', np.int64, (0, 2))]:
+                fh.create_dataset(schema[key], shape=shape, dtype=dtype,
+                                  maxshape=(None,) + shape[1:],
+                                  chunks=(min(chunk_size, 2**12)
+                                          if key in ['fcti', 'fshp', 'find']
+                                          else chunk_size,) + shape[1:],
+                                  compression=compression, shuffle=True)
+
+        nnz = np.array([csr.nnz for csr in matrices], dtype=np.int64)
+        columns = [('fdat', np.concatenate([csr.data for csr in matrices])),
+                   ('fidx', np.concatenate([csr.indices for csr in matrices])),
+                   ('fptr', fh[schema['fptr']][-1] + np.cumsum(nnz)),
+                   ('fcti', np.array([int(cti) for cti, csr in batch], dtype=np.int64)),
+                   ('fshp', np.array([csr.shape for csr in matrices], dtype=np.int64))]
+        first = fh[schema['fcti']].shape[0]
+        for key, values in columns:
+            dataset = fh[schema[key]]
+            start = dataset.shape[0]
+            dataset.resize((start + len(values),) + dataset.shape[1:])
+            dataset[start:] = values
+
+        # append the batch to the case_tube_idx -> position index, which stays sorted
+        # if the batch follows the tubes in it, otherwise it is sorted by _sort_index()
+        added = np.column_stack((columns[3][1], np.arange(first, first + len(batch))))
+        index = fh[schema['find']]
+        start = index.shape[0]
+        in_order = np.all(np.diff(added[:, 0]) >= 0) and \
+            (start == 0 or index[start - 1, 0] <= added[0, 0])
+        index.resize((start + len(added), 2))
+        index[start:] = added
+        if not in_order:
+            index.attrs['sorted'] = False
+        self.__indices.clear()
+
+    def _sort_index(self, fh, level):
+        """ Sorts the case_tube_idx -> position index of level in place (if needed) """
+        self.level, previous = level, self.level
+        try:
+            schema = self.__make_schema('')
+        finally:
+            self.level = previous
+        if schema['find'] in fh and not fh[schema['find']].attrs.get('sorted', True):
+            index = fh[schema['find']]
+            values = index[:]
+            index[:] = values[np.argsort(values[:, 0], kind='mergesort')]
+            index.attrs['sorted'] = True
+            self.__indices.clear()
+
+    def get_levels(self):
+        """ Returns the names of the 'Pyramid' levels in the file """
+        fh = h5py.File(self.filepath, 'r')
+        levels = sorted(fh['levels'].keys()) if 'levels' in fh else []
+        fh.close()
+        return levels
+
+    def push_cell_dictionary(self, cell_dictionary, path='/cell_dictionary'):
+        """
+        This function will push (replace) the Cell_Dictionary that indexes 'Sparse'
+        features, i.e. after all case_tube_idx of a cohort are pushed
         """
-        self.schema = self.__make_schema(str(case_tube_idx))
         fh = h5py.File(self.filepath, 'a')
-	
-        self.__push_check_version(hdf_fh=fh, FCS=FCS, db=db)
-        
-        # push sparse data into dir named for case_tube_idx
-        fh[self.schema['sdat']] = FCS.FCS_features.histogram.data
-        fh[self.schema['sidx']] = FCS.FCS_features.histogram.indices
-        fh[self.schema['sind']] = FCS.FCS_features.histogram.indptr
-        fh[self.schema['sshp']] = FCS.FCS_features.histogram.shape
+        if path in fh:
+            del fh[path]
+        fh[os.path.join(path, 'coordinates')] = cell_dictionary.coordinates()
+        fh[path].attrs['capacity'] = cell_dictionary.capacity
+        self.push_Series(SR=cell_dictionary.bin_description,
+                         path=os.path.join(path, 'bin_description'), ext_filehandle=fh)
         fh.close()
 
+    def get_cell_dictionary(self, path='/cell_dictionary'):
+        """
+        This function will return the Cell_Dictionary stored with push_cell_dictionary
+        """
+        fh = h5py.File(self.filepath, 'r')
+        coordinates = fh[os.path.join(path, 'coordinates')].value
+        capacity = int(fh[path].attrs['capacity'])
+        bin_description = self.pull_Series(os.path.join(path, 'bin_description'),
+                                           ext_filehandle=fh).astype(np.int64)
+        fh.close()
+        return Cell_Dictionary.from_coordinates(bin_description, coordinates, capacity=capacity)
+
     def push_failed_cti_list(self, cti_list):
         """
         This function will push a dataframe containing the case_num,
@@ -117,29 +269,77 @@ class Feature_IO(HDF5_IO):
         """
         This function will return the CSR matrix for a given case_tube_idx
         """
-        self.schema = self.__make_schema(str(case_tube_idx))
         fh = h5py.File(self.filepath, 'r')
+        try:
+            return self.__read_features(fh, [case_tube_idx])
+        finally:
+            fh.close()
 
-        # get individual componets of the sparse array
-        d = fh[self.schema['sdat']].value
-        i = fh[self.schema['sidx']].value
-        p = fh[self.schema['sind']].value
-        s = fh[self.schema['sshp']].value
-
-        fh.close()
-        return csr_matrix((d,i,p),shape=s)
+    def get_fcs_features_matrix(self, case_tube_list):
+        """
+        This function will return the CSR matrix with one row for every case_tube_idx
+        listed (in order), read with one slice per run of neighboring tubes
+        """
+        fh = h5py.File(self.filepath, 'r')
+        try:
+            return self.__read_features(fh, case_tube_list)
+        finally:
+            fh.close()
 
-    def get_case_tube_idxs(self):
+    def get_case_tube_idxs(self, ext_filehandle=None):
         """This function returns the case_tube_indices present in the file
 
         RETURN list of int()'s
         """
-
-        fh = h5py.File(self.filepath, 'r')
-        cti = [int(i) for i in fh['data'].keys()]
-        fh.close()
+        if ext_filehandle:
+            fh = ext_filehandle
+        else:
+            fh = h5py.File(self.filepath, 'r')
+        cti = [int(i) for i in self.__load_index(fh)[0]]
+        if not ext_filehandle:
+            fh.close()
         return cti
 
+    def migrate_layout(self, filepath, batch_size=1000):
+        """
+        Writes this file to filepath with the features of every level in the concatenated
+        datasets, i.e. converts the per tube groups of files written by earlier versions,
+        returns the Feature_IO of filepath
+        """
+        if os.path.exists(filepath):
+            raise IOError("{} exists, will not overwrite it".format(filepath))
+        out = Feature_IO(filepath, level=self.level)
+        src = h5py.File(self.filepath, 'r')
+        dst = h5py.File(filepath, 'w')
+        try:
+            levels = [None] + sorted(src['levels'].keys()) if 'levels' in src else [None]
+            for level in levels:
+                self.level, previous = level, self.level
+                try:
+                    root = self.__level_root()
+                    for name in src[root].keys():
+                        if name not in ['data', 'features', 'levels']:
+                            src.copy(src[root + name], dst.require_group(root), name=name)
+
+                    # tubes of the concatenated datasets and of the per tube groups
+                    ctis = self.get_case_tube_idxs(ext_filehandle=src)
+                    for i in xrange(0, len(ctis), batch_size):
+                        batch = ctis[i:i+batch_size]
+                        try:
+                            matrix = self.__read_features(src, batch)
+                            matrices = [matrix[k] for k in range(len(batch))]
+                        except ValueError:  # shapes differ, read tube by tube
+                            matrices = [self.__read_features(src, [cti]) for cti in batch]
+                        out._append_features(dst, level, zip(batch, matrices))
+                    out._sort_index(dst, level)
+                finally:
+                    self.level = previous
+                log.info("Migrated {} tubes of level {}".format(len(ctis), level))
+        finally:
+            src.close()
+            dst.close()
+        return out
+
     def get_meta_data(self):
         """
         this function will load meta information into memory via a dictionary
@@ -147,7 +347,7 @@ class Feature_IO(HDF5_IO):
         """
         meta_schema = self.__make_schema("MetaData")
         #create dictionary with meta info, won't use sparse matrix info to make it "MetaData"
-        csr_keys = ['sdat','sidx','sind','sshp']
+        csr_keys = ['sdat','sidx','sind','sshp','data','fdat','fidx','fptr','fcti','fshp','find']
         #these are the sparse matrix keys to remove
         meta_keys = [k for k in meta_schema.keys() if k not in csr_keys]
 
@@ -169,41 +369,122 @@ class Feature_IO(HDF5_IO):
         return meta_data
 
 
-    def __translate_FCS_feature(self,case_tube_idx):
+    def __load_index(self, fh):
         """
-        makes a dataframe containing the index and data information of the
-        original sparse matrix
+        Returns the case_tube_idx <int array> in the file (sorted), the position of each
+        tube in the concatenated datasets (-1 for tubes in per tube groups) and the row
+        pointers of the concatenated datasets, read once while the file is unchanged
         """
-        sparse_mtx = self.get_fcs_features(case_tube_idx)
-        return pd.DataFrame(data=sparse_mtx.data,
-                            index=sparse_mtx.indices,
-                            columns=[str(case_tube_idx)])
-
-
-    def __get_check_merge_indices(self, case_tube_list):
+        stamp = (os.path.getmtime(self.filepath), os.path.getsize(self.filepath))
+        if self.level in self.__indices and self.__indices[self.level][0] == stamp:
+            return self.__indices[self.level][1]
+
+        schema = self.__make_schema('')
+        if schema['find'] in fh:
+            index = fh[schema['find']][:]
+            if not fh[schema['find']].attrs.get('sorted', True):   # writer not closed yet
+                index = index[np.argsort(index[:, 0], kind='mergesort')]
+            ctis, positions = index.T
+            indptr = fh[schema['fptr']][:]
+        else:
+            ctis = positions = np.zeros(0, dtype=np.int64)
+            indptr = np.zeros(1, dtype=np.int64)
+        if schema['data'] in fh:
+            legacy = np.array(sorted(int(i) for i in fh[schema['data']].keys()), dtype=np.int64)
+            ctis = np.concatenate((ctis, legacy))
+            positions = np.concatenate((positions, -np.ones(len(legacy), dtype=np.int64)))
+            order = np.argsort(ctis, kind='mergesort')
+            ctis, positions = ctis[order], positions[order]
+        index = (ctis, positions, indptr)
+        self.__indices[self.level] = (stamp, index)
+        return index
+
+    def __read_shapes(self, fh, case_tube_list):
         """
-        This will return a list of the union of index positions for all
-        listed case_tube
+        Returns the CSR shape <n x 2 int array> of the features of every tube of
+        case_tube_list from the open file fh, (0, 0) for tubes that can not be read
         """
+        ctis, positions, indptr = self.__load_index(fh)
+        wanted = np.array([int(i) for i in case_tube_list], dtype=np.int64)
+        rows = positions[np.searchsorted(ctis, wanted)]
+        schema = self.__make_schema('')
+        shapes = np.zeros((len(wanted), 2), dtype=np.int64)
+        if (rows >= 0).any():
+            shapes[rows >= 0] = fh[schema['fshp']][:][rows[rows >= 0]]
+        for k in np.flatnonzero(rows < 0):
+            try:
+                shapes[k] = fh[self.__make_schema(str(wanted[k]))['sshp']].value
+            except (KeyError, ValueError, IOError), e:
+                log.debug("Shape of case_tube_idx {} can not be read: {}".format(wanted[k], e))
+        return shapes
 
-        fh = h5py.File(self.filepath, 'a')
-        index = []
-        shape = []
-        for i in case_tube_list:
-            schema = self.__make_schema(str(i))
-            index.extend(fh[schema['sidx']].value.tolist())
-            shape.append(fh[schema['sshp']].value)
-        fh.close()
-
-        #check shape matches
-        areTrue = [shape[i]==shape[i-1] for i in range(1,len(shape))]
-        if not np.all(areTrue):
-            print np.array(shape)
-            raise "The length/shape of one case does not match the others"
+    def __read_features(self, fh, case_tube_list):
+        """
+        Returns the CSR matrix of the features of case_tube_list (one row per tube)
+        from the open file fh
+        """
+        ctis, positions, indptr = self.__load_index(fh)
+        wanted = np.array([int(i) for i in case_tube_list], dtype=np.int64)
+        found = np.searchsorted(ctis, wanted)
+        missing = (found == len(ctis)) | (ctis[np.minimum(found, len(ctis) - 1)] != wanted)
+        if len(ctis) == 0 or missing.any():
+            raise KeyError("case_tube_idx {} are not in {}".format(
+                list(wanted[missing]) if len(ctis) else list(wanted), self.filepath))
+        rows = positions[found]
+        schema = self.__make_schema('')
+
+        if (rows < 0).any():    # tubes in per tube groups, one read per dataset
+            matrices = []
+            for cti, row in zip(wanted, rows):
+                if row < 0:
+                    tube = self.__make_schema(str(cti))
+                    matrices.append(csr_matrix((fh[tube['sdat']].value, fh[tube['sidx']].value,
+                                                fh[tube['sind']].value),
+                                               shape=fh[tube['sshp']].value))
+                else:
+                    matrices.append(self.__read_features(fh, [cti]))
+            shapes = set((m.shape[1],) for m in matrices)
+            if len(shapes) > 1:
+                raise ValueError("The length/shape of one case does not match the others")
+            return vstack(matrices, format='csr')
+
+        shapes = fh[schema['fshp']]
+        if len(rows) == 1:
+            shape = shapes[rows[0]]
+            columns = set([shape[1]])
         else:
-            return np.sort(np.unique(np.array(index)))
-
-    def __push_check_version(self, hdf_fh, FCS, db):
+            shape = shapes[:]
+            columns = set(shape[rows, 1])
+        if len(columns) > 1:
+            raise ValueError("The length/shape of one case does not match the others")
+
+        # read runs of neighboring tubes (less than a chunk apart) with one slice each
+        starts, stops = indptr[rows], indptr[rows + 1]
+        gap = fh[schema['fdat']].chunks[0]
+        order = np.argsort(starts, kind='mergesort')
+        run_starts = [starts[order[0]]]
+        run_stops = [stops[order[0]]]
+        for k in order[1:]:
+            if starts[k] <= run_stops[-1] + gap:
+                run_stops[-1] = max(run_stops[-1], stops[k])
+            else:
+                run_starts.append(starts[k])
+                run_stops.append(stops[k])
+        offsets = np.cumsum([0] + [b - a for a, b in zip(run_starts, run_stops)])
+        data = np.concatenate([fh[schema['fdat']][a:b] for a, b in zip(run_starts, run_stops)])
+        indices = np.concatenate([fh[schema['fidx']][a:b]
+                                  for a, b in zip(run_starts, run_stops)])
+
+        # position of every tube in the read slabs
+        run = np.searchsorted(run_starts, starts, side='right') - 1
+        begin = offsets[run] + starts - np.array(run_starts)[run]
+        lengths = stops - starts
+        take = np.repeat(begin - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + \
+            np.arange(lengths.sum())
+        return csr_matrix((data[take], indices[take], np.concatenate(([0], np.cumsum(lengths)))),
+                          shape=(len(rows), columns.pop()))
+
+    def __push_check_version(self, hdf_fh, FCS, db, features=None):
         """
         This internal function will check to see the header info the
         hdf5 object/file is correct per the following logic
@@ -212,7 +493,10 @@ class Feature_IO(HDF5_IO):
         if not exist, make and equal
 
         Items used: FCS.version, FCS.FCS_features.type, db.date, db.db_file
+        (features -- the FCS_features or pyramid level to check, default FCS.FCS_features)
         """
+        if features is None:
+            features = FCS.FCS_features
 	        
         if self.schema['database_filepath'] in hdf_fh:
             if hdf_fh[self.schema['database_filepath']].value != db.db_file:
@@ -237,13 +521,13 @@ class Feature_IO(HDF5_IO):
         #chek/add Extraction type
         
         if self.schema['extraction_type'] in hdf_fh:
-            if hdf_fh[self.schema['extraction_type']].value != FCS.FCS_features.type:
+            if hdf_fh[self.schema['extraction_type']].value != features.type:
                 raise ValueError('Evn versions do not match')
         else:
-            hdf_fh[self.schema['extraction_type']] = FCS.FCS_features.type
+            hdf_fh[self.schema['extraction_type']] = features.type
         
         #check/add bin_descriptions
-        bin_desc = FCS.FCS_features.bin_description
+        bin_desc = features.bin_description
         if self.schema['bin_description'] in hdf_fh:
             pass
             #Error handling for these things is not working well, the pull returns objects
@@ -265,14 +549,122 @@ class Feature_IO(HDF5_IO):
         """
         makes a dictionary containing the storage schema
         """
-        schema = {"database_filepath": "/database_version/filepath",
-                  "database_datetime": "/database_version/date",
-                  "enviroment_version": "/enviroment_version",
-                  "extraction_type": "/extraction_type",
+        root = self.__level_root()
+        schema = {"database_filepath": root + "database_version/filepath",
+                  "database_datetime": root + "database_version/date",
+                  "enviroment_version": root + "enviroment_version",
+                  "extraction_type": root + "extraction_type",
                   "Case_Tube_Failures_DF": "/failed_cti",
-                  "bin_description": "/bin_description/",
-                  "sdat": "/data/"+case_tube_idx+"/data",
-                  "sidx": "/data/"+case_tube_idx+"/indices",
-                  "sind": "/data/"+case_tube_idx+"/indptr",
-                  "sshp": "/data/"+case_tube_idx+"/shape"}
+                  "bin_description": root + "bin_description/",
+                  "sdat": root + "data/"+case_tube_idx+"/data",
+                  "sidx": root + "data/"+case_tube_idx+"/indices",
+                  "sind": root + "data/"+case_tube_idx+"/indptr",
+                  "sshp": root + "data/"+case_tube_idx+"/shape",
+                  "data": root + "data",
+                  "fdat": root + "features/data",
+                  "fidx": root + "features/indices",
+                  "fptr": root + "features/indptr",
+                  "fcti": root + "features/case_tube_idx",
+                  "fshp": root + "features/shape",
+                  "find": root + "features/index"}
         return schema
+
+    def __level_root(self):
+        """ returns the group (with trailing /) holding the features of self.level """
+        if self.level is None:
+            return '/'
+        return '/levels/{}/'.format(self.level)
+
+
+class Feature_Writer(object):
+    """
+    Writer session on a Feature_IO file (see Feature_IO.writer), keeps the file open,
+    checks the header of every level once and buffers features in memory until
+    batch_size tubes are pushed, then appends them to the resizable, chunked and
+    compressed datasets of the level in one write per dataset
+
+    Accessible Parameters:
+        .pushed -- <int> number of tubes pushed in this session
+    """
+
+    def __init__(self, feature_io, db, batch_size=1000):
+        self.io = feature_io
+        self.db = db
+        self.batch_size = batch_size
+        self.pushed = 0
+        self.fh = None
+        self.__buffer = {}      # level -> list of (case_tube_idx, csr_matrix)
+        self.__checked = set()  # levels with a checked header
+        self.__ctis = set()     # case_tube_idx in the file or buffer, per level
+        self.__written = set()  # levels written in this session (index sorted on close)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        if self.fh is None:
+            self.fh = h5py.File(self.io.filepath, 'a')
+        return self
+
+    def push(self, case_tube_idx, FCS):
+        """ Buffers the features of FCS (every level of 'Pyramid' features) for case_tube_idx """
+        if self.fh is None:
+            raise IOError("Feature_Writer on {} is not open".format(self.io.filepath))
+        if FCS.FCS_features.type == 'Pyramid':
+            levels = sorted(FCS.FCS_features.levels.items())
+        else:
+            levels = [(self.io.level, FCS.FCS_features)]
+
+        for level, features in levels:
+            if level not in self.__checked:
+                self.io._check_header(self.fh, FCS=FCS, db=self.db, features=features,
+                                      level=level)
+                self.__checked.add(level)
+                self.__load_ctis(level)
+            if (level, int(case_tube_idx)) in self.__ctis:
+                raise ValueError("case_tube_idx {} is already in {}".format(
+                    case_tube_idx, self.io.filepath))
+        for level, features in levels:
+            self.__ctis.add((level, int(case_tube_idx)))
+            self.__buffer.setdefault(level, []).append((case_tube_idx, features.histogram))
+        self.pushed += 1
+        if len(self.__buffer[levels[0][0]]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered features """
+        for level, batch in sorted(self.__buffer.items()):
+            if batch:
+                self.io._append_features(self.fh, level, batch)
+                self.__written.add(level)
+                log.debug("Wrote {} tubes to level {}".format(len(batch), level))
+        self.__buffer = {}
+        if self.fh is not None:
+            self.fh.flush()
+
+    def close(self):
+        """ Writes the buffered features, sorts the index of the levels written and closes
+        the file """
+        if self.fh is not None:
+            try:
+                self.flush()
+                for level in sorted(self.__written):
+                    self.io._sort_index(self.fh, level)
+                self.__written = set()
+            finally:
+                self.fh.close()
+                self.fh = None
+
+    def __load_ctis(self, level):
+        """ case_tube_idx already in the file for level (pushing them again is an error) """
+        previous, self.io.level = self.io.level, level
+        try:
+            ctis = self.io.get_case_tube_idxs(ext_filehandle=self.fh)
+        finally:
+            self.io.level = previous
+        self.__ctis.update((level, i) for i in ctis)
@@ -4,6 +4,14 @@ Created on Fri 09 Jan 2015 03:22:34 PM PST
 This file describes a HDF5 interface class for pushing and pulling a pandas
 dataframe
 
+Dataframes and series are stored typed, a group per object holding
+    index, columns -- <1D> labels (numeric labels stay numeric)
+    data -- <1D> values of a series
+    block<k>_values, block<k>_items -- <rows x n> values of the columns (positions in
+                                        items) that share a dtype
+with the dtypes and label names kept as attributes of the group. Groups written before
+(every value as a string, no 'format' attribute) are still read
+
 @author: David Ng, MD
 """
 __author__ = "David Ng, MD"
@@ -21,6 +29,33 @@ import os
 import logging
 log = logging.getLogger(__name__)
 
+# values of these dtype kinds are stored as they are, datetimes as int64, the rest as strings
+_native_kinds = 'biuf'
+
+
+def _to_typed(values):
+    """ Returns values <1D or 2D array> in an HDF5 storable dtype and the dtype to restore """
+    values = np.asarray(values)
+    dtype = str(values.dtype)
+    if values.dtype.kind in _native_kinds:
+        return values, dtype
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]').view(np.int64), 'datetime64[ns]'
+    if values.dtype.kind == 'S':
+        return values, dtype
+    encoded = [v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in values.ravel()]
+    return np.array(encoded, dtype=str).reshape(values.shape), dtype
+
+
+def _from_typed(values, dtype):
+    """ Reverts _to_typed """
+    if dtype == 'datetime64[ns]':
+        return values.view('datetime64[ns]')
+    if dtype == 'object':
+        return values.astype(object)
+    return values
+
+
 class HDF5_IO(object):
     def __init__(self,filename,clobber=False):
         """
@@ -30,7 +65,7 @@ class HDF5_IO(object):
         if clobber is True and os.path.exists(filepath):
             os.remove(filepath)
 
-    def push_Series(self, SR, path, ext_filehandle=None):
+    def push_Series(self, SR, path, ext_filehandle=None, compression='gzip'):
         """
         Method for pushing a full pandas series to the hdf5 file
         """
@@ -38,57 +73,120 @@ class HDF5_IO(object):
             fh = ext_filehandle
         else:
             fh = h5py.File(self.filepath, 'a')
-        fh[os.path.join(path,'index')] = [str(i) for i in SR.index]
-        fh[os.path.join(path,'data')] = SR.values.astype(str)
-        #fh[os.path.join(path,'dtype')] = SR.dtype.astype(str)
-        if not ext_filehandle:                          
+        if path in fh:
+            del fh[path]
+        group = fh.create_group(path)
+        self._push_labels(group, 'index', SR.index, compression)
+        values, dtype = _to_typed(SR.values)
+        self.__push_values(group, 'data', values, compression)
+        group.attrs['dtype'] = dtype
+        if SR.name is not None:
+            group.attrs['name'] = str(SR.name)
+        group.attrs['format'] = 'typed'
+        if not ext_filehandle:
             fh.close()
-          
+
     def pull_Series(self, path, ext_filehandle=None):
         """
-        Method for returning a full pandas dataframe from teh files       
+        Method for returning a full pandas dataframe from teh files
         """
         if ext_filehandle:
             fh = ext_filehandle
         else:
             fh = h5py.File(self.filepath, 'r')
-            
-        SR = pd.Series(data = fh[os.path.join(path,'data')].value,
-                       index = fh[os.path.join(path,'index')].value,
-                       dtype = np.int64)
-                       #dtype = fh[os.path.join(path,'dtype')].value)
-        if not ext_filehandle:                          
+
+        group = fh[path]
+        if group.attrs.get('format') == 'typed':
+            SR = pd.Series(data=_from_typed(group['data'][()], group.attrs['dtype']),
+                           index=self._pull_labels(group, 'index'),
+                           name=group.attrs.get('name'))
+        else:   # every value stored as a string
+            SR = pd.Series(data = fh[os.path.join(path,'data')].value,
+                           index = fh[os.path.join(path,'index')].value,
+                           dtype = np.int64)
+        if not ext_filehandle:
             fh.close()
         return SR
 
 
-    def push_DataFrame(self, DF, path, ext_filehandle=None):
+    def push_DataFrame(self, DF, path, ext_filehandle=None, compression='gzip'):
         """
-        Method for pushing a full pandas dataframe to the hdf5 file
+        Method for pushing a full pandas dataframe to the hdf5 file, one dataset per
+        block of columns that share a dtype
         """
         if ext_filehandle:
             fh = ext_filehandle
         else:
             fh = h5py.File(self.filepath, 'a')
-        fh[os.path.join(path,'index')] = [str(i) for i in DF.index]
-        fh[os.path.join(path,'columns')] = [str(i) for i in DF.columns]
-        fh[os.path.join(path,'data')] = DF.values.astype(str)
-        
-        if not ext_filehandle:                          
+        if path in fh:
+            del fh[path]
+        group = fh.create_group(path)
+        self._push_labels(group, 'index', DF.index, compression)
+        self._push_labels(group, 'columns', DF.columns, compression)
+
+        blocks = {}     # dtype -> column positions
+        for j, dtype in enumerate(DF.dtypes):
+            blocks.setdefault(str(dtype), []).append(j)
+        for k, (dtype, items) in enumerate(sorted(blocks.items())):
+            values, dtype = _to_typed(DF.iloc[:, items].values)
+            self.__push_values(group, 'block{}_values'.format(k), values, compression)
+            self.__push_values(group, 'block{}_items'.format(k), np.array(items), None)
+            group.attrs['block{}_dtype'.format(k)] = dtype
+        group.attrs['nblocks'] = len(blocks)
+        group.attrs['format'] = 'typed'
+
+        if not ext_filehandle:
             fh.close()
-          
+
     def pull_DataFrame(self, path, ext_filehandle=None):
         """
-        Method for returning a full pandas dataframe from teh files       
+        Method for returning a full pandas dataframe from teh files
         """
         if ext_filehandle:
             fh = ext_filehandle
         else:
             fh = h5py.File(self.filepath, 'r')
-            
-        DF = pd.DataFrame(data = fh[os.path.join(path,'data')].value,
-                          index = fh[os.path.join(path,'index')].value,
-                          columns = fh[os.path.join(path,'columns')].value)
-        if not ext_filehandle:                          
+
+        group = fh[path]
+        if group.attrs.get('format') == 'typed':
+            columns = self._pull_labels(group, 'columns')
+            index = self._pull_labels(group, 'index')
+            blocks = []
+            for k in range(group.attrs['nblocks']):
+                items = group['block{}_items'.format(k)][()]
+                values = _from_typed(group['block{}_values'.format(k)][()],
+                                     group.attrs['block{}_dtype'.format(k)])
+                blocks.append(pd.DataFrame(values, columns=items))
+            if blocks:
+                DF = pd.concat(blocks, axis=1).reindex(columns=range(len(columns)))
+                DF.index = index
+                DF.columns = columns
+            else:
+                DF = pd.DataFrame(index=index, columns=columns)
+        else:   # every value stored as a string
+            DF = pd.DataFrame(data = fh[os.path.join(path,'data')].value,
+                              index = fh[os.path.join(path,'index')].value,
+                              columns = fh[os.path.join(path,'columns')].value)
+        if not ext_filehandle:
             fh.close()
         return DF
+
+    def _push_labels(self, group, name, labels, compression):
+        """ Stores index or column labels (and their name) typed """
+        values, dtype = _to_typed(np.asarray(labels))
+        self.__push_values(group, name, values, compression)
+        group.attrs[name + '_dtype'] = dtype
+        if labels.name is not None:
+            group.attrs[name + '_name'] = str(labels.name)
+
+    def _pull_labels(self, group, name):
+        labels = _from_typed(group[name][()], group.attrs[name + '_dtype'])
+        return pd.Index(labels, name=group.attrs.get(name + '_name'))
+
+    def __push_values(self, group, name, values, compression):
+        """ Writes a dataset, chunked and compressed if it holds any values """
+        if compression is None or values.size == 0:
+            group.create_dataset(name, data=values)
+        else:
+            group.create_dataset(name, data=values, chunks=True, compression=compression,
+                                 shuffle=True)
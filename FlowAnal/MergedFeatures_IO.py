@@ -8,7 +8,12 @@ push_all, get_all
 push_features, get_features
 push_not_found, get_not_found
 push_annotations, get_annotations
+iter_batches, get_memmap
 
+Features are stored in row blocks (the ML input does not need to fit in memory),
+under /features/ either as CSR (data, indices, indptr) when sparse or as a float32
+<rows x bins> dataset, with the index (cases) and column (bins) labels and the layout
+as attributes. An uncompressed dense layout is contiguous and can be memory mapped
 @author: David Ng, MD
 """
 __author__ = "David Ng, MD"
@@ -19,7 +24,7 @@ __maintainer__ = "David Ng"
 __email__ = "ngdavid@uw.edu"
 __status__ = "Production"
 
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse, vstack
 from HDF5_subroutines.HDF5_IO import HDF5_IO
 
 import numpy as np
@@ -32,6 +37,9 @@ log = logging.getLogger(__name__)
 
 
 class MergedFeatures_IO(HDF5_IO):
+    # features with more than this fraction of nonzero values are stored dense
+    density_threshold = 0.3
+
     def __init__(self, filepath, clobber=False):
         """ HDF5 input/output inferface for the MergedFeatures/ML Input
         
@@ -108,25 +116,187 @@ class MergedFeatures_IO(HDF5_IO):
         log.debug("Succesfully retrived annotation dataframe: {}".format(DF.head()))
         return DF
 
-    def push_features(self,Feature_DF):
+    def push_features(self, Feature_DF, index=None, columns=None, layout='auto',
+                      block_rows=1024, compression='lzf'):
         """
-        This will push the annotation dataframe
+        This will push the feature matrix in row blocks
+
+        Feature_DF -- <pd.DataFrame> cases x bins, or a csr_matrix/array with its
+                      index (cases) and columns (bins) labels
+        layout -- 'sparse' (CSR), 'dense' (float32) or 'auto' (dense above
+                  density_threshold), a dense layout without compression is contiguous
+                  (see get_memmap)
+        block_rows -- <int> number of rows per block (and chunk) of the stored matrix
         """
+        if isinstance(Feature_DF, pd.DataFrame):
+            index, columns = Feature_DF.index, Feature_DF.columns
+            matrix = Feature_DF.values
+        else:
+            matrix = Feature_DF
+        index = pd.Index(index if index is not None else np.arange(matrix.shape[0]))
+        columns = pd.Index(columns if columns is not None else np.arange(matrix.shape[1]))
+        n_rows, n_columns = matrix.shape
+        if layout == 'auto':
+            nnz = matrix.nnz if issparse(matrix) else np.count_nonzero(matrix)
+            density = float(nnz) / max(n_rows * n_columns, 1)
+            layout = 'dense' if density > self.density_threshold else 'sparse'
+        if layout == 'sparse':
+            matrix = csr_matrix(matrix, dtype=np.float32)
+
         schema = self.__make_schema()
-        self.push_DataFrame(DF = Feature_DF,
-                            path = schema['Feature_DF'])
-        log.debug("Succesfully pushed Feature dataframe to ML_input hdf5")
+        fh = h5py.File(self.filepath, 'a')
+        if schema['Feature_DF'] in fh:
+            del fh[schema['Feature_DF']]
+        group = fh.create_group(schema['Feature_DF'])
+        self._push_labels(group, 'index', index, compression)
+        self._push_labels(group, 'columns', columns, compression)
+        options = {} if compression is None else {'compression': compression,
+                                                  'shuffle': True}
+        if layout == 'sparse':
+            chunk = max(1, min(matrix.nnz, block_rows * 2**10))
+            group.create_dataset('data', data=matrix.data, chunks=(chunk,), **options)
+            group.create_dataset('indices', data=matrix.indices.astype(np.int64),
+                                 chunks=(chunk,), **options)
+            group.create_dataset('indptr', data=matrix.indptr.astype(np.int64))
+        elif layout == 'dense':
+            if compression is None:
+                values = group.create_dataset('values', shape=matrix.shape, dtype=np.float32)
+            else:
+                rows = max(1, min(block_rows, n_rows, 2**20 // max(n_columns, 1)))
+                values = group.create_dataset('values', shape=matrix.shape, dtype=np.float32,
+                                              chunks=(rows, max(n_columns, 1)), **options)
+            for start in xrange(0, n_rows, block_rows):
+                block = matrix[start:start+block_rows]
+                values[start:start+block_rows] = block.toarray() if issparse(block) else block
+        else:
+            fh.close()
+            raise ValueError("Feature layout {} is undefined".format(layout))
+        group.attrs['format'] = 'blocks'
+        group.attrs['layout'] = layout
+        group.attrs['shape'] = (n_rows, n_columns)
+        group.attrs['block_rows'] = block_rows
+        fh.close()
+        log.debug("Succesfully pushed {} features {} to ML_input hdf5".format(
+            layout, (n_rows, n_columns)))
 
     def get_features(self):
         """
-        This will push the annotation dataframe
+        This will get the feature dataframe (dense, see iter_batches to stream it)
         """
         self.__check_file_schema()
         schema = self.__make_schema()
-        DF = self.pull_DataFrame(path = schema['Feature_DF'])
+        fh = h5py.File(self.filepath, 'r')
+        group = fh[schema['Feature_DF']]
+        if group.attrs.get('format') != 'blocks':
+            fh.close()
+            DF = self.pull_DataFrame(path = schema['Feature_DF'])
+        else:
+            index, columns = self._pull_labels(group, 'index'), self._pull_labels(group, 'columns')
+            matrix = self.__read_rows(group, 0, len(index))
+            fh.close()
+            DF = pd.DataFrame(matrix.toarray() if issparse(matrix) else matrix,
+                              index=index, columns=columns)
         log.debug("Succesfully retrived feature dataframe: {}".format(DF.head()))
         return DF
-        
+
+    def iter_batches(self, batch_size=256, shuffle=False, seed=0):
+        """
+        Yields (index <pd.Index> of the cases, features) of batch_size rows at a time,
+        features is a float32 array (dense layout) or csr_matrix (sparse layout)
+
+        Rows are read one block at a time, shuffle visits the blocks in random order
+        and shuffles the rows of every block (seeded with seed). Without shuffle the
+        batches of a memory mapped layout are views of the file (see get_memmap)
+        """
+        schema = self.__make_schema()
+        fh = h5py.File(self.filepath, 'r')
+        try:
+            group = fh[schema['Feature_DF']]
+            if group.attrs.get('format') != 'blocks':
+                raise ValueError("Features in {} are not stored in row blocks".format(
+                    self.filepath))
+            index = self._pull_labels(group, 'index')
+            block_rows = int(group.attrs['block_rows'])
+            memmap = self.__memmap(group)
+            if memmap is not None and not shuffle:
+                for start in xrange(0, len(index), batch_size):
+                    yield index[start:start+batch_size], memmap[start:start+batch_size]
+                return
+
+            starts = np.arange(0, len(index), block_rows)
+            rs = np.random.RandomState(seed)
+            if shuffle:
+                rs.shuffle(starts)
+            rows, blocks, n_buffered = [], [], 0
+            for start in starts:
+                stop = min(start + block_rows, len(index))
+                if memmap is not None:
+                    block = memmap[start:stop]
+                else:
+                    block = self.__read_rows(group, start, stop)
+                order = np.arange(start, stop)
+                if shuffle:
+                    permutation = rs.permutation(stop - start)
+                    order, block = order[permutation], block[permutation]
+                rows.append(order)
+                blocks.append(block)
+                n_buffered += stop - start
+                while n_buffered >= batch_size:
+                    batch_rows, batch, rows, blocks = self.__split_batch(rows, blocks,
+                                                                         batch_size)
+                    n_buffered -= batch_size
+                    yield index[batch_rows], batch
+            if n_buffered > 0:
+                batch_rows, batch, rows, blocks = self.__split_batch(rows, blocks, n_buffered)
+                yield index[batch_rows], batch
+        finally:
+            fh.close()
+
+    def get_memmap(self):
+        """
+        Returns a read-only np.memmap of the features <float32 rows x bins> stored with
+        layout='dense' and compression=None (the data is not copied)
+        """
+        schema = self.__make_schema()
+        fh = h5py.File(self.filepath, 'r')
+        try:
+            memmap = self.__memmap(fh[schema['Feature_DF']])
+        finally:
+            fh.close()
+        if memmap is None:
+            raise ValueError("Features in {} are not contiguous dense float32".format(
+                self.filepath))
+        return memmap
+
+    def __memmap(self, group):
+        """ np.memmap of a contiguous dense feature layout or None """
+        if group.attrs.get('format') != 'blocks' or group.attrs['layout'] != 'dense':
+            return None
+        values = group['values']
+        offset = values.id.get_offset()
+        if values.chunks is not None or values.compression is not None or offset is None:
+            return None
+        return np.memmap(self.filepath, mode='r', dtype=values.dtype, shape=values.shape,
+                         offset=offset)
+
+    def __read_rows(self, group, start, stop):
+        """ Returns rows start:stop of the stored features """
+        if group.attrs['layout'] == 'dense':
+            return group['values'][start:stop]
+        indptr = group['indptr'][start:stop+1]
+        return csr_matrix((group['data'][indptr[0]:indptr[-1]],
+                           group['indices'][indptr[0]:indptr[-1]], indptr - indptr[0]),
+                          shape=(stop - start, int(group.attrs['shape'][1])))
+
+    def __split_batch(self, rows, blocks, size):
+        """ Takes size rows off the front of the buffered rows and blocks """
+        rows = np.concatenate(rows)
+        if issparse(blocks[0]):
+            blocks = vstack(blocks, format='csr')
+        else:
+            blocks = np.concatenate(blocks)
+        return rows[:size], blocks[:size], [rows[size:]], [blocks[size:]]
+
     def __check_file_schema(self):
         """
         This checks to make sure the base schema of the input HDF5 file matches
@@ -1,6 +1,9 @@
 import glob
 from os.path import splitext, split, join
 
+from FlowAnal.FCS_subroutines.Event_Cache import Event_Cache
+from FlowAnal.FCS_subroutines.Singlet_Model_Cache import Singlet_Model_Cache
+
 
 def itermodules(subcommands_path, root=__name__):
 
@@ -48,3 +51,40 @@ def add_filter_args(parser):
 
 
 
+def add_cache_args(parser):
+    """ Adds the processed event cache arguments to parser """
+
+    parser.add_argument('-cache', '--event-cache', dest='event_cache',
+                        help='Directory of the processed event cache (files are only \
+                        compensated and gated once for the same settings) [default: no cache]',
+                        default=None, type=str)
+    parser.add_argument('--cache-size', dest='cache_size',
+                        help='Maximum size of the processed event cache in GB [default: 10]',
+                        default=10, type=float)
+
+
+def make_event_cache(args):
+    """ Returns the Event_Cache described by args (see add_cache_args) or None """
+    if args.event_cache is None:
+        return None
+    return Event_Cache(args.event_cache, max_size=int(args.cache_size * 2**30))
+
+
+def add_singlet_cache_args(parser):
+    """ Adds the auto singlet model cache arguments to parser """
+
+    parser.add_argument('--singlet-cache', dest='singlet_model_cache',
+                        help='Directory of the auto singlet model cache (fits are warm started \
+                        from the model of the same cytometer and date window) [default: no cache]',
+                        default=None, type=str)
+    parser.add_argument('--singlet-window', dest='singlet_window',
+                        help='Number of days of acquisition dates sharing a cached singlet \
+                        model [default: 30]',
+                        default=30, type=int)
+
+
+def make_singlet_cache(args):
+    """ Returns the Singlet_Model_Cache described by args (see add_singlet_cache_args) or None """
+    if args.singlet_model_cache is None:
+        return None
+    return Singlet_Model_Cache(args.singlet_model_cache, window_days=args.singlet_window)
@@ -20,7 +20,7 @@ import shutil
 from FlowAnal.Analysis_Variables import gate_coords, comp_file
 from FlowAnal.FCS import FCS
 from FlowAnal.database.FCS_database import FCSdatabase
-from __init__ import add_filter_args
+from __init__ import add_filter_args, add_cache_args, make_event_cache
 
 log = logging.getLogger(__name__)
 
@@ -41,6 +41,7 @@ def build_parser(parser):
     parser.add_argument('-n', '--n', help='Limit to n files (for testing)', default=None,
                         type=int)
     add_filter_args(parser)
+    add_cache_args(parser)
 
 
 def action(args):
@@ -56,18 +57,21 @@ def action(args):
     # Create query
     q = db.query(exporttype='dict_dict', getfiles=True, **vars(args))
 
+    cache = make_event_cache(args)
+
     n = 0
     done = False
     for case, case_info in q.results.items():
         for case_tube_idx, relpath in case_info.items():
             log.info("Case: %s, Case_tube_idx: %s, File: %s" % (case, case_tube_idx, relpath))
             filepath = path.join(args.dir, relpath)
-            fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx, import_dataframe=True)
+            fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx)
 
             try:
                 fFCS.comp_scale_FCS_data(compensation_file=comp_file,
                                          gate_coords=gate_coords,
-                                         strict=False, auto_comp=False, **vars(args))
+                                         strict=False, auto_comp=False, cache=cache,
+                                         **vars(args))
                 fFCS.extract_FCS_histostats()
             except:
                 fFCS.flag = 'stats_extraction_fail'
@@ -51,7 +51,8 @@ def action(args):
 
     # Get features
     Feature_obj = Feature_IO(filepath=args.feature_fp, clobber=False)
-    features_df, not_in_cti, merge_fail_cti = Feature_obj.make_single_tube_analysis(case_tube_list)
+    features_df, bin_num, not_in_cti, merge_fail_cti = \
+        Feature_obj.make_single_tube_analysis(case_tube_list, dense=True)
     log.debug("Feature DF: {} \n Case_tube_indices that failed: {}".format(
                                            features_df.head(), merge_fail_cti))
 
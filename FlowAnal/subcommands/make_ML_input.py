@@ -81,22 +81,24 @@ def action(args):
     exclusions_dic['excluded_by_DB_query'] = list(cases_to_consider - case_list)
     log.debug(exclusions_dic)
 
-    # Get features [assuming that features are returned in order!]
-    features_df, not_in_data, merge_fail = HDF_feature_obj.make_single_tube_analysis(case_tube_index_list)
-    features_df.set_index('bin_num', drop=True, inplace=True)
-    features_df.columns = case_list
-    features_df = features_df.T
-    log.debug(features_df.head())
+    # Get features [returned in order, without the tubes that failed to merge]
+    features, bin_num, not_in_data, merge_fail = \
+        HDF_feature_obj.make_single_tube_analysis(case_tube_index_list)
+    log.debug("Features of {} cases in {} bins".format(*features.shape))
+    cti_case = dict(zip(case_tube_index_list, q.results.case_number.tolist()))
+    dropped = set(int(i) for i in not_in_data + merge_fail)
+    exclusions_dic['merge_failure'] = [cti_case[i] for i in merge_fail]
+    merged_cases = [cti_case[i] for i in case_tube_index_list if int(i) not in dropped]
 
     # Get annotations [ordered by case_tube_idx]
-    annotation_df = ann.loc[list(case_list), :]
+    annotation_df = ann.loc[merged_cases, :]
     log.debug(annotation_df.head())
 
-    # Send features_df, annotation_df, and exclusions to ML_input_HDF5 (args.ml_hdf5_fp)
+    # Send features, annotation_df, and exclusions to ML_input_HDF5 (args.ml_hdf5_fp)
     Merged_ML_feat_obj = MergedFeatures_IO(filepath=args.ml_hdf5_fp,
                                            clobber=True)
 
-    Merged_ML_feat_obj.push_features(features_df)
+    Merged_ML_feat_obj.push_features(features, index=merged_cases, columns=bin_num)
     Merged_ML_feat_obj.push_annotations(annotation_df)
     Merged_ML_feat_obj.push_not_found(exclusions_dic)  # exclusions is a dictionary
 
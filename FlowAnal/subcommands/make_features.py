@@ -22,9 +22,10 @@ from itertools import chain
 from os import path
 from sqlalchemy.exc import IntegrityError
 
-from __init__ import add_filter_args
+from __init__ import add_filter_args, add_cache_args, make_event_cache
 
 from FlowAnal.FCS import FCS
+from FlowAnal.FCS_subroutines.Cell_Dictionary import Cell_Dictionary
 from FlowAnal.database.FCS_database import FCSdatabase
 from FlowAnal.Feature_IO import Feature_IO
 from FlowAnal.Analysis_Variables import gate_coords, comp_file
@@ -42,11 +43,18 @@ def build_parser(parser):
     [default: db/fcs_features.hdf5]', dest='hdf5_fp',
                         default="db/fcs_features.hdf5", type=str)
     parser.add_argument('-method', '--feature-extration-method',
-                        help='The method to use to extract features [default: Full]',
+                        help='The method to use to extract features, Full or Sparse \
+                        (columns of the occupied cells of the cohort) or Pyramid (Full and \
+                        2D features at every --levels resolution) [default: Full]',
                         default='Full', type=str, dest='feature_extraction_method')
+    parser.add_argument('-levels', '--levels', help='Bins per channel of each level of the \
+    Pyramid method [default: 5 8 10]', default=[5, 8, 10], type=int, nargs='+')
     parser.add_argument('-ow','--overwrite',help='Overwrite Feature-hdf5 file',type=bool,
                          default=True, dest='clobber')
+    parser.add_argument('-batch-size', '--batch-size', help='Number of tubes buffered before \
+    features are written to the hdf5 file [default: 1000]', default=1000, type=int)
     add_filter_args(parser)
+    add_cache_args(parser)
 
 
 def action(args):
@@ -60,51 +68,64 @@ def action(args):
     # Create query
     q = db.query(exporttype='dict_dict', getfiles=True, **vars(args))
 
+    # processed event cache (None if not requested)
+    cache = make_event_cache(args)
+
     # Create HDF5 object
     HDF_obj = Feature_IO(filepath=args.hdf5_fp, clobber=args.clobber)
 
+    # cells shared by all tubes for sparse features (extended if the file already has one)
+    cell_dictionary = None
+    if args.feature_extraction_method.lower() == 'sparse':
+        try:
+            cell_dictionary = HDF_obj.get_cell_dictionary()
+        except (IOError, KeyError):
+            cell_dictionary = Cell_Dictionary()
+    bins = args.levels if args.feature_extraction_method.lower() == 'pyramid' else 10
+
     # initalize empty list to append case_tube_idx that failed feature extraction
     feature_failed_CTIx = []
 
     num_results = len(list(chain(*q.results.values())))
     i = 1
     log.info("Found {} case_tube_idx's".format(num_results))
-    for case, case_info in q.results.items():
-        for case_tube_idx, relpath in case_info.items():
-            # this nested for loop iterates over all case_tube_idx
-            log.info("Case: %s, Case_tube_idx: %s, File: %s [%s of %s]" %
-                     (case, case_tube_idx, relpath, i, num_results))
-            filepath = path.join(args.dir, relpath)
-            fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx, import_dataframe=True)
-
-            try:
-                fFCS.comp_scale_FCS_data(compensation_file=comp_file,
-                                         gate_coords=gate_coords,
-                                         rescale_lim=(-0.5, 1),
-                                         strict=False, auto_comp=False)
-                fFCS.feature_extraction(extraction_type=args.feature_extraction_method,
-                                        bins=10)
-                HDF_obj.push_fcs_features(case_tube_idx=case_tube_idx,
-                                          FCS=fFCS, db=db)
-            except ValueError, e:
-                print("Skipping feature extraction for case: {} because of 'ValueError {}'".
-                      format(case, str(e)))
-            except KeyError, e:
-                print "Skipping FCS %s because of KeyError: %s" % (filepath, str(e))
-            except IntegrityError, e:
-                print "Skipping Case: {}, Tube: {}, Date: {}, filepath: {} because \
-                of IntegrityError: {}".format(case, case_tube_idx, filepath, str(e))
-            except:
-                print "Skipping FCS %s because of unknown error related to: %s" % \
-                    (filepath, sys.exc_info()[0])
-                e = sys.exc_info()[0]
-
-            print("{:6d} of {} cases found and loaded\r".format(i, num_results)),
-            if 'e' in locals():
-                feature_failed_CTIx.append([case, case_tube_idx, e])
-                del(e)
-
-            i += 1
+    # one writer session, features are written to the hdf5 file in batches
+    with HDF_obj.writer(db=db, batch_size=args.batch_size) as writer:
+        for case, case_info in q.results.items():
+            for case_tube_idx, relpath in case_info.items():
+                # this nested for loop iterates over all case_tube_idx
+                log.info("Case: %s, Case_tube_idx: %s, File: %s [%s of %s]" %
+                         (case, case_tube_idx, relpath, i, num_results))
+                filepath = path.join(args.dir, relpath)
+                fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx)
+
+                try:
+                    fFCS.comp_scale_FCS_data(compensation_file=comp_file,
+                                             gate_coords=gate_coords,
+                                             rescale_lim=(-0.5, 1),
+                                             strict=False, auto_comp=False, cache=cache)
+                    fFCS.feature_extraction(extraction_type=args.feature_extraction_method,
+                                            bins=bins, cell_dictionary=cell_dictionary)
+                    writer.push(case_tube_idx=case_tube_idx, FCS=fFCS)
+                except ValueError, e:
+                    print("Skipping feature extraction for case: {} because of 'ValueError {}'".
+                          format(case, str(e)))
+                except KeyError, e:
+                    print "Skipping FCS %s because of KeyError: %s" % (filepath, str(e))
+                except IntegrityError, e:
+                    print "Skipping Case: {}, Tube: {}, Date: {}, filepath: {} because \
+                    of IntegrityError: {}".format(case, case_tube_idx, filepath, str(e))
+                except:
+                    print "Skipping FCS %s because of unknown error related to: %s" % \
+                        (filepath, sys.exc_info()[0])
+                    e = sys.exc_info()[0]
+
+                print("{:6d} of {} cases found and loaded\r".format(i, num_results)),
+                if 'e' in locals():
+                    feature_failed_CTIx.append([case, case_tube_idx, e])
+                    del(e)
+
+                i += 1
 
     if feature_failed_CTIx == []:
         # if no features failed, we will create a dummy dataframe to load
@@ -122,4 +143,11 @@ def action(args):
 
     HDF_obj.push_failed_cti_list(failed_DF)
 
+    if cell_dictionary is not None:
+        log.info("Sparse features index {} occupied cells".format(len(cell_dictionary)))
+        HDF_obj.push_cell_dictionary(cell_dictionary)
+
+    if cache is not None:
+        log.info("Processed event cache: {} hits, {} misses".format(cache.hits, cache.misses))
+
 
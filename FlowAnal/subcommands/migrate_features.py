@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Converts a feature HDF5 file to the concatenated feature layout
+
+Files written by earlier versions hold one group per case_tube_idx, the converted file
+holds the features of every level in a few concatenated datasets (see Feature_IO)
+"""
+
+__author__ = "David Ng, MD"
+__copyright__ = "Copyright 2014"
+__license__ = "GPL v3"
+__version__ = "1.0"
+__maintainer__ = "David Ng"
+__email__ = "ngdavid@uw.edu"
+__status__ = "Production"
+
+import logging
+
+from FlowAnal.Feature_IO import Feature_IO
+
+log = logging.getLogger(__name__)
+
+
+def build_parser(parser):
+    parser.add_argument('-feature-hdf5', '--feature-hdf5', help='Input hdf5 filepath for FCS \
+    features [default: db/fcs_features.hdf5]', dest='hdf5_fp',
+                        default="db/fcs_features.hdf5", type=str)
+    parser.add_argument('-out', '--out', help='Output hdf5 filepath for the converted FCS \
+    features (must not exist) [required]', dest='out_fp', required=True, type=str)
+    parser.add_argument('-batch-size', '--batch-size', help='Number of tubes converted per \
+    write [default: 1000]', default=1000, type=int)
+
+
+def action(args):
+    log.info('Converting feature file [%s] to [%s]' % (args.hdf5_fp, args.out_fp))
+    HDF_obj = Feature_IO(filepath=args.hdf5_fp, clobber=False)
+    out = HDF_obj.migrate_layout(args.out_fp, batch_size=args.batch_size)
+    log.info("Converted {} case_tube_idx's".format(len(out.get_case_tube_idxs())))
@@ -20,8 +20,10 @@ from multiprocessing import Pool
 
 from FlowAnal.Analysis_Variables import gate_coords, comp_file
 from FlowAnal.FCS import FCS
+from FlowAnal.FCS_subroutines.Process_FCS_Data import warm_compensation_cache
 from FlowAnal.database.FCS_database import FCSdatabase
-from __init__ import add_filter_args
+from __init__ import (add_filter_args, add_cache_args, make_event_cache,
+                      add_singlet_cache_args, make_singlet_cache)
 
 log = logging.getLogger(__name__)
 
@@ -44,19 +46,38 @@ def build_parser(parser):
                         default=False)
     parser.add_argument('--noviability', help='Turn off the singlet gate', action='store_true',
                         default=False)
+    parser.add_argument('--singlet_flag', help='Singlet gate mode [default: fixed]',
+                        default='fixed', type=str)
+    parser.add_argument('--singlet_method', help='Auto singlet method [gmm or grid]',
+                        default='gmm', type=str)
     parser.add_argument('-t', '--testing', help='Testing: run one load of workers',
                         default=False, action='store_true')
 
     add_filter_args(parser)
+    add_cache_args(parser)
+    add_singlet_cache_args(parser)
+
+
+def cache_counts(kwargs):
+    """ Returns the [hits, misses] of the event and singlet model caches in kwargs """
+    counts = []
+    for name in ['cache', 'singlet_cache']:
+        cache = kwargs.get(name, None)
+        counts.append([cache.hits, cache.misses] if cache is not None else [0, 0])
+    return counts
 
 
 def worker(in_list, **kwargs):
     """
     Still need to work on handling of cases that did not extract correctly
+
+    Returns the FCS object and the [hits, misses] of the caches on this case_tube
+    (the caches are copies in the worker, their counts are collected by action)
     """
     filepath = in_list[0]
     case_tube_idx = in_list[1]
-    fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx, import_dataframe=True)
+    before = cache_counts(kwargs)
+    fFCS = FCS(filepath=filepath, case_tube_idx=case_tube_idx)
     try:
         fFCS.comp_scale_FCS_data(compensation_file=comp_file,
                                  gate_coords=gate_coords,
@@ -67,7 +88,9 @@ def worker(in_list, **kwargs):
         fFCS.flag = 'stats_extraction_fail'
         fFCS.error_message = str(sys.exc_info()[0])
 
-    return fFCS
+    counts = [[after - start for after, start in zip(*pair)]
+              for pair in zip(cache_counts(kwargs), before)]
+    return fFCS, counts
 
 
 def action(args):
@@ -97,18 +120,23 @@ def action(args):
 
     # Setup args
     vargs = {key: value for key, value in vars(args).items()
-             if key in ['nosinglet', 'noviability']}
+             if key in ['nosinglet', 'noviability', 'singlet_flag', 'singlet_method']}
+    vargs['cache'] = make_event_cache(args)
+    vargs['singlet_cache'] = make_singlet_cache(args)  # shared by the workers through its directory
 
     i = 0
+    totals = [[0, 0], [0, 0]]  # [hits, misses] of the event and singlet model caches
     for sublist in sublists:
-        p = Pool(args.workers)
+        p = Pool(args.workers, initializer=warm_compensation_cache, initargs=(comp_file, ))
         results = [p.apply_async(worker, args=(case_info, ), kwds=vargs)
                    for case_info in sublist]
         p.close()
 
         for f in results:
             i += 1
-            fFCS = f.get()
+            fFCS, counts = f.get()
+            totals = [[t + c for t, c in zip(total, count)]
+                      for total, count in zip(totals, counts)]
             fFCS.histostats_to_db(db=out_db)
             del fFCS
             print "Case_tubes: {} of {} have been processed\r".format(i, len(q_list)),
@@ -116,3 +144,8 @@ def action(args):
 
         if args.testing is True:
             break  # run loop once then break if testing
+
+    if vargs['cache'] is not None:
+        log.info("Processed event cache: {} hits, {} misses".format(*totals[0]))
+    if vargs['singlet_cache'] is not None:
+        log.info("Singlet model cache: {} hits, {} misses".format(*totals[1]))
@@ -20,7 +20,7 @@ import shutil
 from FlowAnal.Analysis_Variables import gate_coords, comp_file
 from FlowAnal.FCS import FCS
 from FlowAnal.database.FCS_database import FCSdatabase
-from __init__ import add_filter_args
+from __init__ import add_filter_args, add_singlet_cache_args, make_singlet_cache
 
 log = logging.getLogger(__name__)
 
@@ -43,7 +43,21 @@ def build_parser(parser):
                         help='Viablity gate mode', 
                         default="Fixed",
                         type=str)
+    parser.add_argument('--singlet_method',
+                        help='Auto singlet method [gmm or grid]',
+                        default='grid',
+                        type=str)
+    parser.add_argument('--singlet_compare',
+                        help='Auto singlet method to report singlet agreement with \
+                        [default: gmm]',
+                        default='gmm',
+                        type=str)
+    parser.add_argument('--singlet_seed',
+                        help='Seed of the auto singlet fit',
+                        default=0,
+                        type=int)
     add_filter_args(parser)
+    add_singlet_cache_args(parser)
 
 def action(args):
 
@@ -54,6 +68,8 @@ def action(args):
     # Create query
     q = db.query(exporttype='dict_dict', getfiles=True, **vars(args))
 
+    singlet_cache = make_singlet_cache(args)
+
     n = 0
     done = False
     for case, case_info in q.results.items():
@@ -66,10 +82,18 @@ def action(args):
                 fFCS.comp_scale_FCS_data(compensation_file=comp_file,gate_coords=gate_coords,
                               strict=False, rescale_lim=(-0.5,1.0),
                               classes=5,singlet_verbose=True,
+                              singlet_cache=singlet_cache,
                               **vars(args))
                 
             except:
                 log.debug("Comp Scale failed")
                 fFCS.flag = 'stats_extraction_fail'
                 fFCS.error_message = str(sys.exc_info()[0])
-                print(
+                print("Comp Scale failed for %s: %s" % (relpath, fFCS.error_message))
+                continue
+
+            if hasattr(fFCS, 'singlet_agreement'):
+                print("%s\t%s singlets: %d\tagreement with %s: %.4f" %
+                      (case_tube_idx, args.singlet_method, fFCS.singlet_remain,
+                       args.singlet_compare, fFCS.singlet_agreement))
+
@@ -11,7 +11,7 @@ from os import path
 from FlowAnal.database.FCS_database import FCSdatabase
 from FlowAnal.FCS import FCS
 from FlowAnal.__init__ import package_data
-from __init__ import add_filter_args
+from __init__ import add_filter_args, add_cache_args, make_event_cache
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +34,7 @@ def build_parser(parser):
     parser.add_argument('-n', '--n_files', help='For testing purposes only find N files',
                         default=None, type=int)
     add_filter_args(parser)
+    add_cache_args(parser)
 
 
 def action(args):
@@ -43,6 +44,8 @@ def action(args):
     # Create query
     q = db.query(exporttype='dict_dict', getfiles=True, **vars(args))
 
+    cache = make_event_cache(args)
+
     i = 0
     done = False
     for case, case_info in q.results.items():
@@ -50,10 +53,10 @@ def action(args):
             log.info("Case: %s, Case_tube_idx: %s, File: %s" % (case, case_tube_idx, relpath))
             filepath = path.join(args.dir, relpath)
 
-            a = FCS(filepath=filepath, import_dataframe=True)
+            a = FCS(filepath=filepath)
             a.comp_scale_FCS_data(compensation_file=comp_file,
                                   gate_coords=coords,
-                                  strict=False, auto_comp=False)
+                                  strict=False, auto_comp=False, cache=cache)
             outfile = 'output/' + '_'.join([case, str(case_tube_idx),
                                             a.case_tube.replace(' ', '_'),
                                             a.date.strftime("%Y%m%d")]) + '.png'
@@ -13,6 +13,20 @@ import pickle
 
 from __init__ import TestBase, datadir, write_csv
 from FlowAnal.FCS import FCS
+from FlowAnal.FCS_subroutines.Event_Cache import Event_Cache
+from FlowAnal.FCS_subroutines.Event_Store import Event_Store
+from FlowAnal.FCS_subroutines.Logicle_Transform import get_logicle_transform
+from FlowAnal.FCS_subroutines.Compiled_Gate import compile_gate
+from FlowAnal.FCS_subroutines.Cell_Dictionary import Cell_Dictionary
+from FlowAnal.FCS_subroutines.Auto_Singlet import GMM_doublet_detection
+from FlowAnal.FCS_subroutines.Auto_Comp_Tweak import Auto_Comp_Tweak
+from FlowAnal.FCS_subroutines.Singlet_Model_Cache import Singlet_Model_Cache
+from FlowAnal.FCS_subroutines.Extract_HistoStats import (histogram_counts, quantiles,
+                                                         Quantile_Sketch)
+from FlowAnal.FCS_subroutines import Process_FCS_Data
+from FlowAnal.FCS_subroutines import Singlet_Model_Cache as singlet_model_cache
+from matplotlib.path import Path
+from scipy.stats import pearsonr
 from FlowAnal.database.FCS_database import FCSdatabase
 from FlowAnal.__init__ import package_data, __version__
 from FlowAnal.Analysis_Variables import gate_coords, comp_file, test_fcs_fn
@@ -25,6 +39,31 @@ def data(fname):
     return path.join(datadir, fname)
 
 
+def write_fcs(filepath, records, datatype, byteord, ranges=None):
+    """
+    Writes a minimal listmode FCS 3.0 file of records <structured numpy array>,
+    one field per parameter (the field dtypes give $PnB)
+    """
+    fields = records.dtype.names
+    text = [('$BYTEORD', byteord), ('$DATATYPE', datatype), ('$MODE', 'L'),
+            ('$PAR', str(len(fields))), ('$TOT', str(len(records))), ('$NEXTDATA', '0'),
+            ('$CYT', 'LSRII'), ('$CYTNUM', 'H0152'), ('$DATE', '05-JAN-2012'),
+            ('$ETIM', '12:00:00')]
+    for i, field in enumerate(fields, 1):
+        text += [('$P{}N'.format(i), field),
+                 ('$P{}B'.format(i), str(8 * records.dtype[field].itemsize))]
+        if ranges is not None:
+            text += [('$P{}R'.format(i), str(ranges[i - 1]))]
+    text = '/' + '/'.join('{}/{}'.format(k, v) for k, v in text) + '/'
+    raw = records.tobytes()
+    text_start = 58
+    data_start = text_start + len(text)
+    header = 'FCS3.0    ' + ''.join('%8d' % v for v in [
+        text_start, data_start - 1, data_start, data_start + len(raw) - 1, 0, 0])
+    with open(filepath, 'wb') as fh:
+        fh.write(header + text + raw)
+
+
 class Test_FCS(TestBase):
     """ Test FCS subpackage """
 
@@ -61,10 +100,65 @@ class Test_FCS(TestBase):
             self.assertEqual(a.num_events, header_info['num_events'])
             #            self.assertEqual(a.version, header_info['version'])
             self.assertTrue(hasattr(a, 'data'))
+            self.assertEqual(a.data.values.dtype, np.float32)
 
             parameters = pd.read_pickle(data('parameter_info.pkl'))
             assert_frame_equal(a.parameters, parameters)
 
+    def test_loadFCS_subset(self):
+        """ Testing column and event selective loading of FCS data """
+
+        filepath = data(test_fcs_fn)
+        a = FCS(filepath=filepath, import_dataframe=True)
+        cols = ['FSC-A', 'FSC-H']
+
+        b = FCS(filepath=filepath, columns=cols, max_events=1000)
+        self.assertEqual(list(b.data.columns), cols)
+        self.assertEqual(b.data.shape, (1000, 2))
+        self.assertEqual(b.num_events, a.num_events)
+        rows = np.arange(1000) * a.num_events / 1000
+        np.testing.assert_array_equal(b.data.values, a.data[cols].values[rows])
+
+        c = FCS(filepath=filepath, max_events=1000, sample='random', seed=0)
+        d = FCS(filepath=filepath, max_events=1000, sample='random', seed=0)
+        self.assertEqual(c.data.shape, (1000, a.data.shape[1]))
+        np.testing.assert_array_equal(c.data.values, d.data.values)
+
+    def test_loadFCS_datatypes(self):
+        """ Testing decoding of integer (I) and double (D) DATA segments """
+
+        outdir = self.mkoutdir()
+        values = np.array([[0, 1, 2], [255, 1023, 4095], [17, 300, 70000]])
+        cases = [('I', '1', '|u1', [256] * 3, None),
+                 ('I', '1,2', '<u2', [1024] * 3, [[0, 1, 2], [255, 1023, 4095 & 1023],
+                                                  [17, 300, 70000 & 1023]]),
+                 ('I', '2,1', '>u2', None, None),
+                 ('I', '4,3,2,1', '>u4', [262144] * 3, None),
+                 ('I', '1,2,3,4', '<u4', [1024, 4096, 65536], [[0, 1, 2], [255, 1023, 4095],
+                                                                [17, 300, 70000 & 65535]]),
+                 ('D', '4,3,2,1', '>f8', None, None),
+                 ('D', '1,2,3,4', '<f8', None, None)]
+        for datatype, byteord, dtype, ranges, expected in cases:
+            records = np.zeros(len(values), dtype=[('FSC-A', dtype), ('FSC-H', dtype),
+                                                   ('CD45 APC-H7', dtype)])
+            for j, field in enumerate(records.dtype.names):
+                records[field] = values[:, j] if dtype != '|u1' else values[:, j] % 256
+            if expected is None:
+                expected = [[records[f][k] for f in records.dtype.names]
+                            for k in range(len(records))]
+            filepath = path.join(outdir, '12-00031_{}{}.fcs'.format(datatype,
+                                                                    byteord.replace(',', '')))
+            write_fcs(filepath, records, datatype, byteord, ranges)
+
+            a = FCS(filepath=filepath, import_dataframe=True)
+            self.assertEqual(list(a.data.columns), ['FSC-A', 'FSC-H', 'CD45 APC-H7'])
+            self.assertEqual(a.data.values.dtype, np.float32)
+            np.testing.assert_array_equal(a.data.values, np.array(expected, dtype=np.float32))
+
+            b = FCS(filepath=filepath, columns=['CD45 APC-H7'], max_events=2)
+            np.testing.assert_array_equal(b.data.values.ravel(),
+                                          np.array(expected, dtype=np.float32)[[0, 1], 2])
+
     def test_feature_extraction(self):
         """ tests ND_Feature_Extraction """
         filepath = data(test_fcs_fn)
@@ -94,6 +188,47 @@ class Test_FCS(TestBase):
             np.testing.assert_allclose(out_coords.values,test_coords.values)
             np.testing.assert_allclose(binned_data.histogram.data,test_histogram.data)
 
+    def test_feature_extraction_edges(self):
+        """ tests that ND binning puts 1.0 in the last bin and counts repeated bins """
+        a = FCS(filepath=data(test_fcs_fn))
+        a.data = pd.DataFrame([[0.0, 0.0], [0.95, 1.0], [1.0, 0.99], [0.05, 0.0]],
+                              columns=['CD15 FITC', 'CD33 PE'])
+        a.feature_extraction(extraction_type='FULL', bins=10, normalize=False)
+
+        histogram = a.FCS_features.histogram
+        self.assertEqual(histogram.shape, (1, 100))
+        np.testing.assert_array_equal(histogram.indices, [0, 99])
+        np.testing.assert_array_equal(histogram.data, [2, 2])
+
+    def test_sparse_feature_extraction(self):
+        """ tests that sparse ND features index cells shared across tubes """
+        cell_dictionary = Cell_Dictionary()
+        a = FCS(filepath=data(test_fcs_fn))
+        a.data = pd.DataFrame([[0.0, 0.0], [0.95, 1.0], [1.0, 0.99], [0.05, 0.0]],
+                              columns=['CD15 FITC', 'CD33 PE'])
+        a.feature_extraction(extraction_type='Sparse', bins=10, normalize=False,
+                             cell_dictionary=cell_dictionary)
+        b = FCS(filepath=data(test_fcs_fn))
+        b.data = pd.DataFrame([[0.5, 0.5], [0.99, 0.95]], columns=['CD15 FITC', 'CD33 PE'])
+        b.feature_extraction(extraction_type='Sparse', bins=10, normalize=False,
+                             cell_dictionary=cell_dictionary)
+
+        self.assertEqual(a.FCS_features.type, 'Sparse')
+        self.assertEqual(len(cell_dictionary), 3)
+        np.testing.assert_array_equal(a.FCS_features.histogram.indices, [0, 1])
+        np.testing.assert_array_equal(a.FCS_features.histogram.data, [2, 2])
+        np.testing.assert_array_equal(b.FCS_features.histogram.indices, [1, 2])
+        np.testing.assert_array_equal(cell_dictionary.coordinates([1, 2]), [[9, 9], [5, 5]])
+        self.assertEqual(a.FCS_features.histogram.shape, b.FCS_features.histogram.shape)
+
+        # coordinates that do not pack into 64 bits are keyed on their bytes
+        wide = Cell_Dictionary(pd.Series([2**16] * 5, index=list('abcde')))
+        self.assertFalse(wide.packed)
+        ids, counts = wide.lookup([[1, 2, 3, 4, 5], [1, 2, 3, 4, 5], [0, 0, 0, 0, 2**16 - 1]])
+        np.testing.assert_array_equal(counts[np.argsort(ids)], [1, 2])
+        rebuilt = Cell_Dictionary.from_coordinates(wide.bin_description, wide.coordinates())
+        np.testing.assert_array_equal(rebuilt.lookup([[1, 2, 3, 4, 5]])[0], [ids.max()])
+
     def test_2d_feature_extraction(self):
         """ tests 2D_Feature_Extraction """
 
@@ -118,6 +253,21 @@ class Test_FCS(TestBase):
             f.close()
             np.testing.assert_allclose(binned_data.histogram.data,test_histogram.data)
 
+    def test_2d_feature_extraction_pairs(self):
+        """ tests 2D binning against np.histogram2d on selected pairs and range edges """
+        a = FCS(filepath=data(test_fcs_fn))
+        a.data = pd.DataFrame({'CD15 FITC': [0.0, 0.5, 1.0, 1.2, -0.1, np.nan],
+                               'CD33 PE': [1.0, 0.25, 1.0, 0.5, 0.5, 0.5],
+                               'CD45 ECD': [0.3] * 6}, dtype=np.float32)
+        pairs = [('CD45 ECD', 'CD15 FITC'), ('CD15 FITC', 'CD33 PE')]
+        a.feature_extraction(extraction_type='2d', bins=4, pairs=pairs,
+                             normalize=False, output='dense')
+
+        expected = [np.histogram2d(a.data[x], a.data[y], bins=(4, 4),
+                                   range=[[0, 1], [0, 1]])[0].ravel() for x, y in pairs]
+        np.testing.assert_array_equal(a.FCS_features.histogram,
+                                      np.concatenate(expected).reshape(1, -1))
+
     def test_empty_FCS(self):
         """ Testing loading FCS filepath that does not load properly ==> empty """
 
@@ -198,6 +348,75 @@ class Test_FCS(TestBase):
                                        rtol=1e-3, atol=0, err_msg="FCS Data results are more \
                                        different than tolerable")
 
+    def test_logicle_transform(self):
+        """ Tests the memoized logicle transform and its inverse """
+
+        a = get_logicle_transform(T=2**18, M=4, W=0.5, A=0)
+        self.assertIs(a, get_logicle_transform(T=2**18, M=4.0, W=0.5, A=0))
+
+        values = np.array([[-100, 10], [1000, 2**18]], dtype=np.float32)
+        scale = a.transform(values)
+        np.testing.assert_allclose(a.biexponential(scale), values, rtol=1e-5, atol=1e-3)
+
+        a.transform(values, out=values)   # in place on float32
+        np.testing.assert_allclose(values, scale, rtol=1e-6)
+        self.assertTrue(np.isnan(a.transform(np.array([2.0**20]))).all())
+
+    def test_fast_engine(self):
+        """ Tests that the fast processing engine reproduces the pandas engine """
+
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0), comp_flag='table',
+                      singlet_flag='fixed', viable_flag='fixed')
+
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(engine='pandas', **kwargs)
+        b = FCS(filepath=filepath, import_dataframe=True)
+        b.comp_scale_FCS_data(engine='fast', **kwargs)
+
+        assert_frame_equal(a.data, b.data)
+        for attr in ['total_events', 'n_transform_not_nan_all', 'n_transform_keep_all',
+                     'singlet_remain', 'viable_remain']:
+            self.assertEqual(getattr(a, attr), getattr(b, attr))
+        assert_almost_equal(a.n_transform_keep_by_channel, b.n_transform_keep_by_channel)
+        assert_almost_equal(a.n_transform_not_nan_by_channel, b.n_transform_not_nan_by_channel)
+
+    def test_compiled_gate(self):
+        """ Tests that compiled gates match matplotlib Path gating """
+
+        rs = np.random.RandomState(0)
+        for coords in gate_coords.values():
+            gate = compile_gate(coords)
+            self.assertIs(gate, compile_gate(coords))
+
+            vertices = np.array(coords)
+            on_edges = np.concatenate([vertices[:-1] + t * (vertices[1:] - vertices[:-1])
+                                       for t in np.linspace(0, 1, 11)])
+            points = np.concatenate([rs.uniform(-0.2, 1.2, (100000, 2)), vertices, on_edges,
+                                     [[np.nan, 0.5]]]).astype(np.float32)
+            np.testing.assert_array_equal(gate.contains(points),
+                                          Path(coords, closed=True).contains_points(points))
+            np.testing.assert_array_equal(gate.contains_pairs(points, [0, 1], [1, 0]),
+                                          np.column_stack((gate.contains(points),
+                                                           gate.contains(points[:, ::-1]))))
+
+    def test_compensation_cache(self):
+        """ Tests that spectral libraries and compensation matrices are parsed once """
+
+        Process_FCS_Data.warm_compensation_cache(comp_file)
+        library = Process_FCS_Data.load_spectral_library(comp_file['1'])
+        self.assertIs(library, Process_FCS_Data.load_spectral_library(comp_file['1']))
+
+        filepath = data(test_fcs_fn)
+        for i in range(2):
+            a = FCS(filepath=filepath, import_dataframe=True)
+            a.comp_scale_FCS_data(compensation_file=comp_file, gate_coords=gate_coords,
+                                  strict=False, rescale_lim=(-0.5,1.0))
+            if i == 0:
+                n_matrices = len(Process_FCS_Data._comp_matrices)
+        self.assertEqual(len(Process_FCS_Data._comp_matrices), n_matrices)
+
     def test_HistoStats(self):
         """ Tests the HistoStats information subroutines
         :return:
@@ -235,6 +454,131 @@ class Test_FCS(TestBase):
                                        different than tolerable")
             assert_frame_equal(a.comp_correlation, comp_correlation)
 
+    def test_comp_correlation(self):
+        """ Tests the batched compensation correlations against scipy's pearsonr """
+        a = FCS(filepath=data(test_fcs_fn), import_dataframe=True)
+        a.comp_scale_FCS_data(compensation_file=comp_file, gate_coords=gate_coords,
+                              strict=False, rescale_lim=(-0.5,1.0), comp_flag='table',
+                              singlet_flag='fixed', viable_flag='fixed')
+        a.extract_FCS_histostats()
+
+        ul_gate = Path([(0.0,0.7),(0.6,0.7),(0.9,1.0),(0.0,1.0),(0.0,0.7)], closed=True)
+        for i, row in a.comp_correlation.iterrows():
+            gated = a.data[[row.spill_in, row.spill_from]].values.astype(np.float64)
+            gated = gated[ul_gate.contains_points(a.data[[row.spill_in, row.spill_from]].values)]
+            if len(gated) > 25:
+                r, p = pearsonr(gated[:, 0], gated[:, 1])
+                np.testing.assert_allclose([row.Pearson_R, row.P_value], [r, p], rtol=1e-6)
+            else:
+                self.assertTrue(np.isnan(row.Pearson_R) and np.isnan(row.P_value))
+
+    def test_histostats_engine(self):
+        """ Tests the bincount histograms and partition quartiles against numpy/pandas """
+        rng = np.random.RandomState(0)
+        values = rng.rand(10001, 4).astype(np.float32)
+        values[:5, 0] = [0.0, 1.0, 0.29, -0.5, np.nan]
+        values[:, 3] = np.nan
+
+        counts, edges = histogram_counts(values, np.linspace(0, 1, 101))
+        for j in range(values.shape[1]):
+            np.testing.assert_array_equal(counts[:, j],
+                                          np.histogram(values[:, j], bins=100, range=(0, 1))[0])
+
+        describe = pd.DataFrame(values).describe().T[['25%', '50%', '75%']].values.T
+        np.testing.assert_array_equal(quantiles(values), describe)
+
+        sketch = Quantile_Sketch(values.shape[1], k=256)
+        for start in range(0, len(values), 1000):
+            sketch.update(values[start:start + 1000])
+        ranks = [np.searchsorted(np.sort(values[:, j]), sketch.quantiles()[:, j]) / 10000.0
+                 for j in range(3)]
+        np.testing.assert_allclose(ranks, [[0.25, 0.5, 0.75]] * 3,
+                                   atol=np.log2(10000 / 256.0) / (2 * 256))
+        self.assertTrue(np.isnan(sketch.quantiles()[:, 3]).all())
+
+    def test_block_processing(self):
+        """ Tests that streaming an FCS file in blocks matches processing the whole file """
+
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0), comp_flag='table',
+                      singlet_flag='fixed', viable_flag='fixed')
+
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(**kwargs)
+        a.extract_FCS_histostats()
+        a.feature_extraction(extraction_type='FULL', bins=10)
+
+        b = FCS(filepath=filepath)
+        b.extract_FCS_histostats(blocks=b.comp_scale_FCS_blocks(block_size=7000, **kwargs))
+        self.assertEqual(a.TubeStats, b.TubeStats)
+        np.testing.assert_array_equal(a.histos.values, b.histos.values)
+        np.testing.assert_allclose(a.PmtStats['mean'].values, b.PmtStats['mean'].values,
+                                   rtol=1e-6)
+        self.assertFalse(b.PmtStats['50%'].isnull().any())
+        np.testing.assert_allclose(a.comp_correlation.Pearson_R.values,
+                                   b.comp_correlation.Pearson_R.values, rtol=1e-6)
+
+        b.feature_extraction(extraction_type='FULL', bins=10,
+                             blocks=b.comp_scale_FCS_blocks(block_size=7000, **kwargs))
+        np.testing.assert_array_equal(a.FCS_features.histogram.indices,
+                                      b.FCS_features.histogram.indices)
+        np.testing.assert_allclose(a.FCS_features.histogram.data,
+                                   b.FCS_features.histogram.data)
+
+    def test_event_cache(self):
+        """ Tests that processed data is reused from the event cache """
+
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0))
+        outdir = self.mkoutdir()
+        cache = Event_Cache(path.join(outdir, 'cache'))
+
+        a = FCS(filepath=filepath)
+        a.comp_scale_FCS_data(cache=cache, **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        b = FCS(filepath=filepath)
+        b.comp_scale_FCS_data(cache=cache, **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(a.gated_events.remain, b.gated_events.remain)
+        assert_frame_equal(a.data, b.data)
+        for output in Event_Cache.counters:
+            np.testing.assert_array_equal(getattr(a, output), getattr(b, output))
+
+        kwargs['rescale_lim'] = (-0.15, 1.0)
+        c = FCS(filepath=filepath)
+        c.comp_scale_FCS_data(cache=cache, **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        cache.max_size = cache.size() - 1   # least recently used entry (a) is evicted
+        kwargs['rescale_lim'] = (-0.3, 1.0)
+        d = FCS(filepath=filepath)
+        d.comp_scale_FCS_data(cache=cache, **kwargs)
+        self.assertTrue(cache.size() <= cache.max_size)
+
+        kwargs['rescale_lim'] = (-0.5, 1.0)
+        e = FCS(filepath=filepath)
+        e.comp_scale_FCS_data(cache=cache, **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+        cache.max_size = 2**30
+        f = FCS(filepath=filepath)   # arguments outside the usual flags are part of the key
+        f.comp_scale_FCS_data(cache=cache, log_param=['FSC-A'], **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        f = FCS(filepath=filepath)   # but not those that do not change the output
+        f.comp_scale_FCS_data(cache=cache, engine='fast', **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (2, 5))
+
+        # command line options (i.e. **vars(args)) and explicit defaults share the entry
+        for k in range(2):
+            with open(path.join(outdir, 'log{}.txt'.format(k)), 'w') as logfile:
+                g = FCS(filepath=filepath)
+                g.comp_scale_FCS_data(cache=cache, logfile=logfile, verbosity=k, dir='.',
+                                      comp_flag='Table', singlet_flag='fixed', **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (4, 5))
+
     def test_GatingToggle(self):
         """ Tests the HistoStats information subroutines
         :return:
@@ -270,7 +614,145 @@ class Test_FCS(TestBase):
                               comp_flag='table',singlet_flag='auto',
                               viable_flag='fixed',classes=5,
                               singlet_verbose=True,save_dir=self.mkoutdir())
-                             
+
+    def test_auto_singlet_grid(self):
+        """
+        Tests that grid auto singlet gating is reproducible and agrees with the gmm method
+        """
+        filepath = data(test_fcs_fn)
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(compensation_file=comp_file,gate_coords=gate_coords,
+                              strict=False, rescale_lim=(-0.5,1.0),
+                              comp_flag='table',singlet_flag=None,
+                              viable_flag=None)
+
+        first = GMM_doublet_detection(a.data, classes=5, singlet_method='grid',
+                                      singlet_seed=1, singlet_compare='gmm')
+        second = GMM_doublet_detection(a.data, classes=5, singlet_method='grid', singlet_seed=1)
+        np.testing.assert_array_equal(first.singlet_mask, second.singlet_mask)
+        np.testing.assert_array_equal(first.centroids, second.centroids)
+        self.assertGreater(first.agreement, 0.95)
+
+    def test_event_cache_singlet_method(self):
+        """ Tests that auto singlet runs with another singlet_method miss the event cache """
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0), singlet_flag='auto',
+                      singlet_seed=1, classes=5)
+        outdir = self.mkoutdir()
+        cache = Event_Cache(path.join(outdir, 'cache'))
+
+        a = FCS(filepath=filepath)
+        a.comp_scale_FCS_data(cache=cache, singlet_method='gmm', **kwargs)
+        b = FCS(filepath=filepath)
+        b.comp_scale_FCS_data(cache=cache, singlet_method='grid', singlet_compare='gmm',
+                              **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        c = FCS(filepath=filepath)
+        c.comp_scale_FCS_data(singlet_method='grid', singlet_compare='gmm', **kwargs)
+        self.assertEqual(b.singlet_remain, c.singlet_remain)
+
+        d = FCS(filepath=filepath)
+        d.comp_scale_FCS_data(cache=cache, singlet_method='grid', singlet_compare='gmm',
+                              **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(d.singlet_remain, c.singlet_remain)
+        self.assertEqual(d.singlet_agreement, c.singlet_agreement)
+
+        # fits warm started from a singlet model cache are not mixed with cold fits
+        singlet_cache = Singlet_Model_Cache(path.join(outdir, 'singlet_cache'))
+        e = FCS(filepath=filepath)
+        e.comp_scale_FCS_data(cache=cache, singlet_method='grid', singlet_compare='gmm',
+                              singlet_cache=singlet_cache, **kwargs)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_singlet_model_cache(self):
+        """
+        Tests that auto singlet fits are cached per cytometer and warm started from the cache
+        """
+        filepath = data(test_fcs_fn)
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(compensation_file=comp_file,gate_coords=gate_coords,
+                              strict=False, rescale_lim=(-0.5,1.0),
+                              comp_flag='table',singlet_flag=None,
+                              viable_flag=None)
+
+        cache_dir = path.join(self.mkoutdir(), 'singlet_cache')
+        cache = Singlet_Model_Cache(cache_dir)
+        cold = GMM_doublet_detection(a.data, classes=5, singlet_method='grid',
+                                     singlet_cache=cache, cytnum=a.cytnum, date=a.date)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        singlet_model_cache._models.clear()   # as in another worker, read from the directory
+        cache = Singlet_Model_Cache(cache_dir)
+        warm = GMM_doublet_detection(a.data, classes=5, singlet_method='grid',
+                                     singlet_cache=cache, cytnum=a.cytnum, date=a.date)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertGreater(np.mean(cold.singlet_mask == warm.singlet_mask), 0.99)
+
+    def test_gated_events(self):
+        """
+        Tests that gates are composed lazily and that stats read through the gate mask
+        match stats of the materialized data
+        """
+        filepath = data(test_fcs_fn)
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(compensation_file=comp_file,gate_coords=gate_coords,
+                              strict=False, rescale_lim=(-0.5,1.0),
+                              comp_flag='table',singlet_flag='fixed',
+                              viable_flag='fixed')
+        gated = a.gated_events
+        self.assertEqual([name for name, n in gated.remain], ['nan', 'limit', 'singlet', 'viable'])
+        self.assertEqual(dict(gated.remain)['singlet'], a.singlet_remain)
+        self.assertEqual(dict(gated.remain)['viable'], a.viable_remain)
+        self.assertEqual(len(gated.events), a.total_events)
+
+        a.extract_FCS_histostats()   # from the mask
+        self.assertIsNotNone(a.gated_events)
+        histos, PmtStats = a.histos, a.PmtStats
+
+        self.assertEqual(len(a.data), a.viable_remain)   # materialized on access
+        self.assertIsNone(a.gated_events)
+        a.extract_FCS_histostats()
+        assert_frame_equal(histos, a.histos)
+        assert_frame_equal(PmtStats, a.PmtStats)
+
+    def test_event_store(self):
+        """
+        Tests that processing into an Event_Store matches the dataframe and that
+        stats and features accept it
+        """
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0), comp_flag='table',
+                      singlet_flag='fixed', viable_flag='fixed', engine='fast')
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(**kwargs)
+        b = FCS(filepath=filepath, import_dataframe=True)
+        b.comp_scale_FCS_data(event_store=True, **kwargs)
+
+        self.assertIsInstance(b.data, Event_Store)
+        self.assertEqual(b.data.values.dtype, np.float32)
+        self.assertTrue(b.data.values.flags.c_contiguous)
+        assert_frame_equal(b.data.to_dataframe(), a.data)
+        np.testing.assert_array_equal(b.data['CD45 APC-H7'], a.data['CD45 APC-H7'].values)
+        round_trip = pickle.loads(pickle.dumps(b.data, protocol=pickle.HIGHEST_PROTOCOL))
+        assert_frame_equal(round_trip.to_dataframe(), a.data)
+        assert_frame_equal(Event_Store.from_dataframe(a.data).to_dataframe(), a.data)
+
+        a.extract_FCS_histostats()
+        b.extract_FCS_histostats()
+        assert_frame_equal(b.histos, a.histos)
+        assert_frame_equal(b.PmtStats, a.PmtStats)
+
+        a.feature_extraction(extraction_type='Full', bins=10)
+        b.feature_extraction(extraction_type='Full', bins=10)
+        np.testing.assert_array_equal(b.FCS_features.histogram.indices,
+                                      a.FCS_features.histogram.indices)
+        np.testing.assert_allclose(b.FCS_features.histogram.data,
+                                   a.FCS_features.histogram.data)
+
     def test_auto_comp(self):
         """ Tests the auto compensation subroutine of comp_scale_FCS_data
 
@@ -299,6 +781,46 @@ class Test_FCS(TestBase):
                                    rtol=1e-3, atol=0, err_msg="Results are more different \
                                    than tolerable")
 
+    def test_auto_comp_tweak(self):
+        """
+        Tests that auto compensation recovers spillover missing from the overlap library
+        and that both engines apply it
+        """
+        filepath = data(test_fcs_fn)
+        kwargs = dict(compensation_file=comp_file, gate_coords=gate_coords,
+                      strict=False, rescale_lim=(-0.5,1.0), comp_flag='auto',
+                      singlet_flag='fixed', viable_flag='fixed')
+        a = FCS(filepath=filepath, import_dataframe=True)
+        a.comp_scale_FCS_data(engine='pandas', **kwargs)
+        b = FCS(filepath=filepath, import_dataframe=True)
+        b.comp_scale_FCS_data(engine='fast', **kwargs)
+        assert_frame_equal(a.data, b.data)
+
+        # synthetic events (30% bright per reagent) acquired with more spillover than the library
+        c = FCS(filepath=filepath, import_dataframe=True)
+        processed = Process_FCS_Data.Process_FCS_Data(c, comp_file, strict=False,
+                                                      singlet_flag=None, viable_flag=None)
+        columns = processed.columns
+        rs = np.random.RandomState(0)
+        events = np.zeros((30000, len(columns)))
+        for j, name in enumerate(columns):
+            if name in Auto_Comp_Tweak.ignore:
+                events[:, j] = rs.uniform(1e4, 1e5, len(events))
+            else:
+                bright = rs.rand(len(events)) < 0.3
+                events[:, j] = (rs.normal(0, 30, len(events)) +
+                                bright * rs.lognormal(np.log(3e4), 0.5, len(events)))
+        actual = np.array(processed.overlap_matrix)
+        i, j = columns.index('CD45 APC-H7'), columns.index('CD13 PE-Cy7')
+        actual[i, j] += 0.02
+        processed.FCS.data = np.dot(events, actual)
+
+        tweak = Auto_Comp_Tweak(processed)
+        self.assertAlmostEqual(tweak.overlap_matrix.iloc[i, j], actual[i, j], places=3)
+        np.testing.assert_allclose(tweak.overlap_matrix.values, actual, atol=0.005)
+        np.testing.assert_allclose(np.dot(tweak.overlap_matrix.values, tweak.comp_matrix),
+                                   np.eye(len(columns)), atol=1e-9)
+
     # def test_add_CustomCaseData(self):
     #     """ Make sure that CustomCaseData can be loaded
 
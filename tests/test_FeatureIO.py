@@ -9,6 +9,9 @@ import datetime
 import numpy as np
 import pandas as pd
 import pickle
+import h5py
+import os
+from scipy.sparse import csr_matrix
 
 from __init__ import TestBase, datadir, write_csv
 
@@ -70,13 +73,185 @@ class Test_Feature_IO(TestBase):
         # pull meta data from HDF5 file
         meta_data = HDF_obj.get_meta_data()
         log.debug("File meta data is {}".format(meta_data))
-        
-        
 
+    def test_push_pull_pyramid(self):
+        """
+        tests that Pyramid levels match Full extraction and are stored per level
+        """
+        FCS_fp = data(test_fcs_fn)
+        DB_fp = path.join(self.mkoutdir(), 'test.db')
+        HDF_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_pyramid.hdf5')
 
+        FCS_obj = FCS(filepath=FCS_fp, import_dataframe=True)
+        FCS_obj.comp_scale_FCS_data(compensation_file=comp_file,
+                                    gate_coords=gate_coords, rescale_lim=(-0.5, 1),
+                                    strict=False, auto_comp=False)
+        FCS_obj.feature_extraction(extraction_type='Full', bins=5)
+        full = FCS_obj.FCS_features.histogram
+        FCS_obj.feature_extraction(extraction_type='Pyramid', bins=[5, 10])
+        self.assertEqual(sorted(FCS_obj.FCS_features.levels.keys()),
+                         ['2D_10', '2D_5', 'ND_10', 'ND_5'])
+        np.testing.assert_array_equal(FCS_obj.FCS_features.levels['ND_5'].histogram.indices,
+                                      full.indices)
+        np.testing.assert_allclose(FCS_obj.FCS_features.levels['ND_5'].histogram.data,
+                                   full.data)
 
+        DB_obj = FCSdatabase(db=DB_fp, rebuild=True)
+        FCS_obj.meta_to_db(db=DB_obj, dir=path.abspath('.'))
+        Feature_IO(filepath=HDF_fp).push_fcs_features(case_tube_idx=FCS_obj.case_tube_idx,
+                                                      FCS=FCS_obj, db=DB_obj)
 
+        self.assertEqual(Feature_IO(filepath=HDF_fp).get_levels(),
+                         ['2D_10', '2D_5', 'ND_10', 'ND_5'])
+        HDF_obj = Feature_IO(filepath=HDF_fp, level='ND_5')
+        self.assertEqual(HDF_obj.get_case_tube_idxs(), [FCS_obj.case_tube_idx])
+        output = HDF_obj.get_fcs_features(FCS_obj.case_tube_idx)
+        np.testing.assert_allclose(output.data, full.data)
+
+    def test_writer_session(self):
+        """
+        tests that a Feature_IO.writer session writes tubes in batches and that files
+        with per tube groups stay readable
+        """
+        FCS_fp = data(test_fcs_fn)
+        DB_fp = path.join(self.mkoutdir(), 'test.db')
+        HDF_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_writer.hdf5')
+
+        FCS_obj = FCS(filepath=FCS_fp, import_dataframe=True)
+        FCS_obj.comp_scale_FCS_data(compensation_file=comp_file,
+                                    gate_coords=gate_coords, rescale_lim=(-0.5, 1),
+                                    strict=False, auto_comp=False)
+        FCS_obj.feature_extraction(extraction_type='Full', bins=5)
+        histogram = FCS_obj.FCS_features.histogram
+        DB_obj = FCSdatabase(db=DB_fp, rebuild=True)
 
+        HDF_obj = Feature_IO(filepath=HDF_fp, clobber=True)
+        with HDF_obj.writer(db=DB_obj, batch_size=2) as writer:
+            for cti in [5, 3, 1]:
+                writer.push(cti, FCS_obj)
+            self.assertEqual(writer.pushed, 3)
+        HDF_obj.push_fcs_features(case_tube_idx=4, FCS=FCS_obj, db=DB_obj)
+        with self.assertRaises(ValueError):
+            HDF_obj.push_fcs_features(case_tube_idx=3, FCS=FCS_obj, db=DB_obj)
 
+        # a tube written to the per tube groups of earlier versions
+        fh = h5py.File(HDF_fp, 'a')
+        fh['/data/2/data'] = histogram.data
+        fh['/data/2/indices'] = histogram.indices
+        fh['/data/2/indptr'] = histogram.indptr
+        fh['/data/2/shape'] = histogram.shape
+        fh.close()
+
+        fh = h5py.File(HDF_fp, 'r')
+        np.testing.assert_array_equal(fh['/features/index'][:, 0], [1, 3, 4, 5])
+        fh.close()
+        self.assertEqual(HDF_obj.get_case_tube_idxs(), [1, 2, 3, 4, 5])
+        for cti in [1, 2, 4, 5]:
+            output = HDF_obj.get_fcs_features(cti)
+            self.assertEqual(output.shape, histogram.shape)
+            np.testing.assert_array_equal(output.indices, histogram.indices)
+            np.testing.assert_array_equal(output.data, histogram.data)
+
+    def test_migrate_layout(self):
+        """
+        tests converting per tube groups to the concatenated layout and multi tube reads
+        """
+        FCS_fp = data(test_fcs_fn)
+        HDF_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_groups.hdf5')
+        out_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_migrated.hdf5')
+
+        FCS_obj = FCS(filepath=FCS_fp, import_dataframe=True)
+        FCS_obj.comp_scale_FCS_data(compensation_file=comp_file,
+                                    gate_coords=gate_coords, rescale_lim=(-0.5, 1),
+                                    strict=False, auto_comp=False)
+        FCS_obj.feature_extraction(extraction_type='Full', bins=5)
+        histogram = FCS_obj.FCS_features.histogram
+
+        # per tube groups as written by earlier versions
+        fh = h5py.File(HDF_fp, 'w')
+        fh['/extraction_type'] = 'Full'
+        for cti in [12, 3, 7]:
+            fh['/data/{}/data'.format(cti)] = histogram.data * cti
+            fh['/data/{}/indices'.format(cti)] = histogram.indices
+            fh['/data/{}/indptr'.format(cti)] = histogram.indptr
+            fh['/data/{}/shape'.format(cti)] = histogram.shape
+        fh.close()
+        if path.exists(out_fp):
+            os.remove(out_fp)
+
+        out = Feature_IO(filepath=HDF_fp).migrate_layout(out_fp, batch_size=2)
+        fh = h5py.File(out_fp, 'r')
+        self.assertNotIn('data', fh)
+        self.assertEqual(fh['/extraction_type'].value, 'Full')
+        np.testing.assert_array_equal(fh['/features/index'][:, 0], [3, 7, 12])
+        fh.close()
+
+        self.assertEqual(out.get_case_tube_idxs(), [3, 7, 12])
+        output = out.get_fcs_features_matrix([12, 3, 7, 3])
+        self.assertEqual(output.shape, (4, histogram.shape[1]))
+        for row, cti in enumerate([12, 3, 7, 3]):
+            np.testing.assert_array_equal(output[row].indices, histogram.indices)
+            np.testing.assert_allclose(output[row].data, histogram.data * cti)
+        with self.assertRaises(KeyError):
+            out.get_fcs_features(5)
+
+    def test_merge_failure(self):
+        """
+        tests that tubes with another number of bins or unreadable features are left out
+        of the merged features and listed as merge failures
+        """
+        HDF_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_merge_failure.hdf5')
+        HDF_obj = Feature_IO(filepath=HDF_fp, clobber=True)
+
+        row = csr_matrix(np.array([[0, 2.0, 0, 0, 1.0, 0]]))
+        fh = h5py.File(HDF_fp, 'w')
+        HDF_obj._append_features(fh, None, [(3, row), (7, 3 * row),
+                                            (5, csr_matrix(np.ones((1, 4))))])
+        fh['/data/9/data'] = row.data       # per tube group without a shape
+        fh['/data/11/data'] = row.data
+        fh['/data/11/indices'] = row.indices
+        fh['/data/11/indptr'] = row.indptr
+        fh['/data/11/shape'] = row.shape
+        fh['/data/13/shape'] = row.shape    # per tube group without the values
+        fh.close()
+
+        features, bin_num, not_in_data, merge_fail = \
+            HDF_obj.make_single_tube_analysis([7, 5, 13, 9, 11, 3, 4], dense=True)
+        self.assertEqual(not_in_data, [4])
+        self.assertEqual(merge_fail, [5, 9, 13])
+        self.assertEqual(list(features.index), [7, 11, 3])
+        np.testing.assert_array_equal(bin_num, [1, 4])
+        np.testing.assert_allclose(features.values, [[6, 3], [2, 1], [2, 1]])
+
+        with self.assertRaises(ValueError):
+            HDF_obj.make_single_tube_analysis([9])
+
+    def test_index_append(self):
+        """
+        tests that batches are appended to the tube index, which is read in order before
+        and after it is sorted
+        """
+        HDF_fp = path.join(self.mkoutdir(), 'test_Feature_HDF_index.hdf5')
+        HDF_obj = Feature_IO(filepath=HDF_fp, clobber=True)
+        row = csr_matrix(np.array([[0, 2.0, 0, 1.0]]))
 
+        fh = h5py.File(HDF_fp, 'w')
+        HDF_obj._append_features(fh, None, [(2, row), (4, 2 * row)])
+        HDF_obj._append_features(fh, None, [(6, 3 * row)])
+        self.assertTrue(fh['/features/index'].attrs.get('sorted', True))
+        HDF_obj._append_features(fh, None, [(5, 4 * row), (1, 5 * row)])
+        self.assertEqual(fh['/features/index'].shape, (5, 2))
+        self.assertFalse(fh['/features/index'].attrs['sorted'])
+        fh.close()
 
+        for sort in [False, True]:
+            if sort:
+                fh = h5py.File(HDF_fp, 'a')
+                HDF_obj._sort_index(fh, None)
+                np.testing.assert_array_equal(fh['/features/index'][:],
+                                              [[1, 4], [2, 0], [4, 1], [5, 3], [6, 2]])
+                fh.close()
+            self.assertEqual(HDF_obj.get_case_tube_idxs(), [1, 2, 4, 5, 6])
+            output = HDF_obj.get_fcs_features_matrix([6, 1, 4])
+            np.testing.assert_allclose(output.toarray(), [[0, 6, 0, 3], [0, 10, 0, 5],
+                                                          [0, 4, 0, 2]])
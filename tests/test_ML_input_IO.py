@@ -9,6 +9,9 @@ import datetime
 import numpy as np
 import pandas as pd
 import pickle
+import h5py
+from scipy.sparse import csr_matrix, issparse
+from pandas.util.testing import assert_frame_equal, assert_series_equal
 
 from __init__ import TestBase, datadir, write_csv
 from FlowAnal.Feature_IO import Feature_IO
@@ -56,7 +59,18 @@ class Test_ML_input_IO(TestBase):
         FT_HDF_obj.push_fcs_features(case_tube_idx=FCS_obj.case_tube_idx,
                                      FCS=FCS_obj, db=DB_obj)
         
-        feature_DF,not_in_data,merge_fail = FT_HDF_obj.make_single_tube_analysis([FCS_obj.case_tube_idx])
+        features, bin_num, not_in_data, merge_fail = \
+            FT_HDF_obj.make_single_tube_analysis([FCS_obj.case_tube_idx])
+        histogram = FCS_obj.FCS_features.histogram
+        np.testing.assert_array_equal(bin_num, histogram.indices)
+        np.testing.assert_allclose(features.toarray().ravel(), histogram.data)
+        self.assertEqual((not_in_data, merge_fail), ([], []))
+
+        feature_DF, bin_num, not_in_data, merge_fail = \
+            FT_HDF_obj.make_single_tube_analysis([FCS_obj.case_tube_idx, 0], dense=True)
+        self.assertEqual(not_in_data, [0])
+        self.assertEqual(list(feature_DF.index), [FCS_obj.case_tube_idx])
+        np.testing.assert_allclose(feature_DF.values, features.toarray())
 
         ML_HDF_obj = MergedFeatures_IO(filepath=ML_HDF_fp,clobber=True)
         
@@ -67,3 +81,75 @@ class Test_ML_input_IO(TestBase):
 
 
 
+
+    def test_typed_storage(self):
+        """
+        tests that dataframes and series round trip with their dtypes and that string
+        encoded groups of earlier versions are still read
+        """
+        ML_HDF_fp = path.join(self.mkoutdir(), 'test_ML_HDF_typed.hdf5')
+        ML_HDF_obj = MergedFeatures_IO(filepath=ML_HDF_fp, clobber=True)
+
+        features = pd.DataFrame(np.arange(12, dtype=np.float32).reshape(3, 4),
+                                index=[11, 12, 15], columns=[3, 8, 9, 40])
+        annotations = pd.DataFrame({'case_num': ['13-1', '13-2', '13-2'],
+                                    'annotation': [0, 1, 1],
+                                    'score': [0.5, np.nan, 2.0],
+                                    'date': pd.to_datetime(['2015-01-01', '2015-02-01',
+                                                            '2015-03-01'])},
+                                   columns=['case_num', 'annotation', 'score', 'date'])
+        ML_HDF_obj.push_DataFrame(features, '/typed/')
+        ML_HDF_obj.push_annotations(annotations)
+        assert_frame_equal(ML_HDF_obj.pull_DataFrame('/typed/'), features)
+        assert_frame_equal(ML_HDF_obj.pull_DataFrame('/annotations/'), annotations)
+
+        bins = pd.Series([10, 10, 8], index=['FSC-A', 'SSC-H', 'CD45'], name='bins')
+        ML_HDF_obj.push_Series(bins, '/bin_description/')
+        assert_series_equal(ML_HDF_obj.pull_Series('/bin_description/'), bins)
+
+        # string encoded dataframe as written by earlier versions
+        fh = h5py.File(ML_HDF_fp, 'a')
+        fh['/old/index'] = ['0', '1']
+        fh['/old/columns'] = ['a', 'b']
+        fh['/old/data'] = np.array([['1', 'x'], ['2', 'y']])
+        fh.close()
+        old = ML_HDF_obj.pull_DataFrame('/old')
+        self.assertEqual(list(old.columns), ['a', 'b'])
+        self.assertEqual(list(old['b']), ['x', 'y'])
+
+    def test_feature_batches(self):
+        """
+        tests storing features in row blocks (sparse, dense and memory mapped) and
+        streaming them in batches
+        """
+        ML_HDF_fp = path.join(self.mkoutdir(), 'test_ML_HDF_batches.hdf5')
+        rs = np.random.RandomState(0)
+        values = rs.rand(50, 20).astype(np.float32)
+        values[values < 0.8] = 0
+        features = pd.DataFrame(values, index=['case_{}'.format(i) for i in range(50)],
+                                columns=np.arange(20) * 3)
+
+        for layout, compression in [('auto', 'lzf'), ('dense', 'lzf'), ('dense', None)]:
+            ML_HDF_obj = MergedFeatures_IO(filepath=ML_HDF_fp, clobber=True)
+            ML_HDF_obj.push_features(csr_matrix(values) if layout == 'auto' else features,
+                                     index=features.index, columns=features.columns,
+                                     layout=layout, block_rows=16, compression=compression)
+            fh = h5py.File(ML_HDF_fp, 'r')
+            self.assertEqual(fh['/features/'].attrs['layout'],
+                             'sparse' if layout == 'auto' else 'dense')
+            fh.close()
+
+            for shuffle in [False, True]:
+                rows = []
+                for index, batch in ML_HDF_obj.iter_batches(batch_size=12, shuffle=shuffle,
+                                                            seed=1):
+                    self.assertLessEqual(batch.shape[0], 12)
+                    batch = batch.toarray() if issparse(batch) else np.asarray(batch)
+                    np.testing.assert_array_equal(batch, features.loc[index].values)
+                    rows.extend(index)
+                self.assertEqual(sorted(rows), sorted(features.index))
+                self.assertEqual(rows == list(features.index), not shuffle)
+
+        memmap = ML_HDF_obj.get_memmap()
+        self.assertIsInstance(memmap, np.memmap)
+        np.testing.assert_array_equal(memmap, values)